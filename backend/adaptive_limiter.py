@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+import httpx
+from openai import APITimeoutError
+
+logger = logging.getLogger(__name__)
+
+CHAT_LIMIT_INITIAL = int(os.getenv("CHAT_LIMIT_INITIAL", 5))
+CHAT_LIMIT_FLOOR = int(os.getenv("CHAT_LIMIT_FLOOR", 2))
+CHAT_LIMIT_CEILING = int(os.getenv("CHAT_LIMIT_CEILING", 64))
+# Latency above this multiple of the recent best counts as congestion (no growth)
+CHAT_LIMIT_LATENCY_TOLERANCE = float(os.getenv("CHAT_LIMIT_LATENCY_TOLERANCE", 2.0))
+CHAT_LIMIT_BACKOFF = float(os.getenv("CHAT_LIMIT_BACKOFF", 0.5))
+# Longest a chat may wait in the queue before it is turned away as busy (0 = no limit)
+CHAT_MAX_QUEUE_WAIT_S = float(os.getenv("CHAT_MAX_QUEUE_WAIT_S", 60))
+# How often a queued chat re-checks its position for progress updates
+QUEUE_POLL_S = 0.5
+
+
+class QueueTimeout(Exception):
+    """A chat waited longer than the maximum queue wait for a slot."""
+
+    def __init__(self, waited: float):
+        self.waited = waited
+        super().__init__(f"Server busy: no chat slot within {waited:.0f}s, please retry")
+
+
+def is_overload(exc: BaseException) -> bool:
+    """Upstream throttling or timeouts: signals to shrink the limit."""
+    if getattr(exc, "status_code", None) == 429:
+        return True
+    return isinstance(exc, (APITimeoutError, httpx.TimeoutException, asyncio.TimeoutError))
+
+
+# Called with (position, estimated wait in ms or None) while a chat is queued
+QueueCallback = Callable[[int, Optional[int]], Awaitable[None]]
+
+
+class _Waiter:
+    __slots__ = ("future", "flow")
+
+    def __init__(self, future: asyncio.Future, flow: str):
+        self.future = future
+        self.flow = flow
+
+
+class _Slot:
+    def __init__(self, limiter: "AIMDLimiter", flow: str, on_queued: Optional[QueueCallback]):
+        self.limiter = limiter
+        self.flow = flow
+        self.on_queued = on_queued
+        self.started = 0.0
+
+    async def __aenter__(self):
+        await self.limiter.acquire(self.flow, self.on_queued)
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.limiter.release()
+        if exc is None:
+            self.limiter.on_success(time.monotonic() - self.started)
+        elif is_overload(exc):
+            self.limiter.on_overload(self.started)
+        return False
+
+    def failed(self, exc: BaseException):
+        """Report a failure handled inside the slot (e.g. a route the router failed over from)."""
+        if is_overload(exc):
+            self.limiter.on_overload(self.started)
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit that adapts to the upstream (additive increase,
+    multiplicative decrease).
+
+    Each successful call whose latency stays within CHAT_LIMIT_LATENCY_TOLERANCE
+    times the recent best grows the limit by 1/limit, so a full window of good
+    calls adds one slot. A 429 or timeout multiplies the limit by
+    CHAT_LIMIT_BACKOFF, at most once per window: failures from calls that
+    started before the last decrease are ignored. The limit stays within
+    [floor, ceiling].
+
+    Waiters are queued per flow (one per agent) and flows are served round-robin,
+    FIFO within a flow, so a busy agent cannot push others to the back. A queued
+    caller can be told its position and an estimated wait, and gives up with
+    QueueTimeout after `max_queue_wait` seconds.
+    """
+
+    def __init__(
+        self,
+        initial: int = CHAT_LIMIT_INITIAL,
+        floor: int = CHAT_LIMIT_FLOOR,
+        ceiling: int = CHAT_LIMIT_CEILING,
+        backoff: float = CHAT_LIMIT_BACKOFF,
+        latency_tolerance: float = CHAT_LIMIT_LATENCY_TOLERANCE,
+        max_queue_wait: Optional[float] = CHAT_MAX_QUEUE_WAIT_S
+    ):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.max_queue_wait = max_queue_wait or None
+        self._limit = float(min(self.ceiling, max(self.floor, initial)))
+        self.in_flight = 0
+        # flow -> FIFO of waiters; dict order is the round-robin order
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._last_decrease = 0.0
+        self._latencies: Deque[float] = deque(maxlen=100)
+        self.successes = 0
+        self.overloads = 0
+        self.increases = 0
+        self.decreases = 0
+        self.busy_rejections = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit + 1e-9)
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for q in self._queues.values() for w in q if not w.future.done())
+
+    def slot(self, flow: str = "default", on_queued: Optional[QueueCallback] = None) -> _Slot:
+        """`async with limiter.slot():` holds one slot and reports the outcome."""
+        return _Slot(self, flow, on_queued)
+
+    def position(self, waiter: _Waiter) -> int:
+        """1-based place in the round-robin admission order."""
+        live = {f: sum(1 for w in q if not w.future.done()) for f, q in self._queues.items()}
+        index = [w for w in self._queues[waiter.flow] if not w.future.done()].index(waiter)
+        # Each round admits one waiter per flow in rotation order; ours comes up in round `index`
+        earlier_rounds = sum(min(count, index) for count in live.values())
+        flows = list(live)
+        ahead_this_round = sum(1 for f in flows[:flows.index(waiter.flow)] if live[f] > index)
+        return earlier_rounds + ahead_this_round + 1
+
+    def estimated_wait_ms(self, position: int) -> Optional[int]:
+        """Rough wait from recent call durations: one call time per `limit` callers ahead."""
+        if not self._latencies:
+            return None
+        average = sum(self._latencies) / len(self._latencies)
+        return int(math.ceil(position / max(1, self.limit)) * average * 1000)
+
+    async def acquire(self, flow: str = "default", on_queued: Optional[QueueCallback] = None):
+        if self.in_flight < self.limit and not self._queues:
+            self.in_flight += 1
+            return
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), flow)
+        self._queues.setdefault(flow, deque()).append(waiter)
+        self._wake()  # only stale (cancelled) waiters may have been ahead of us
+
+        started = time.monotonic()
+        last_position = None
+        try:
+            while not waiter.future.done():
+                if on_queued:
+                    position = self.position(waiter)
+                    if position != last_position:
+                        last_position = position
+                        await on_queued(position, self.estimated_wait_ms(position))
+                        continue  # the callback may have taken a while
+                timeout = QUEUE_POLL_S
+                if self.max_queue_wait is not None:
+                    remaining = self.max_queue_wait - (time.monotonic() - started)
+                    if remaining <= 0:
+                        raise QueueTimeout(time.monotonic() - started)
+                    timeout = min(timeout, remaining)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()  # admitted just as we gave up
+            else:
+                waiter.future.cancel()
+            if isinstance(e, QueueTimeout):
+                self.busy_rejections += 1
+            raise
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+        self._wake()
+
+    def _wake(self):
+        while self._queues and self.in_flight < self.limit:
+            flow, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if waiter.future.done():
+                # Stale entry (cancelled or timed out); doesn't use up the flow's turn
+                if not queue:
+                    del self._queues[flow]
+                continue
+            if queue:
+                self._queues.move_to_end(flow)
+            else:
+                del self._queues[flow]
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+    def on_success(self, latency: float):
+        self.successes += 1
+        best = min(self._latencies) if self._latencies else latency
+        self._latencies.append(latency)
+        if latency > best * self.latency_tolerance:
+            return  # slower than usual: hold the limit
+        if self._limit < self.ceiling:
+            before = self.limit
+            self._limit = min(float(self.ceiling), self._limit + 1.0 / self._limit)
+            if self.limit > before:
+                self.increases += 1
+                self._wake()
+
+    def on_overload(self, started: float):
+        self.overloads += 1
+        if started < self._last_decrease:
+            return  # already backed off for this window
+        self._last_decrease = time.monotonic()
+        before = self.limit
+        self._limit = max(float(self.floor), self._limit * self.backoff)
+        if self.limit < before:
+            self.decreases += 1
+            logger.warning(f"Upstream overloaded: chat concurrency limit {before} -> {self.limit}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "floor": self.floor,
+            "ceiling": self.ceiling,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "successes": self.successes,
+            "overloads": self.overloads,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "busy_rejections": self.busy_rejections,
+            "max_queue_wait_s": self.max_queue_wait,
+        }
@@ -0,0 +1,439 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Collection, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from pydantic import BaseModel, ConfigDict, Field
+from sqlmodel import Session, select
+
+from chat_memory import MemoryPolicy
+from knowledge_index import KNOWLEDGE_MODE, BM25Index, ChunkKey, IngestedDocument, KnowledgeChunk, build_knowledge_index, format_knowledge
+from knowledge_store import load_blob_contents
+from mcp_manager import MCPManager
+from models import Agent, AgentKnowledgeFile, AgentMCPServer, ChatMessage, KnowledgeBlobChunk, MCPServer
+
+logger = logging.getLogger(__name__)
+
+# Prompt layout is kept byte-stable across requests so the upstream can reuse its
+# prompt-prefix cache: static content (agent prompt, then knowledge files in a
+# fixed order) comes first, anything that varies per request goes last, and tools
+# are always sent sorted by name. In retrieval mode the knowledge chunks picked for
+# a user message go in a system message just before it and stay in the history,
+# so earlier turns are never rewritten.
+
+
+def build_knowledge_context(knowledge_files: Sequence[AgentKnowledgeFile], contents: Mapping[str, str]) -> str:
+    """The knowledge section of a full-mode system prompt; `contents` maps the files' blob hashes to their text."""
+    if not knowledge_files:
+        return ""
+    ordered = sorted(knowledge_files, key=lambda k: (k.filename, k.id or 0))
+    context = "\n\n--- Contextual Information ---\n"
+    for k_file in ordered:
+        context += f"File: {k_file.filename}\nContent:\n{contents.get(k_file.blob_sha256, '')}\n\n"
+    context += "----------------------------\n\n"
+    return context
+
+
+def build_system_prompt(agent: Agent, knowledge_context: str, volatile_context: str = "") -> str:
+    """Static agent prompt first, then knowledge, then per-request content."""
+    return agent.system_prompt + knowledge_context + volatile_context
+
+
+def load_knowledge_files(session: Session, agent_id: int) -> List[AgentKnowledgeFile]:
+    return session.exec(
+        select(AgentKnowledgeFile)
+        .where(AgentKnowledgeFile.agent_id == agent_id, AgentKnowledgeFile.status == "ready")
+        .order_by(AgentKnowledgeFile.filename, AgentKnowledgeFile.id)
+    ).all()
+
+
+def load_knowledge_chunks(session: Session, agent_id: int) -> List[KnowledgeBlobChunk]:
+    """Chunks of the blobs behind the agent's ready files, each blob's once."""
+    blobs = select(AgentKnowledgeFile.blob_sha256).where(
+        AgentKnowledgeFile.agent_id == agent_id, AgentKnowledgeFile.status == "ready"
+    )
+    return session.exec(
+        select(KnowledgeBlobChunk)
+        .where(KnowledgeBlobChunk.blob_sha256.in_(blobs))
+        .order_by(KnowledgeBlobChunk.blob_sha256, KnowledgeBlobChunk.ordinal)
+    ).all()
+
+
+def load_chat_history(
+    session: Session,
+    chat_session_id: int,
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None
+) -> List[ChatMessage]:
+    """
+    A session's messages oldest first; with `limit`, only the most recent ones.
+    `after_id`/`before_id` bound the ids (exclusive), for paging back through a
+    long history on the (chat_session_id, id) index.
+    """
+    statement = select(ChatMessage).where(ChatMessage.chat_session_id == chat_session_id)
+    if after_id is not None:
+        statement = statement.where(ChatMessage.id > after_id)
+    if before_id is not None:
+        statement = statement.where(ChatMessage.id < before_id)
+    if limit is None:
+        return session.exec(statement.order_by(ChatMessage.id)).all()
+    latest = session.exec(statement.order_by(ChatMessage.id.desc()).limit(limit)).all()
+    return list(reversed(latest))
+
+
+def mcp_scripts_dir() -> str:
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.getenv("MCP_SCRIPTS_DIR", os.path.join(base_dir, "mcp-runtime-scripts"))
+
+
+async def ensure_mcp_registered(mcp_manager: MCPManager, server: MCPServer):
+    """Register the server's config with the manager if it isn't already."""
+    status = await mcp_manager.get_mcp_status(str(server.id))
+    if status.get("status") != "not found":
+        return
+
+    env_vars = {}
+    if server.env_vars:
+        try:
+            env_vars = json.loads(server.env_vars)
+        except Exception:
+            logger.warning(f"Invalid env_vars for MCP {server.id}")
+
+    args = []
+    if server.args:
+        try:
+            args = json.loads(server.args)
+        except Exception:
+            pass
+
+    if not args and server.command == "python":
+        # Resolve full path
+        args = [os.path.join(mcp_scripts_dir(), server.script)]
+
+    await mcp_manager.spawn_mcp(str(server.id), server.command, args, cwd=server.cwd, env=env_vars)
+
+
+def load_agent_mcp_servers(session: Session, agent_id: int) -> List[Tuple[int, Optional[MCPServer]]]:
+    """(server id, server or None if the row is gone) for each linked MCP server."""
+    server_ids = session.exec(
+        select(AgentMCPServer.mcp_server_id)
+        .where(AgentMCPServer.agent_id == agent_id)
+        .order_by(AgentMCPServer.mcp_server_id)
+    ).all()
+    return [(server_id, session.get(MCPServer, server_id)) for server_id in server_ids]
+
+
+async def load_agent_tools(
+    session: Session, agent_id: int, mcp_manager: MCPManager
+) -> Tuple[List[Dict], Dict[str, str], List[str]]:
+    """
+    Build the OpenAI tool list for an agent's linked MCP servers.
+    Returns (tools sorted by name, tool name -> server id, warnings for servers that failed).
+    """
+    return await build_agent_tools(load_agent_mcp_servers(session, agent_id), mcp_manager)
+
+
+async def build_agent_tools(
+    servers: List[Tuple[int, Optional[MCPServer]]], mcp_manager: MCPManager
+) -> Tuple[List[Dict], Dict[str, str], List[str]]:
+    """load_agent_tools for servers already loaded (e.g. on a DB worker thread)."""
+    tools = []
+    tool_map = {}
+    warnings = []
+    for server_id, mcp_server_db in servers:
+        try:
+            # Ensure server is "started" (registered in manager)
+            if mcp_server_db:
+                await ensure_mcp_registered(mcp_manager, mcp_server_db)
+
+            server_tools = await mcp_manager.list_mcp_tools(str(server_id))
+            for tool in server_tools:
+                tool_def = tool.model_dump(exclude_none=True)
+                tools.append({
+                    "type": "function",
+                    "function": {
+                        "name": tool_def["name"],
+                        "description": tool_def.get("description"),
+                        "parameters": tool_def.get("inputSchema")
+                    }
+                })
+                tool_map[tool_def["name"]] = str(server_id)
+        except Exception as e:
+            logger.warning(f"Error loading tools for server {server_id}: {e}")
+            name = mcp_server_db.name if mcp_server_db else server_id
+            warnings.append(f"Failed to load MCP tools for '{name}'. Error: {str(e)}")
+
+    tools.sort(key=lambda t: t["function"]["name"])
+    return tools, tool_map, warnings
+
+
+class AgentSetup(NamedTuple):
+    """The rows chat setup needs for an agent, loaded in one session."""
+
+    agent: Agent
+    knowledge_files: List[AgentKnowledgeFile]
+    servers: List[Tuple[int, Optional[MCPServer]]]
+    # Only loaded in retrieval mode
+    knowledge_chunks: Optional[List[KnowledgeBlobChunk]] = None
+    # Blob hash -> text: every file's in full mode, only unchunked blobs' in retrieval mode
+    knowledge_contents: Optional[Dict[str, str]] = None
+
+
+def knowledge_mode(agent: Agent) -> str:
+    """The agent's knowledge injection mode, "retrieval" or "full"."""
+    mode = agent.knowledge_mode or KNOWLEDGE_MODE
+    return "full" if mode == "full" else "retrieval"
+
+
+def memory_policy(agent: Agent) -> MemoryPolicy:
+    """The agent's conversation memory settings, with the server defaults for those it leaves unset."""
+    policy = MemoryPolicy()
+    if agent.memory_window_tokens is not None:
+        policy.window_tokens = agent.memory_window_tokens
+    if agent.memory_pinned_turns is not None:
+        policy.pinned_turns = agent.memory_pinned_turns
+    if agent.memory_summary_model is not None:
+        policy.summary_model = agent.memory_summary_model
+    return policy
+
+
+def load_agent_setup(session: Session, agent_id: int) -> Optional[AgentSetup]:
+    """Agent row, knowledge files (and their text or chunks) and linked MCP servers, or None if the agent doesn't exist."""
+    agent = session.get(Agent, agent_id)
+    if agent is None:
+        return None
+    knowledge_files = load_knowledge_files(session, agent_id)
+    hashes = {k_file.blob_sha256 for k_file in knowledge_files if k_file.blob_sha256}
+    knowledge_chunks = []
+    if knowledge_mode(agent) == "retrieval":
+        knowledge_chunks = load_knowledge_chunks(session, agent_id)
+        hashes -= {row.blob_sha256 for row in knowledge_chunks}
+    return AgentSetup(
+        agent=agent,
+        knowledge_files=knowledge_files,
+        servers=load_agent_mcp_servers(session, agent_id),
+        knowledge_chunks=knowledge_chunks,
+        knowledge_contents=load_blob_contents(session, hashes)
+    )
+
+
+class AgentRuntimeProfile(BaseModel):
+    """
+    Everything chat setup derives from an agent's rows: the assembled system
+    prompt, the tool definitions and their server map, and the model settings.
+    Shared between connections, so treat it (and its lists) as read-only;
+    the knowledge index is only changed through AgentProfileCache.update().
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    agent_id: int
+    # AgentProfileCache clock value when the build started; see AgentProfileCache
+    version: int
+    model: str
+    reasoning_enabled: bool = True
+    context_budget_tokens: Optional[int] = None
+    fallback_model: Optional[str] = None
+    hedge_enabled: bool = False
+    knowledge_mode: str = "full"
+    memory: MemoryPolicy = Field(default_factory=MemoryPolicy)
+    # Full mode: every knowledge file, already part of system_prompt
+    knowledge_context: str = ""
+    # Retrieval mode: the agent's knowledge chunks, see retrieve_knowledge
+    knowledge_index: Optional[BM25Index] = None
+    system_prompt: str
+    tools: List[Dict[str, Any]] = Field(default_factory=list)
+    tool_map: Dict[str, str] = Field(default_factory=dict)
+    # MCP servers whose tools failed to load; such a profile is not cached
+    warnings: List[str] = Field(default_factory=list)
+
+
+async def compile_agent_profile(setup: AgentSetup, mcp_manager: MCPManager, version: int = 0) -> AgentRuntimeProfile:
+    agent = setup.agent
+    mode = knowledge_mode(agent)
+    contents = setup.knowledge_contents or {}
+    knowledge_context, knowledge_index = "", None
+    if mode == "full":
+        knowledge_context = build_knowledge_context(setup.knowledge_files, contents)
+    else:
+        knowledge_index = build_knowledge_index(setup.knowledge_files, setup.knowledge_chunks or [], contents)
+    tools, tool_map, warnings = await build_agent_tools(setup.servers, mcp_manager)
+    return AgentRuntimeProfile(
+        agent_id=agent.id,
+        version=version,
+        model=agent.model,
+        reasoning_enabled=agent.reasoning_enabled,
+        context_budget_tokens=agent.context_budget_tokens,
+        fallback_model=agent.fallback_model,
+        hedge_enabled=agent.hedge_enabled,
+        knowledge_mode=mode,
+        memory=memory_policy(agent),
+        knowledge_context=knowledge_context,
+        knowledge_index=knowledge_index,
+        system_prompt=build_system_prompt(agent, knowledge_context),
+        tools=tools,
+        tool_map=tool_map,
+        warnings=warnings
+    )
+
+
+def retrieve_knowledge(
+    profile: AgentRuntimeProfile,
+    query: str,
+    count_tokens: Callable[[str], int],
+    exclude: Collection[ChunkKey] = ()
+) -> Tuple[Optional[Dict[str, str]], List[ChunkKey]]:
+    """
+    The system message carrying the knowledge chunks most relevant to a user
+    message, to send just before it, and the keys of those chunks (pass them
+    back in `exclude` on later turns so chunks already in the history aren't
+    repeated; keys stay valid when the profile's index is rebuilt). (None, [])
+    in full mode or when nothing matches.
+    """
+    if profile.knowledge_index is None:
+        return None, []
+    index = profile.knowledge_index
+    hits = index.retrieve(query, count_tokens, exclude=index.indices(exclude))
+    if not hits:
+        return None, []
+    chunks = [index.chunks[i] for i in hits]
+    return {"role": "system", "content": format_knowledge(chunks)}, [chunk.key for chunk in chunks]
+
+
+def add_knowledge_file(profile: AgentRuntimeProfile, file_id: int, filename: str, document: IngestedDocument) -> bool:
+    """Index a newly ingested file into a cached profile; False if the profile can't take it incrementally."""
+    if profile.knowledge_index is None:
+        # Full mode: the file belongs in the system prompt, so the profile is rebuilt
+        return False
+    for ordinal, content in enumerate(document.chunks):
+        terms = document.chunk_terms[ordinal] if document.chunk_terms else None
+        profile.knowledge_index.add(KnowledgeChunk(filename, ordinal, content, file_id, document.sha256), terms)
+    return True
+
+
+def remove_knowledge_file(profile: AgentRuntimeProfile, file_id: int) -> bool:
+    """Unindex a deleted file from a cached profile; False if the profile can't drop it incrementally."""
+    if profile.knowledge_index is None:
+        return False
+    profile.knowledge_index.remove_file(file_id)
+    return True
+
+
+# Compiled agent profiles kept in memory; the TTL bounds staleness when another
+# process (e.g. a second worker) changes an agent
+AGENT_PROFILE_CACHE_SIZE = int(os.getenv("AGENT_PROFILE_CACHE_SIZE", 1000))
+AGENT_PROFILE_TTL_S = float(os.getenv("AGENT_PROFILE_TTL_S", 300))
+
+
+class AgentProfileCache:
+    """
+    AgentRuntimeProfile per agent, so chat setup is a dictionary lookup
+    instead of three queries, prompt assembly and an MCP tool listing.
+
+    The agent, knowledge and MCP write endpoints call invalidate(). Every
+    invalidation advances a clock; a profile is stamped with the clock value
+    at which its build started and is only stored if nothing invalidated that
+    agent since, so a build racing an update can't cache stale rows.
+    Concurrent misses for one agent share a single build.
+    """
+
+    def __init__(self, max_agents: int = AGENT_PROFILE_CACHE_SIZE, ttl_s: float = AGENT_PROFILE_TTL_S):
+        self.max_agents = max_agents
+        self.ttl_s = ttl_s
+        self._profiles: "OrderedDict[int, Tuple[float, AgentRuntimeProfile]]" = OrderedDict()
+        self._builds: Dict[int, asyncio.Future] = {}
+        self._clock = 0
+        self._invalidated_at: Dict[int, int] = {}
+        self._all_invalidated_at = 0
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def invalidate(self, agent_id: Optional[int] = None):
+        """Drop one agent's profile, or every profile (MCP server changes can affect any agent)."""
+        self._clock += 1
+        self.invalidations += 1
+        if agent_id is None:
+            self._all_invalidated_at = self._clock
+            self._invalidated_at.clear()
+            self._profiles.clear()
+        else:
+            self._invalidated_at[agent_id] = self._clock
+            self._profiles.pop(agent_id, None)
+
+    def update(self, agent_id: int, apply: Callable[[AgentRuntimeProfile], bool]):
+        """
+        Change an agent's cached profile in place (e.g. add a knowledge file to
+        its index) instead of dropping it. If apply returns False the profile
+        is dropped as by invalidate(). Builds already running may have missed
+        the change, so like invalidate() this keeps them out of the cache.
+        """
+        self._clock += 1
+        self._invalidated_at[agent_id] = self._clock
+        entry = self._profiles.get(agent_id)
+        if entry is not None and not apply(entry[1]):
+            self._profiles.pop(agent_id, None)
+            self.invalidations += 1
+
+    def cached(self, agent_id: int) -> bool:
+        """Whether a profile for the agent is cached (without counting a lookup)."""
+        return agent_id in self._profiles
+
+    def _fresh_since(self, agent_id: int, version: int) -> bool:
+        return version >= max(self._all_invalidated_at, self._invalidated_at.get(agent_id, 0))
+
+    async def get(
+        self, agent_id: int, build: Callable[[int], Awaitable[Optional[AgentRuntimeProfile]]]
+    ) -> Optional[AgentRuntimeProfile]:
+        """
+        The cached profile, or build(version) on a miss. build returns None
+        for an unknown agent (not cached).
+        """
+        entry = self._profiles.get(agent_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl_s:
+            self._profiles.move_to_end(agent_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+        pending = self._builds.get(agent_id)
+        if pending is not None:
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                return pending.result()
+            # The shared build failed; build here so the error reaches this caller too
+
+        version = self._clock
+        future = asyncio.get_running_loop().create_future()
+        self._builds[agent_id] = future
+        try:
+            profile = await build(version)
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            if self._builds.get(agent_id) is future:
+                del self._builds[agent_id]
+        future.set_result(profile)
+
+        if profile is not None and not profile.warnings and self._fresh_since(agent_id, version):
+            self._profiles[agent_id] = (time.monotonic(), profile)
+            self._profiles.move_to_end(agent_id)
+            while len(self._profiles) > self.max_agents:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "profiles": len(self._profiles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,149 @@
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional, Protocol, TypeVar
+
+from fastapi import Depends
+from sqlmodel import Session
+
+from database import get_async_engine, get_session
+from db_worker import DBWorker
+from dependencies import get_db_worker
+
+T = TypeVar("T")
+
+
+class ResultRows(Protocol):
+    """The accessors handlers use on exec() results: sqlmodel's ScalarResult or Rows."""
+
+    def __iter__(self) -> Iterator[Any]: ...
+
+    def all(self) -> List[Any]: ...
+
+    def first(self) -> Optional[Any]: ...
+
+    def one(self) -> Any: ...
+
+    def one_or_none(self) -> Optional[Any]: ...
+
+
+class AsyncDBSession(Protocol):
+    """
+    What async handlers may use of their session: the API sqlmodel's
+    AsyncSession and ThreadedAsyncSession share.
+    """
+
+    def add(self, instance: Any) -> None: ...
+
+    async def get(self, entity: Any, ident: Any) -> Any: ...
+
+    async def exec(self, statement: Any) -> ResultRows: ...
+
+    async def commit(self) -> None: ...
+
+    async def rollback(self) -> None: ...
+
+    async def refresh(self, instance: Any) -> None: ...
+
+    async def delete(self, instance: Any) -> None: ...
+
+    async def run_sync(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T: ...
+
+
+class Rows:
+    """Buffered result of ThreadedAsyncSession.exec(), with the ScalarResult accessors routers use."""
+
+    def __init__(self, rows: List[Any]):
+        self._rows = rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def all(self) -> List[Any]:
+        return list(self._rows)
+
+    def first(self) -> Optional[Any]:
+        return self._rows[0] if self._rows else None
+
+    def one(self) -> Any:
+        if len(self._rows) != 1:
+            raise ValueError(f"Expected exactly one row, got {len(self._rows)}")
+        return self._rows[0]
+
+    def one_or_none(self) -> Optional[Any]:
+        if len(self._rows) > 1:
+            raise ValueError(f"Expected at most one row, got {len(self._rows)}")
+        return self.first()
+
+
+class ThreadedAsyncSession:
+    """
+    The subset of sqlmodel's AsyncSession used by async handlers, backed by a
+    sync Session whose calls run on the DB worker threads. Used when no async
+    engine is configured, so handlers are written once against the async API.
+
+    After a call with no pending changes the read transaction is ended (without
+    expiring loaded objects), so the pooled connection isn't held while the
+    handler awaits something else. Otherwise requests holding connections and
+    worker threads waiting for one could deadlock once the pool is exhausted.
+    """
+
+    def __init__(self, session: Session, worker: DBWorker):
+        self.session = session
+        self.worker = worker
+
+    def add(self, instance: Any):
+        self.session.add(instance)
+
+    def _release(self):
+        session = self.session
+        if session.in_transaction() and not (session.new or session.dirty or session.deleted):
+            expire_on_commit, session.expire_on_commit = session.expire_on_commit, False
+            try:
+                session.commit()
+            finally:
+                session.expire_on_commit = expire_on_commit
+
+    def _read(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._release()
+
+    async def get(self, entity: Any, ident: Any) -> Any:
+        return await self.worker.run(self._read, self.session.get, entity, ident)
+
+    async def exec(self, statement: Any) -> Rows:
+        return Rows(await self.worker.run(self._read, lambda: self.session.exec(statement).all()))
+
+    async def commit(self):
+        await self.worker.run(self.session.commit)
+
+    async def rollback(self):
+        await self.worker.run(self.session.rollback)
+
+    async def refresh(self, instance: Any):
+        await self.worker.run(self._read, self.session.refresh, instance)
+
+    async def delete(self, instance: Any):
+        await self.worker.run(self.session.delete, instance)
+
+    async def run_sync(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """fn(session, *args) with the sync session, like AsyncSession.run_sync."""
+        return await self.worker.run(self._read, fn, self.session, *args, **kwargs)
+
+
+async def get_async_session(
+    session: Session = Depends(get_session),
+    worker: DBWorker = Depends(get_db_worker)
+) -> AsyncIterator[AsyncDBSession]:
+    """
+    Session for async handlers: an AsyncSession on the async engine when
+    DATABASE_ASYNC is on, otherwise the request's get_session session run on
+    the DB worker threads. Either way every query is awaited.
+    """
+    engine = get_async_engine()
+    if engine is None:
+        yield ThreadedAsyncSession(session, worker)
+        return
+    from sqlmodel.ext.asyncio.session import AsyncSession
+    # No expiry on commit: attribute access after a commit can't do lazy IO in async code
+    async with AsyncSession(engine, expire_on_commit=False) as async_session:
+        yield async_session
@@ -0,0 +1,118 @@
+"""
+Database layer benchmark: requests/sec for list_agents and REST chat setup.
+
+    python bench_db.py --mode threads     # sync engine, queries on the DB worker threads
+    python bench_db.py --mode async       # DATABASE_ASYNC=true (aiosqlite / asyncpg)
+
+Uses DATABASE_URL if set, else a temporary SQLite file, seeded with --agents
+agents (each with knowledge files and a linked MCP server). Requests go
+in-process through httpx.ASGITransport. Chat turns hit the fake upstream with
+no latency, so they measure chat setup (agent, knowledge and MCP lookups) plus
+request handling.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+
+def log(msg):
+    print(f"[BENCH] {msg}")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+class StubMCPManager:
+    async def get_mcp_status(self, mcp_id):
+        return {"status": "active"}
+
+    async def list_mcp_tools(self, mcp_id):
+        return []
+
+
+def seed(engine, agents: int):
+    from sqlmodel import Session, SQLModel
+    from knowledge_store import add_knowledge_text
+    from models import Agent, AgentMCPServer, MCPServer
+
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        server = MCPServer(name="calc", script="calc.py")
+        rows = [Agent(name=f"agent-{i}", system_prompt="Be brief.", model="glm-4.5-flash") for i in range(agents)]
+        session.add_all(rows + [server])
+        session.commit()
+        for agent in rows:
+            session.add(AgentMCPServer(agent_id=agent.id, mcp_server_id=server.id))
+            add_knowledge_text(session, agent.id, "kb.txt", "facts " * 50)
+        session.commit()
+        return [agent.id for agent in rows]
+
+
+async def run(client, make_request, total: int, concurrency: int):
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return time.perf_counter() - started, latencies, errors
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["threads", "async"], default="threads")
+    parser.add_argument("--agents", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    if "DATABASE_URL" not in os.environ:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    os.environ["DATABASE_ASYNC"] = "true" if args.mode == "async" else "false"
+    os.environ.setdefault("ZAI_API_KEY", "bench")
+
+    import httpx
+    from main import app
+    from database import dispose_async_engine, engine
+    from dependencies import get_mcp_manager, get_zai_client
+    from fake_zai_server import FakeZaiConfig, create_app
+    from zai_client import ZaiClient
+
+    agent_ids = seed(engine, args.agents)
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3))
+    zai = ZaiClient(api_key="bench", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_mcp_manager] = lambda: StubMCPManager()
+
+    scenarios = {
+        "list_agents": lambda client, i: client.get("/api/v1/agents/"),
+        "chat_setup": lambda client, i: client.post(
+            "/api/v1/chat/", json={"agent_id": agent_ids[i % len(agent_ids)], "message": "hi"}
+        ),
+    }
+    log(f"mode={args.mode} db={os.environ['DATABASE_URL']} agents={args.agents} "
+        f"requests={args.requests} concurrency={args.concurrency}")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for name, make_request in scenarios.items():
+            elapsed, latencies, errors = await run(client, make_request, args.requests, args.concurrency)
+            log(f"{name:12} {len(latencies) / elapsed:8.1f} req/s  p50={percentile(latencies, 50) * 1000:.1f}ms "
+                f"p95={percentile(latencies, 95) * 1000:.1f}ms mean={statistics.mean(latencies) * 1000:.1f}ms errors={errors}")
+    await dispose_async_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+"""
+Knowledge ingestion benchmark: corpus throughput, and API latency while it is ingested.
+
+    python bench_ingest.py --mb 300 --files 30 --workers 4
+    python bench_ingest.py --workers 0      # ingest on a thread instead of worker processes
+
+Generates a synthetic text corpus (--mb megabytes over --files files) and
+uploads each file through POST /agents/{id}/knowledge in-process (httpx.ASGITransport)
+into a temporary SQLite database, then waits for every file to be ready.
+Reports MB/s and chunks/s end to end (spool, chunk, tokenize, store). While
+that runs, a probe calls GET /agents/ every 20ms; its latency shows how much
+ingestion holds up the event loop.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+
+def log(msg):
+    print(f"[BENCH] {msg}")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def generate_corpus(directory: str, total_mb: int, files: int):
+    rng = random.Random(42)
+    vocabulary = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(3, 10))) for _ in range(20000)]
+    per_file = total_mb * 1024 * 1024 // files
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f"doc-{i:03}.txt")
+        with open(path, "w") as f:
+            size = 0
+            while size < per_file:
+                paragraph = " ".join(rng.choices(vocabulary, k=rng.randint(40, 160))) + ".\n\n"
+                f.write(paragraph)
+                size += len(paragraph)
+        paths.append(path)
+    return paths
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=int, default=300)
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["KNOWLEDGE_INGEST_WORKERS"] = str(args.workers)
+    os.environ["KNOWLEDGE_MAX_UPLOAD_MB"] = str(args.mb)
+    os.environ.setdefault("ZAI_API_KEY", "bench")
+
+    import httpx
+    from sqlmodel import Session, SQLModel
+    from main import app
+    from database import engine
+    from dependencies import knowledge_ingestor
+    from models import Agent
+
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        agent = Agent(name="bench", system_prompt="Be brief.", model="glm-4.5-flash")
+        session.add(agent)
+        session.commit()
+        agent_id = agent.id
+
+    started = time.perf_counter()
+    paths = generate_corpus(workdir, args.mb, args.files)
+    total_bytes = sum(os.path.getsize(p) for p in paths)
+    log(f"corpus: {total_bytes / 1024 / 1024:.0f}MB in {len(paths)} files ({time.perf_counter() - started:.1f}s to generate)")
+
+    probe_latencies = []
+    done = asyncio.Event()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None) as client:
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get("/api/v1/agents/")
+                probe_latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.02)
+
+        probe_task = asyncio.create_task(probe())
+        started = time.perf_counter()
+        file_ids = []
+        for path in paths:
+            with open(path, "rb") as f:
+                response = await client.post(
+                    f"/api/v1/agents/{agent_id}/knowledge", files={"file": (os.path.basename(path), f, "text/plain")}
+                )
+            assert response.status_code == 202, response.text
+            file_ids.append(response.json()["id"])
+        queued = time.perf_counter() - started
+        for file_id in file_ids:
+            await knowledge_ingestor.wait(file_id)
+        elapsed = time.perf_counter() - started
+        done.set()
+        await probe_task
+
+    stats = knowledge_ingestor.stats()
+    knowledge_ingestor.shutdown()
+    log(f"workers={args.workers} uploads queued in {queued:.1f}s, all ingested in {elapsed:.1f}s: "
+        f"{total_bytes / 1024 / 1024 / elapsed:.1f} MB/s, {stats['chunks_stored'] / elapsed:.0f} chunks/s, "
+        f"failed={stats['failed']}")
+    log(f"GET /agents/ during ingestion: n={len(probe_latencies)} p50={percentile(probe_latencies, 50) * 1000:.1f}ms "
+        f"p99={percentile(probe_latencies, 99) * 1000:.1f}ms max={max(probe_latencies) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
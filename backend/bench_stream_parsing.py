@@ -0,0 +1,110 @@
+"""
+Client-side CPU cost of consuming a streamed completion: OpenAI SDK path
+(chat_stream -> ChatCompletionChunk objects) vs the raw SSE path
+(chat_stream_raw -> StreamDelta tuples).
+
+The upstream is an httpx.MockTransport replaying a canned SSE body, so only
+request building, SSE parsing and JSON decoding are measured.
+
+    python bench_stream_parsing.py --tokens 2000 --rounds 20
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from zai_client import ZaiClient
+
+
+def log(msg):
+    print(f"[BENCH] {msg}")
+
+
+def build_sse_body(tokens: int) -> bytes:
+    frames = []
+    for i in range(tokens):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "glm-4.5-flash",
+            "choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}],
+        }
+        frames.append(f"data: {json.dumps(chunk)}\n\n")
+    usage = {"prompt_tokens": 500, "completion_tokens": tokens, "total_tokens": 500 + tokens}
+    frames.append(f"data: {json.dumps({'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': 1700000000, 'model': 'glm-4.5-flash', 'choices': [], 'usage': usage})}\n\n")
+    frames.append("data: [DONE]\n\n")
+    return "".join(frames).encode()
+
+
+def make_client(body: bytes) -> ZaiClient:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=body, headers={"content-type": "text/event-stream"})
+
+    return ZaiClient(api_key="bench", base_url="http://bench.local", transport=httpx.MockTransport(handler))
+
+
+# A realistic tool list so request serialization is part of the measurement
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": f"tool_{i}",
+            "description": "Look up records in the billing database by customer and date range.",
+            "parameters": {
+                "type": "object",
+                "properties": {"customer_id": {"type": "string"}, "from": {"type": "string"}, "to": {"type": "string"}},
+                "required": ["customer_id"],
+            },
+        },
+    }
+    for i in range(12)
+]
+MESSAGES = [{"role": "system", "content": "You are a billing assistant."}, {"role": "user", "content": "Summarize my bill."}]
+
+
+async def consume_sdk(client: ZaiClient) -> int:
+    count = 0
+    async for chunk in client.chat_stream(messages=MESSAGES, tools=TOOLS, stream_options={"include_usage": True}):
+        if chunk.choices and chunk.choices[0].delta.content:
+            count += 1
+    return count
+
+
+async def consume_raw(client: ZaiClient) -> int:
+    count = 0
+    async for content, _, _, _ in client.chat_stream_raw(messages=MESSAGES, tools=TOOLS, tools_key="bench", stream_options={"include_usage": True}):
+        if content:
+            count += 1
+    return count
+
+
+async def measure(name: str, consume, client: ZaiClient, rounds: int) -> float:
+    await consume(client)  # warm up connection pool, caches and imports
+    cpu_start = time.process_time()
+    tokens = 0
+    for _ in range(rounds):
+        tokens += await consume(client)
+    cpu = time.process_time() - cpu_start
+    per_1k = cpu / tokens * 1000 * 1000
+    log(f"{name:<4} {tokens} tokens, {cpu:.3f}s CPU -> {per_1k:.2f} ms CPU per 1k tokens")
+    return per_1k
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    body = build_sse_body(args.tokens)
+    client = make_client(body)
+    sdk = await measure("sdk", consume_sdk, client, args.rounds)
+    raw = await measure("raw", consume_raw, client, args.rounds)
+    log(f"raw SSE path uses {sdk / raw:.1f}x less CPU per token")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
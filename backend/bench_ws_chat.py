@@ -0,0 +1,112 @@
+"""
+WebSocket chat load driver.
+
+Run the backend against the fake upstream to benchmark without network:
+
+    python fake_zai_server.py &
+    ZAI_BASE_URL=http://127.0.0.1:9100 uvicorn main:app --port 8001 &
+    python bench_ws_chat.py --agent-id 1 --clients 50 --turns 5
+
+Reports time-to-first-token and turn duration percentiles across all turns,
+and payload bytes received per completion token. Compare wire formats with
+--protocol compact|msgpack, and --no-deflate to turn off permessage-deflate.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import websockets
+
+from ws_protocol import expand_frame
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WS_URL = "ws://localhost:8001/api/v1/ws/chat"
+
+
+def log(msg):
+    print(f"[BENCH] {msg}")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def decode(frame):
+    if isinstance(frame, bytes):
+        frame = msgpack.unpackb(frame, raw=False)
+    else:
+        frame = json.loads(frame)
+    return expand_frame(frame) if isinstance(frame, list) else frame
+
+
+async def run_client(url: str, turns: int, ttfts: list, durations: list, errors: list, traffic: dict, deflate: bool):
+    try:
+        async with websockets.connect(url, max_size=None, compression="deflate" if deflate else None) as ws:
+            for turn in range(turns):
+                start = time.perf_counter()
+                first_token = None
+                await ws.send(json.dumps({"message": f"benchmark turn {turn}"}))
+                while True:
+                    frame = await ws.recv()
+                    event = decode(frame)
+                    traffic["bytes"] += len(frame.encode("utf-8") if isinstance(frame, str) else frame)
+                    if event["type"] == "token" and first_token is None:
+                        first_token = time.perf_counter()
+                    elif event["type"] == "done":
+                        traffic["tokens"] += event["tokens"]["completion"]
+                        break
+                    elif event["type"] == "error":
+                        errors.append(event.get("content"))
+                        return
+                end = time.perf_counter()
+                if first_token is not None:
+                    ttfts.append(first_token - start)
+                durations.append(end - start)
+    except Exception as e:
+        errors.append(str(e))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=WS_URL)
+    parser.add_argument("--agent-id", type=int, required=True)
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--protocol", choices=["json", "compact", "msgpack"], default="json")
+    parser.add_argument("--no-deflate", action="store_true", help="don't offer permessage-deflate")
+    args = parser.parse_args()
+
+    url = f"{args.url}/{args.agent_id}?protocol={args.protocol}"
+    ttfts, durations, errors = [], [], []
+    traffic = {"bytes": 0, "tokens": 0}
+
+    log(f"{args.clients} clients x {args.turns} turns -> {url} (deflate {'off' if args.no_deflate else 'on'})")
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_client(url, args.turns, ttfts, durations, errors, traffic, not args.no_deflate) for _ in range(args.clients)
+    ))
+    elapsed = time.perf_counter() - started
+
+    log(f"completed turns: {len(durations)} in {elapsed:.2f}s ({len(durations) / elapsed:.1f} turns/s)")
+    if ttfts:
+        log(f"ttft     p50={percentile(ttfts, 50) * 1000:.0f}ms p95={percentile(ttfts, 95) * 1000:.0f}ms p99={percentile(ttfts, 99) * 1000:.0f}ms")
+    if durations:
+        log(f"turn     p50={percentile(durations, 50) * 1000:.0f}ms p95={percentile(durations, 95) * 1000:.0f}ms mean={statistics.mean(durations) * 1000:.0f}ms")
+    if traffic["tokens"]:
+        log(f"payload  {traffic['bytes'] / traffic['tokens']:.1f} bytes/token ({traffic['bytes']} bytes, {traffic['tokens']} tokens)")
+    if errors:
+        log(f"errors: {len(errors)} (first: {errors[0]})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Collection, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from pydantic import BaseModel
+
+from llm_scheduler import LLMScheduler, Priority
+from zai_client import ZaiClient
+
+logger = logging.getLogger(__name__)
+
+# Defaults for agents that leave their memory_* fields unset. The window is the
+# history kept verbatim per prompt in estimated tokens (0 keeps everything); the
+# last MEMORY_PINNED_TURNS turns are kept even past it. Evicted turns are
+# summarized by MEMORY_SUMMARY_MODEL (empty: dropped without a summary).
+MEMORY_WINDOW_TOKENS = int(os.getenv("MEMORY_WINDOW_TOKENS", 12000))
+MEMORY_PINNED_TURNS = int(os.getenv("MEMORY_PINNED_TURNS", 2))
+MEMORY_SUMMARY_MODEL = os.getenv("MEMORY_SUMMARY_MODEL", "glm-4.5-flash")
+MEMORY_SUMMARY_WORDS = int(os.getenv("MEMORY_SUMMARY_WORDS", 300))
+
+# Eviction goes down to this fraction of the window, so the prompt prefix stays
+# the same (and cacheable upstream) for several turns between evictions
+LOW_WATER = 0.6
+# Tool results are cut to this many characters in the summarizer's input
+SUMMARY_TOOL_CHARS = 1000
+
+# Starts the system message carrying the summary; token_budget counts it as history
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain the memory of a conversation between a user and an assistant. Merge the new "
+    "messages into the summary so far. Keep facts, decisions, names, numbers, user preferences "
+    "and open questions; drop pleasantries and anything superseded. Reply with the updated "
+    "summary only, in at most {words} words."
+)
+
+# (summary so far, evicted messages) -> updated summary
+Summarizer = Callable[[str, List[Dict[str, Any]]], Awaitable[str]]
+# (summary, id of the last stored message it covers) -> persisted
+SummarySaver = Callable[[str, int], Awaitable[None]]
+
+
+class MemoryPolicy(BaseModel):
+    """How much of a conversation each prompt carries; see ChatMemory."""
+
+    window_tokens: int = MEMORY_WINDOW_TOKENS
+    pinned_turns: int = MEMORY_PINNED_TURNS
+    summary_model: str = MEMORY_SUMMARY_MODEL
+
+
+class MemoryTurn(NamedTuple):
+    """A user message with everything sent and received for it (knowledge, replies, tool calls and results)."""
+
+    messages: List[Dict[str, Any]]
+    tokens: int
+    # Keys of the knowledge chunks sent with it (see retrieve_knowledge)
+    chunk_ids: List[Tuple[str, int]]
+    # Id of the turn's last stored ChatMessage, if known
+    last_message_id: Optional[int] = None
+
+
+def format_transcript(messages: List[Dict[str, Any]]) -> str:
+    """Plain-text rendering of evicted messages for the summarizer; retrieved knowledge is left out."""
+    lines = []
+    for message in messages:
+        role, content = message.get("role"), message.get("content") or ""
+        if role == "user":
+            lines.append(f"User: {content}")
+        elif role == "assistant":
+            if content:
+                lines.append(f"Assistant: {content}")
+            for tool_call in message.get("tool_calls") or []:
+                function = tool_call.get("function", {})
+                lines.append(f"Assistant called {function.get('name')}({function.get('arguments') or ''})")
+        elif role == "tool":
+            if len(content) > SUMMARY_TOOL_CHARS:
+                content = content[:SUMMARY_TOOL_CHARS] + " [...]"
+            lines.append(f"Tool result: {content}")
+    return "\n".join(lines)
+
+
+def summarizer(zai_client: ZaiClient, scheduler: LLMScheduler, model: str, flow: str = "default") -> Summarizer:
+    """A Summarizer calling `model`, admitted at batch priority so it never delays live turns."""
+    async def summarize(previous: str, messages: List[Dict[str, Any]]) -> str:
+        prompt = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=MEMORY_SUMMARY_WORDS)},
+            {"role": "user", "content": f"Summary so far:\n{previous or '(none)'}\n\nNew messages:\n{format_transcript(messages)}"}
+        ]
+        async with scheduler.slot(Priority.BATCH, flow=flow):
+            message = await zai_client.chat(prompt, model=model, include_reasoning=False)
+        summary = (message.content or "").strip()
+        if not summary:
+            raise ValueError("Summarizer returned no text")
+        return summary
+
+    return summarize
+
+
+class ChatMemory:
+    """
+    A chat session's conversation as sent to the model: the system prompt
+    (always first), a rolling summary of older turns, then recent turns
+    verbatim.
+
+    When the verbatim turns outgrow the policy's window, the oldest (never the
+    last `pinned_turns`) are evicted down to LOW_WATER of it and summarized in
+    the background. They stay in the prompt until their summary is ready and
+    are then replaced by it in one step, so nothing is missing in between and
+    the prompt only changes when a summary lands. However long the session
+    runs, a prompt carries about one window of turns plus the summary.
+
+    With `save_summary`, each summary is also handed over with the id of the
+    last stored message it covers, so a session reopened later (see
+    session_store) starts from the summary instead of the full history.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        policy: MemoryPolicy,
+        count_message: Callable[[Dict[str, Any]], int],
+        summarize: Optional[Summarizer] = None,
+        save_summary: Optional[SummarySaver] = None
+    ):
+        self.configure(system_prompt, policy, count_message, summarize)
+        self.save_summary = save_summary
+        self.summary = ""
+        # Evicted, still in the prompt until a summary covers them
+        self.evicted: List[MemoryTurn] = []
+        self.turns: List[MemoryTurn] = []
+        self._task: Optional[asyncio.Task] = None
+        # Metrics
+        self.summaries = 0
+        self.summary_failures = 0
+        self.dropped_turns = 0
+
+    def configure(
+        self,
+        system_prompt: str,
+        policy: MemoryPolicy,
+        count_message: Callable[[Dict[str, Any]], int],
+        summarize: Optional[Summarizer] = None
+    ):
+        """Apply the agent's current settings, e.g. when a kept session is reopened after the agent changed."""
+        self.system = {"role": "system", "content": system_prompt}
+        self.policy = policy
+        self.count_message = count_message
+        self.summarize = summarize if policy.summary_model else None
+
+    def messages(self) -> List[Dict[str, Any]]:
+        """The prompt so far as a new list, for the next turn to be appended to."""
+        prompt = [self.system]
+        if self.summary:
+            prompt.append({"role": "system", "content": SUMMARY_HEADER + self.summary})
+        for turn in self.evicted + self.turns:
+            prompt.extend(turn.messages)
+        return prompt
+
+    def sent_chunks(self) -> Set[Tuple[str, int]]:
+        """Knowledge chunks carried by turns still in the prompt (retrieve them again once they leave)."""
+        return {chunk_id for turn in self.evicted + self.turns for chunk_id in turn.chunk_ids}
+
+    def add_turn(
+        self,
+        messages: List[Dict[str, Any]],
+        chunk_ids: Collection[Tuple[str, int]] = (),
+        last_message_id: Optional[int] = None
+    ):
+        """Record a completed turn's messages and evict what no longer fits the window."""
+        self._append(messages, chunk_ids, last_message_id)
+        self._evict()
+        if self.evicted:
+            self._start_summary()
+
+    def restore(self, summary: str, turns: Sequence[Tuple[List[Dict[str, Any]], Optional[int]]]):
+        """Start from a stored session: its summary, then its latest turns (messages, last message id), oldest first."""
+        self.summary = summary
+        for messages, last_message_id in turns:
+            self._append(messages, (), last_message_id)
+        self._evict()
+        if self.evicted:
+            self._start_summary()
+
+    def _append(self, messages: List[Dict[str, Any]], chunk_ids: Collection[Tuple[str, int]], last_message_id: Optional[int]):
+        tokens = sum(self.count_message(message) for message in messages)
+        self.turns.append(MemoryTurn(list(messages), tokens, list(chunk_ids), last_message_id))
+
+    def _evict(self):
+        window = self.policy.window_tokens
+        total = sum(turn.tokens for turn in self.turns)
+        if window <= 0 or total <= window:
+            return
+        count = 0
+        while len(self.turns) - count > self.policy.pinned_turns and total > window * LOW_WATER:
+            total -= self.turns[count].tokens
+            count += 1
+        self.evicted.extend(self.turns[:count])
+        del self.turns[:count]
+        if self.summarize is None:
+            self._drop(len(self.evicted))
+            return
+        # If summaries keep failing, evicted turns can't pile up past another window
+        backlog = sum(turn.tokens for turn in self.evicted)
+        drop = 0
+        while drop < len(self.evicted) and backlog > window:
+            backlog -= self.evicted[drop].tokens
+            drop += 1
+        self._drop(drop)
+
+    def _drop(self, count: int):
+        if count:
+            del self.evicted[:count]
+            self.dropped_turns += count
+
+    def _start_summary(self):
+        if self.summarize is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._summarize())
+
+    async def _summarize(self):
+        while self.evicted:
+            batch = list(self.evicted)
+            try:
+                summary = await self.summarize(self.summary, [m for turn in batch for m in turn.messages])
+            except Exception as e:
+                # Left in the prompt; retried after the next turn
+                logger.warning(f"Summarizing chat memory failed: {e}")
+                self.summary_failures += 1
+                return
+            # More turns may have been evicted (or some dropped) while this ran
+            summarized = {id(turn) for turn in batch}
+            self.evicted = [turn for turn in self.evicted if id(turn) not in summarized]
+            self.summary = summary
+            self.summaries += 1
+            covered = [turn.last_message_id for turn in batch if turn.last_message_id is not None]
+            if self.save_summary is not None and covered:
+                try:
+                    await self.save_summary(summary, max(covered))
+                except Exception as e:
+                    # Still used in memory; a reload just starts from the previous one
+                    logger.warning(f"Saving chat memory summary failed: {e}")
+
+    async def settle(self):
+        """Until any summary in progress has landed."""
+        if self._task is not None:
+            await asyncio.wait({self._task})
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,10 @@
+import pytest
+
+from dependencies import agent_profiles
+
+
+@pytest.fixture(autouse=True)
+def fresh_agent_profiles():
+    # Tests build their own databases, so agent ids repeat with different rows
+    agent_profiles.invalidate()
+    yield
@@ -1,4 +1,5 @@
 import os
+from typing import Any, Callable, Dict
 from sqlmodel import create_engine, Session
 
 # Get DATABASE_URL from env, default to local docker container
@@ -8,8 +9,63 @@ DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/cha
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-engine = create_engine(DATABASE_URL)
+# Pool settings (pool sizes don't apply to SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT_S = float(os.getenv("DB_POOL_TIMEOUT_S", 30))
+# Recycle connections older than this, before the server or a proxy drops them
+DB_POOL_RECYCLE_S = int(os.getenv("DB_POOL_RECYCLE_S", 1800))
+# Test each connection on checkout so a restarted database doesn't fail requests
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Serve async handlers from an async engine (asyncpg / aiosqlite) instead of DB worker threads
+DATABASE_ASYNC = os.getenv("DATABASE_ASYNC", "false").lower() in ("1", "true", "yes")
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def pool_options(url: str) -> Dict[str, Any]:
+    options: Dict[str, Any] = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE_S}
+    if not url.startswith("sqlite"):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT_S)
+    return options
+
+
+def async_url(url: str) -> str:
+    """postgresql://... -> postgresql+asyncpg://..., sqlite:///... -> sqlite+aiosqlite:///..."""
+    scheme, rest = url.split("://", 1)
+    dialect = scheme.split("+", 1)[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {dialect}")
+    return f"{ASYNC_DRIVERS[dialect]}://{rest}"
+
+
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
+_async_engine = None
+
+
+def get_async_engine():
+    """The async engine when DATABASE_ASYNC is on (created on first use), else None."""
+    global _async_engine
+    if DATABASE_ASYNC and _async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        _async_engine = create_async_engine(async_url(DATABASE_URL), **pool_options(DATABASE_URL))
+    return _async_engine
+
+
+async def dispose_async_engine():
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+def new_session() -> Session:
+    return Session(engine)
+
+def get_session_factory() -> Callable[[], Session]:
+    # For long-lived handlers (WebSocket chat) that open a short session per
+    # operation instead of pinning one pooled connection for their lifetime
+    return new_session
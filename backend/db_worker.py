@@ -0,0 +1,80 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+# Threads reserved for blocking database calls from async code; keep this at or
+# below the engine's pool size so calls queue here rather than in the pool
+DB_WORKER_THREADS = int(os.getenv("DB_WORKER_THREADS", 4))
+
+T = TypeVar("T")
+
+
+def _call_in_session(session_factory: Callable[[], Any], fn: Callable[..., T], *args: Any) -> T:
+    with session_factory() as session:
+        return fn(session, *args)
+
+
+class DBWorker:
+    """
+    Runs blocking SQLAlchemy work (commits, queries) on dedicated threads so
+    the event loop keeps streaming to other sockets meanwhile.
+
+    A Session is not thread-safe, but it may move between threads: callers
+    await each call before touching the session again, so it is only ever
+    used by one thread at a time. run_in_session() instead opens a session
+    for just one call, so the connection goes back to the pool right after.
+    """
+
+    def __init__(self, threads: int = DB_WORKER_THREADS):
+        self.threads = threads
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="db")
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(fn, *args, **kwargs)
+            )
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self.in_flight -= 1
+            self.calls += 1
+            self.total_s += elapsed
+            self.max_s = max(self.max_s, elapsed)
+
+    async def run_in_session(self, session_factory: Callable[[], Any], fn: Callable[..., T], *args: Any) -> T:
+        """fn(session, *args) in a session that is opened and closed on the worker thread."""
+        return await self.run(_call_in_session, session_factory, fn, *args)
+
+    def shutdown(self):
+        """Wait for queued calls to finish; a later run() starts fresh threads."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "threads": self.threads,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "errors": self.errors,
+            "mean_ms": round(self.total_s / self.calls * 1000, 2) if self.calls else None,
+            "max_ms": round(self.max_s * 1000, 2),
+        }
@@ -1,13 +1,88 @@
 import os
+import asyncio
+from database import new_session
 from mcp_manager import MCPManager
 from zai_client import ZaiClient
+from token_budget import TokenEstimator
+from model_router import ModelRouter
+from llm_scheduler import LLMScheduler
+from adaptive_limiter import AIMDLimiter
+from db_worker import DBWorker
+from loop_monitor import LoopLagMonitor
+from write_behind import WriteBehindBuffer
+from script_index import ScriptIndex
+from agent_runtime import AgentProfileCache
+from knowledge_ingest import KnowledgeIngestor
+from session_store import ChatSessionStore
 
 # Singleton instances
 mcp_manager = MCPManager()
-zai_client = ZaiClient(api_key=os.getenv("ZAI_API_KEY"))
+zai_client = ZaiClient(
+    api_key=os.getenv("ZAI_API_KEY"),
+    # Optional comma-separated pool; takes precedence over ZAI_API_KEY
+    api_keys=[k.strip() for k in os.getenv("ZAI_API_KEYS", "").split(",") if k.strip()] or None,
+    base_url=os.getenv("ZAI_BASE_URL", "https://api.z.ai/api/coding/paas/v4"),
+    raw_streaming=os.getenv("ZAI_RAW_STREAMING", "false").lower() in ("1", "true", "yes")
+)
+token_estimator = TokenEstimator()
+model_router = ModelRouter()
+llm_scheduler = LLMScheduler()
+# Concurrent WebSocket chat turns; adapts to upstream latency and 429s
+chat_limiter = AIMDLimiter()
+# Concurrent MCP tool calls from chat turns, independent of the LLM limits
+tool_pool = asyncio.Semaphore(int(os.getenv("TOOL_MAX_CONCURRENCY", 16)))
+# Blocking DB calls from async handlers run here, off the event loop
+db_worker = DBWorker()
+loop_monitor = LoopLagMonitor()
+# Chat messages and token usage are written in batches by this buffer
+write_buffer = WriteBehindBuffer(new_session, db_worker)
+# Which MCP scripts exist on disk, for the server listing
+script_index = ScriptIndex()
+# Compiled per-agent chat setup (prompt, tools, settings); write endpoints invalidate it
+agent_profiles = AgentProfileCache()
+# Knowledge uploads are chunked and indexed in the background on a process pool
+knowledge_ingestor = KnowledgeIngestor(db_worker)
+# Conversation memory of recently used chat sessions, so clients can resume them
+chat_sessions = ChatSessionStore()
 
 def get_mcp_manager() -> MCPManager:
     return mcp_manager
 
 def get_zai_client() -> ZaiClient:
-    return zai_client
\ No newline at end of file
+    return zai_client
+
+def get_token_estimator() -> TokenEstimator:
+    return token_estimator
+
+def get_model_router() -> ModelRouter:
+    return model_router
+
+def get_llm_scheduler() -> LLMScheduler:
+    return llm_scheduler
+
+def get_chat_limiter() -> AIMDLimiter:
+    return chat_limiter
+
+def get_tool_pool() -> asyncio.Semaphore:
+    return tool_pool
+
+def get_db_worker() -> DBWorker:
+    return db_worker
+
+def get_loop_monitor() -> LoopLagMonitor:
+    return loop_monitor
+
+def get_write_buffer() -> WriteBehindBuffer:
+    return write_buffer
+
+def get_script_index() -> ScriptIndex:
+    return script_index
+
+def get_agent_profiles() -> AgentProfileCache:
+    return agent_profiles
+
+def get_knowledge_ingestor() -> KnowledgeIngestor:
+    return knowledge_ingestor
+
+def get_chat_sessions() -> ChatSessionStore:
+    return chat_sessions
@@ -0,0 +1,305 @@
+"""
+Local OpenAI-compatible stand-in for the Z.ai coding endpoint.
+
+Point ZaiClient at it with ZAI_BASE_URL=http://127.0.0.1:9100 (or mount `app`
+on an httpx.ASGITransport in tests) to exercise the chat routers and run load
+tests without network access. Behaviour (time-to-first-token, tokens/sec,
+reasoning deltas, scripted tool calls, usage blocks, injected 429s) is read
+from FAKE_ZAI_* env vars at startup and can be changed at runtime through
+PUT /_fake/config.
+
+    python fake_zai_server.py            # listens on FAKE_ZAI_PORT (9100)
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+
+# How many recent prompts the simulated prefix cache remembers
+PREFIX_CACHE_ENTRIES = 64
+
+
+class ScriptedToolCall(BaseModel):
+    name: str
+    arguments: Dict[str, Any] = Field(default_factory=dict)
+
+
+class FakeZaiConfig(BaseModel):
+    ttft_ms: float = 200.0
+    tokens_per_sec: float = 50.0  # 0 disables pacing
+    response_tokens: int = 40
+    reasoning_tokens: int = 0
+    # Emitted on the first model turn of a request that carries tools; once the
+    # conversation contains tool results the server answers with plain text.
+    tool_calls: List[ScriptedToolCall] = Field(default_factory=list)
+    include_usage: bool = True
+    rate_limit_every: int = 0  # every Nth request gets a 429 (0 = never)
+    rate_limit_probability: float = 0.0
+    rate_limit_models: List[str] = Field(default_factory=list)  # always 429 for these models
+    max_concurrent_per_key: int = 0  # 429 when one API key has more requests in flight (0 = unlimited)
+    retry_after_s: float = 1.0
+    # Report prompt_tokens_details.cached_tokens for the prefix shared with earlier prompts
+    prefix_cache: bool = True
+    # Precede each streamed event with an SSE comment and an empty "data:" line, as keep-alives from proxies do
+    keepalive_lines: bool = False
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "FakeZaiConfig":
+        overrides: Dict[str, Any] = {}
+        for name in cls.model_fields:
+            raw = os.getenv(f"FAKE_ZAI_{name.upper()}")
+            if raw is not None:
+                overrides[name] = json.loads(raw) if name in ("tool_calls", "rate_limit_models") else raw
+        return cls(**overrides)
+
+
+class FakeZaiStats(BaseModel):
+    requests: int = 0
+    streamed: int = 0
+    rate_limited: int = 0
+    completion_tokens: int = 0
+    requests_by_key: Dict[str, int] = Field(default_factory=dict)
+
+
+def prompt_payload(body: Dict[str, Any]) -> str:
+    # Tools first, as the upstream renders them ahead of the conversation
+    return json.dumps(body.get("tools") or []) + json.dumps(body.get("messages", []))
+
+
+def estimate_prompt_tokens(body: Dict[str, Any]) -> int:
+    """Rough prompt size so usage blocks scale with the request."""
+    return max(1, len(prompt_payload(body)) // 4)
+
+
+def common_prefix_len(a: str, b: str) -> int:
+    # Binary search on slice equality keeps the comparisons in C
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def create_app(config: Optional[FakeZaiConfig] = None) -> FastAPI:
+    fake = FastAPI(title="Fake Z.ai Upstream")
+    fake.state.config = config or FakeZaiConfig.from_env()
+    fake.state.stats = FakeZaiStats()
+    fake.state.rng = random.Random(fake.state.config.seed)
+    fake.state.recent_prompts = deque(maxlen=PREFIX_CACHE_ENTRIES)
+    fake.state.in_flight = {}  # API key -> open requests
+
+    def should_rate_limit(model: str) -> bool:
+        cfg: FakeZaiConfig = fake.state.config
+        count = fake.state.stats.requests
+        if model in cfg.rate_limit_models:
+            return True
+        if cfg.rate_limit_every and count % cfg.rate_limit_every == 0:
+            return True
+        return cfg.rate_limit_probability > 0 and fake.state.rng.random() < cfg.rate_limit_probability
+
+    def wants_tool_calls(body: Dict[str, Any]) -> bool:
+        messages = body.get("messages") or []
+        if not fake.state.config.tool_calls or not body.get("tools"):
+            return False
+        return not any(m.get("role") == "tool" for m in messages if isinstance(m, dict))
+
+    def tool_call_payloads() -> List[Dict[str, Any]]:
+        return [
+            {
+                "index": i,
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {"name": tc.name, "arguments": json.dumps(tc.arguments)},
+            }
+            for i, tc in enumerate(fake.state.config.tool_calls)
+        ]
+
+    def cached_tokens(body: Dict[str, Any]) -> int:
+        payload = prompt_payload(body)
+        recent = fake.state.recent_prompts
+        shared = max((common_prefix_len(payload, p) for p in recent), default=0)
+        recent.append(payload)
+        return shared // 4
+
+    def usage_block(body: Dict[str, Any], completion_tokens: int, cached: int) -> Dict[str, Any]:
+        prompt_tokens = estimate_prompt_tokens(body)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        if fake.state.config.prefix_cache:
+            usage["prompt_tokens_details"] = {"cached_tokens": min(cached, prompt_tokens)}
+        return usage
+
+    async def pace(cfg: FakeZaiConfig):
+        if cfg.tokens_per_sec > 0:
+            await asyncio.sleep(1.0 / cfg.tokens_per_sec)
+
+    @fake.get("/_fake/config")
+    def get_config():
+        return fake.state.config
+
+    @fake.put("/_fake/config")
+    def put_config(new_config: FakeZaiConfig):
+        fake.state.config = new_config
+        fake.state.rng = random.Random(new_config.seed)
+        return new_config
+
+    @fake.get("/_fake/stats")
+    def get_stats():
+        return fake.state.stats
+
+    @fake.post("/_fake/reset")
+    def reset_stats():
+        fake.state.stats = FakeZaiStats()
+        fake.state.recent_prompts.clear()
+        fake.state.in_flight.clear()
+        return fake.state.stats
+
+    @fake.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        cfg: FakeZaiConfig = fake.state.config
+        stats: FakeZaiStats = fake.state.stats
+        stats.requests += 1
+        api_key = request.headers.get("authorization", "").removeprefix("Bearer ")
+        stats.requests_by_key[api_key] = stats.requests_by_key.get(api_key, 0) + 1
+        in_flight = fake.state.in_flight
+
+        model = body.get("model", "glm-4.5-flash")
+        over_key_limit = cfg.max_concurrent_per_key and in_flight.get(api_key, 0) >= cfg.max_concurrent_per_key
+        if over_key_limit or should_rate_limit(model):
+            stats.rate_limited += 1
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after": str(cfg.retry_after_s)},
+                content={"error": {"code": "1302", "message": "Rate limit reached for requests", "type": "rate_limit_error"}},
+            )
+
+        in_flight[api_key] = in_flight.get(api_key, 0) + 1
+
+        def finish():
+            in_flight[api_key] -= 1
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:16]}"
+        created = int(time.time())
+        cached = cached_tokens(body) if cfg.prefix_cache else 0
+
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep(cfg.ttft_ms / 1000.0)
+                message: Dict[str, Any] = {"role": "assistant", "content": None}
+                if wants_tool_calls(body):
+                    message["tool_calls"] = tool_call_payloads()
+                    completion_tokens = len(message["tool_calls"]) * 8
+                    finish_reason = "tool_calls"
+                else:
+                    message["content"] = "".join(f"token{i} " for i in range(cfg.response_tokens))
+                    if cfg.reasoning_tokens:
+                        message["reasoning_content"] = "".join(f"think{i} " for i in range(cfg.reasoning_tokens))
+                    completion_tokens = cfg.response_tokens + cfg.reasoning_tokens
+                    finish_reason = "stop"
+                if cfg.tokens_per_sec > 0:
+                    await asyncio.sleep(completion_tokens / cfg.tokens_per_sec)
+            finally:
+                finish()
+            stats.completion_tokens += completion_tokens
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage_block(body, completion_tokens, cached),
+            }
+
+        stats.streamed += 1
+        include_usage = cfg.include_usage and bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def frame(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def event_stream():
+            try:
+                async for event in stream_events():
+                    if cfg.keepalive_lines:
+                        yield ": keep-alive\n\ndata:\n\n"
+                    yield event
+            finally:
+                finish()
+
+        async def stream_events():
+            await asyncio.sleep(cfg.ttft_ms / 1000.0)
+            completion_tokens = 0
+            yield frame({"role": "assistant", "content": ""})
+
+            for i in range(cfg.reasoning_tokens):
+                yield frame({"reasoning_content": f"think{i} "})
+                completion_tokens += 1
+                await pace(cfg)
+
+            if wants_tool_calls(body):
+                for call in tool_call_payloads():
+                    # Split like the real upstream: header first, then argument fragments.
+                    args = call["function"]["arguments"]
+                    yield frame({"tool_calls": [{**call, "function": {"name": call["function"]["name"], "arguments": ""}}]})
+                    half = len(args) // 2
+                    for fragment in (args[:half], args[half:]):
+                        yield frame({"tool_calls": [{"index": call["index"], "function": {"arguments": fragment}}]})
+                    completion_tokens += 8
+                    await pace(cfg)
+                finish_reason = "tool_calls"
+            else:
+                for i in range(cfg.response_tokens):
+                    yield frame({"content": f"token{i} "})
+                    completion_tokens += 1
+                    await pace(cfg)
+                finish_reason = "stop"
+
+            yield frame({}, finish_reason=finish_reason)
+            stats.completion_tokens += completion_tokens
+            if include_usage:
+                usage_chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": usage_block(body, completion_tokens, cached),
+                }
+                yield f"data: {json.dumps(usage_chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    return fake
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.getenv("FAKE_ZAI_PORT", 9100))
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
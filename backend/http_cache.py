@@ -0,0 +1,42 @@
+import hashlib
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+# Largest page the ?limit= of the list endpoints accepts
+LIST_PAGE_MAX = int(os.getenv("LIST_PAGE_MAX", 500))
+
+
+def next_page(items: List[Dict[str, Any]], limit: Optional[int]) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """
+    Trim a keyset page fetched with limit + 1 rows. Returns the page and the
+    headers to send: X-Next-Cursor holds the `after` for the next page, if any.
+    """
+    headers = {"Cache-Control": "no-cache"}
+    if limit is not None and len(items) > limit:
+        items = items[:limit]
+        headers["X-Next-Cursor"] = str(items[-1]["id"])
+    return items, headers
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def conditional_json(request: Request, content: Any, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    JSON response with a strong ETag over its body, or 304 with no body when
+    the request's If-None-Match already names that ETag.
+    """
+    headers = dict(headers or {})
+    response = JSONResponse(content, headers=headers)
+    etag = f'"{hashlib.sha256(response.body).hexdigest()[:32]}"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    response.headers["ETag"] = etag
+    return response
@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import httpx
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# How long a key is sidelined after a 429 when the upstream sends no Retry-After;
+# doubles on consecutive 429s up to KEY_COOLDOWN_MAX_S
+KEY_COOLDOWN_S = float(os.getenv("ZAI_KEY_COOLDOWN_S", 5))
+KEY_COOLDOWN_MAX_S = float(os.getenv("ZAI_KEY_COOLDOWN_MAX_S", 120))
+
+
+def key_id(api_key: str) -> str:
+    """Stable, non-secret identifier for a key (used in URLs and stats)."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def mask_key(api_key: str) -> str:
+    return f"{api_key[:4]}...{api_key[-4:]}"
+
+
+def _header_int(headers: httpx.Headers, name: str) -> Optional[int]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+class KeyState:
+    """One API key with its SDK client (on the key's own HTTP connection pool), load and health counters."""
+
+    def __init__(self, api_key: str, client: AsyncOpenAI, http_client: Optional[httpx.AsyncClient] = None):
+        self.api_key = api_key
+        self.id = key_id(api_key)
+        self.client = client
+        self.http_client = http_client
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cooldown_until = 0.0
+        self.consecutive_429s = 0
+        # Last values of the upstream's x-ratelimit-remaining-* headers, if it sends them
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+
+    def cooling_down(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "masked_key": mask_key(self.api_key),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cooldown_remaining_s": round(max(0.0, self.cooldown_until - now), 2),
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+        }
+
+
+class KeyPool:
+    """
+    Spreads upstream requests over several API keys.
+
+    acquire() picks the least-loaded key that is not cooling down (fewest
+    in-flight requests, then most remaining quota, then fewest requests so far).
+    A 429 sidelines the key for its Retry-After (or an exponential default).
+    When every key is cooling down the one that recovers first is used.
+    Keys dropped by set_keys() have their HTTP client closed once their
+    in-flight requests are released.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        http_client_factory: Callable[[], httpx.AsyncClient],
+        api_keys: Optional[List[str]] = None
+    ):
+        self.base_url = base_url
+        # Each key gets its own HTTP client, so connection limits apply per key
+        self.http_client_factory = http_client_factory
+        self.keys: List[KeyState] = []
+        # Removed keys whose HTTP client is not closed yet (still in use, or no loop to close on)
+        self.retired: List[KeyState] = []
+        self._closing: Set[asyncio.Task] = set()
+        self.set_keys(api_keys or [])
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def set_keys(self, api_keys: List[str]):
+        """Replace the key set, keeping counters for keys that stay."""
+        existing = {k.api_key: k for k in self.keys}
+        keys = []
+        for api_key in dict.fromkeys(k for k in api_keys if k):
+            state = existing.get(api_key)
+            if state is None:
+                http_client = self.http_client_factory()
+                client = AsyncOpenAI(api_key=api_key, base_url=self.base_url, http_client=http_client)
+                state = KeyState(api_key, client, http_client)
+            keys.append(state)
+        kept = {k.api_key for k in keys}
+        self.retired.extend(state for api_key, state in existing.items() if api_key not in kept)
+        self.keys = keys
+        self._close_retired()
+
+    def _close_retired(self):
+        """Close the HTTP clients of removed keys that have no request in flight."""
+        if not self.retired:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Called off the event loop (e.g. a sync settings route): the next acquire/release closes them
+            return
+        idle = [k for k in self.retired if k.in_flight == 0]
+        self.retired = [k for k in self.retired if k.in_flight > 0]
+        for key in idle:
+            if key.http_client is not None:
+                task = loop.create_task(key.http_client.aclose())
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+
+    def acquire(self) -> KeyState:
+        if not self.keys:
+            raise RuntimeError("No Z.ai API key configured")
+        now = time.monotonic()
+        healthy = [k for k in self.keys if not k.cooling_down(now)]
+        if healthy:
+            key = min(healthy, key=lambda k: (
+                k.in_flight,
+                -(k.remaining_requests if k.remaining_requests is not None else float("inf")),
+                k.requests
+            ))
+        else:
+            key = min(self.keys, key=lambda k: k.cooldown_until)
+        key.in_flight += 1
+        key.requests += 1
+        self._close_retired()
+        return key
+
+    def release(self, key: KeyState):
+        key.in_flight = max(0, key.in_flight - 1)
+        self._close_retired()
+
+    def has_healthy_key(self, exclude: Optional[KeyState] = None) -> bool:
+        now = time.monotonic()
+        return any(k is not exclude and not k.cooling_down(now) for k in self.keys)
+
+    def find(self, api_key: str) -> Optional[KeyState]:
+        for key in self.keys:
+            if key.api_key == api_key:
+                return key
+        return None
+
+    def record_success(self, key: KeyState):
+        key.consecutive_429s = 0
+
+    def record_usage(self, key: KeyState, usage: Optional[Dict[str, Any]]):
+        if usage:
+            key.prompt_tokens += usage.get("prompt_tokens") or 0
+            key.completion_tokens += usage.get("completion_tokens") or 0
+
+    def record_rate_limit(self, key: KeyState, response: Optional[httpx.Response] = None):
+        key.rate_limited += 1
+        key.consecutive_429s += 1
+        cooldown = min(KEY_COOLDOWN_MAX_S, KEY_COOLDOWN_S * 2 ** (key.consecutive_429s - 1))
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    cooldown = min(KEY_COOLDOWN_MAX_S, float(retry_after))
+                except ValueError:
+                    pass
+        key.cooldown_until = time.monotonic() + cooldown
+        logger.warning(f"Z.ai key {mask_key(key.api_key)} rate limited, sidelined for {cooldown:.1f}s")
+
+    def record_error(self, key: KeyState):
+        key.errors += 1
+
+    def observe_headers(self, key: KeyState, headers: httpx.Headers):
+        """Remember the upstream's remaining-quota headers for `key`, if present."""
+        remaining_requests = _header_int(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            key.remaining_requests = remaining_requests
+        if remaining_tokens is not None:
+            key.remaining_tokens = remaining_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        keys = [k.snapshot(now) for k in self.keys]
+        return {
+            "keys": keys,
+            "healthy": sum(1 for k in self.keys if not k.cooling_down(now)),
+            "requests": sum(k["requests"] for k in keys),
+            "rate_limited": sum(k["rate_limited"] for k in keys),
+            "prompt_tokens": sum(k["prompt_tokens"] for k in keys),
+            "completion_tokens": sum(k["completion_tokens"] for k in keys),
+        }
@@ -0,0 +1,292 @@
+import hashlib
+import heapq
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Callable, Collection, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple
+
+from models import AgentKnowledgeFile, KnowledgeBlobChunk
+
+# How knowledge reaches the model when an agent doesn't choose: "retrieval" sends
+# the chunks most relevant to each user message, "full" puts every file in the
+# system prompt
+KNOWLEDGE_MODE = os.getenv("KNOWLEDGE_MODE", "retrieval")
+# Upper bound on a chunk's length, cut at paragraph, line or word boundaries
+KNOWLEDGE_CHUNK_CHARS = int(os.getenv("KNOWLEDGE_CHUNK_CHARS", 1500))
+# Retrieval mode: at most this many chunks, and this many estimated tokens, per user message
+KNOWLEDGE_TOP_K = int(os.getenv("KNOWLEDGE_TOP_K", 4))
+KNOWLEDGE_BUDGET_TOKENS = int(os.getenv("KNOWLEDGE_BUDGET_TOKENS", 1500))
+
+# CJK text has no spaces between words, so each character is its own term
+_CJK = "\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TERM = re.compile(rf"[{_CJK}]|[^\W_{_CJK}]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased index terms: runs of letters and digits, single CJK characters."""
+    return _TERM.findall(text.lower())
+
+
+# Control characters other than tab and newline (e.g. NULs from binary-ish exports)
+_CONTROL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+
+
+def normalize_text(text: str) -> str:
+    """NFC, \n line endings, no control characters or trailing spaces, at most one blank line in a row."""
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    text = _CONTROL.sub("", text)
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def _pieces(text: str, max_chars: int):
+    """Paragraphs, with any longer than max_chars split at a line break, else a space, else anywhere."""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind("\n", 0, max_chars)
+            if cut <= 0:
+                cut = paragraph.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            yield paragraph[:cut].rstrip()
+            paragraph = paragraph[cut:].lstrip()
+        if paragraph:
+            yield paragraph
+
+
+def chunk_text(text: str, max_chars: int = KNOWLEDGE_CHUNK_CHARS) -> List[str]:
+    """Split a document into chunks of at most max_chars, packing whole paragraphs where they fit."""
+    chunks = []
+    current = ""
+    for piece in _pieces(text, max_chars):
+        if current and len(current) + 2 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class IngestedDocument(NamedTuple):
+    """An uploaded file after ingest_document: normalized text, its distinct chunks and their index terms (if asked for)."""
+
+    content: str
+    sha256: str
+    chunks: List[str]
+    chunk_terms: List[Dict[str, int]]
+    duplicate_chunks: int
+
+
+def ingest_document(path: str, max_chars: int = KNOWLEDGE_CHUNK_CHARS, with_terms: bool = True) -> IngestedDocument:
+    """
+    Read, normalize, chunk and (with_terms) tokenize an uploaded file.
+    CPU-bound and free of I/O beyond reading `path`, so it runs in the
+    ingestion process pool. Raises ValueError for files that aren't UTF-8 text.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("File must be valid UTF-8 text")
+    del raw
+    return ingest_text(text, max_chars, with_terms)
+
+
+def ingest_text(text: str, max_chars: int = KNOWLEDGE_CHUNK_CHARS, with_terms: bool = True) -> IngestedDocument:
+    """ingest_document for text already in memory."""
+    content = normalize_text(text)
+    pieces = chunk_text(content, max_chars)
+    chunks: List[str] = []
+    seen = set()
+    for chunk in pieces:
+        # Repeated boilerplate (headers, footers, disclaimers) is indexed once
+        key = hashlib.sha1(" ".join(chunk.split()).lower().encode()).digest()
+        if key not in seen:
+            seen.add(key)
+            chunks.append(chunk)
+    return IngestedDocument(
+        content=content,
+        sha256=hashlib.sha256(content.encode()).hexdigest(),
+        chunks=chunks,
+        chunk_terms=[dict(Counter(tokenize(chunk))) for chunk in chunks] if with_terms else [],
+        duplicate_chunks=len(pieces) - len(chunks)
+    )
+
+
+# (blob hash, ordinal): names a chunk across index rebuilds, unlike its index
+ChunkKey = Tuple[str, int]
+
+
+class KnowledgeChunk(NamedTuple):
+    filename: str
+    ordinal: int
+    content: str
+    file_id: Optional[int] = None
+    blob_sha256: Optional[str] = None
+
+    @property
+    def key(self) -> ChunkKey:
+        # Chunks indexed without a blob (e.g. in tests) are named by their file instead
+        return (self.blob_sha256 or self.filename, self.ordinal)
+
+
+class BM25Index:
+    """
+    In-memory inverted index over knowledge chunks, ranked with Okapi BM25.
+    Files are added and removed incrementally (statistics are kept as running
+    totals, so nothing is rebuilt); chunk indices stay stable across removals.
+    All access happens on the event loop, so it can be shared between
+    connections.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, chunks: Iterable[KnowledgeChunk] = ()):
+        # Removed chunks leave None behind so indices held by callers stay valid
+        self.chunks: List[Optional[KnowledgeChunk]] = []
+        # term -> {chunk index: term frequency}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._lengths: List[int] = []
+        self._total_length = 0
+        self._live = 0
+        self._by_file: Dict[Optional[int], List[int]] = {}
+        # Files sharing a blob share its chunk keys
+        self._by_key: Dict[ChunkKey, List[int]] = {}
+        for chunk in chunks:
+            self.add(chunk)
+
+    def __len__(self) -> int:
+        return self._live
+
+    @staticmethod
+    def _terms(chunk: KnowledgeChunk) -> Dict[str, int]:
+        # The filename counts as part of the chunk ("pricing" finds pricing.md)
+        return Counter(tokenize(chunk.filename)) + Counter(tokenize(chunk.content))
+
+    def add(self, chunk: KnowledgeChunk, content_terms: Optional[Dict[str, int]] = None) -> int:
+        """
+        Index a chunk and return its index. `content_terms` are the term
+        counts of its content if already computed (see ingest_document).
+        """
+        if content_terms is None:
+            terms = self._terms(chunk)
+        else:
+            terms = Counter(tokenize(chunk.filename))
+            terms.update(content_terms)
+        i = len(self.chunks)
+        self.chunks.append(chunk)
+        length = sum(terms.values())
+        self._lengths.append(length)
+        self._total_length += length
+        self._live += 1
+        self._by_file.setdefault(chunk.file_id, []).append(i)
+        self._by_key.setdefault(chunk.key, []).append(i)
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[i] = frequency
+        return i
+
+    def remove_file(self, file_id: int) -> int:
+        """Unindex every chunk of a file; returns how many were removed."""
+        removed = self._by_file.pop(file_id, [])
+        for i in removed:
+            chunk = self.chunks[i]
+            for term in self._terms(chunk):
+                postings = self._postings[term]
+                del postings[i]
+                if not postings:
+                    del self._postings[term]
+            same_key = self._by_key[chunk.key]
+            same_key.remove(i)
+            if not same_key:
+                del self._by_key[chunk.key]
+            self.chunks[i] = None
+            self._total_length -= self._lengths[i]
+            self._live -= 1
+        return len(removed)
+
+    def indices(self, keys: Iterable[ChunkKey]) -> Set[int]:
+        """Indices of the indexed chunks with these keys."""
+        return {i for key in keys for i in self._by_key.get(key, ())}
+
+    def search(self, query: str, k: int) -> List[Tuple[float, int]]:
+        """(score, chunk index) of the k best matches for query, best first; chunks sharing no term are left out."""
+        if not self._live:
+            return []
+        average_length = self._total_length / self._live or 1
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (self._live - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, frequency in postings.items():
+                norm = self.K1 * (1 - self.B + self.B * self._lengths[i] / average_length)
+                scores[i] = scores.get(i, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+        # Ties go to the earlier chunk
+        return heapq.nlargest(k, ((score, i) for i, score in scores.items()), key=lambda hit: (hit[0], -hit[1]))
+
+    def retrieve(
+        self,
+        query: str,
+        count_tokens: Callable[[str], int],
+        top_k: int = KNOWLEDGE_TOP_K,
+        budget_tokens: int = KNOWLEDGE_BUDGET_TOKENS,
+        exclude: Collection[int] = ()
+    ) -> List[int]:
+        """
+        Indices of the best chunks for query, best first: at most top_k, not
+        in exclude (e.g. already sent earlier in the conversation), and
+        totalling at most budget_tokens by count_tokens.
+        """
+        selected: List[int] = []
+        used = 0
+        for _, i in self.search(query, top_k + len(exclude)):
+            if i in exclude:
+                continue
+            tokens = count_tokens(self.chunks[i].content)
+            if used + tokens > budget_tokens:
+                # A smaller, lower-ranked chunk may still fit
+                continue
+            selected.append(i)
+            used += tokens
+            if len(selected) == top_k:
+                break
+        return selected
+
+
+def build_knowledge_index(
+    knowledge_files: Sequence[AgentKnowledgeFile],
+    chunks: Sequence[KnowledgeBlobChunk],
+    contents: Mapping[str, str] = {}
+) -> BM25Index:
+    """
+    Index an agent's files from their blobs' stored chunks. Blobs stored
+    before chunking existed have no chunk rows; their text (from `contents`,
+    keyed by hash) is chunked here instead.
+    """
+    by_blob: Dict[str, List[KnowledgeBlobChunk]] = {}
+    for row in chunks:
+        by_blob.setdefault(row.blob_sha256, []).append(row)
+
+    index = BM25Index()
+    for k_file in sorted(knowledge_files, key=lambda k: (k.filename, k.id or 0)):
+        rows = sorted(by_blob.get(k_file.blob_sha256, []), key=lambda row: row.ordinal)
+        pieces = [row.content for row in rows] if rows else chunk_text(contents.get(k_file.blob_sha256, ""))
+        for ordinal, piece in enumerate(pieces):
+            index.add(KnowledgeChunk(k_file.filename, ordinal, piece, k_file.id, k_file.blob_sha256))
+    return index
+
+
+def format_knowledge(chunks: Sequence[KnowledgeChunk]) -> str:
+    context = "--- Relevant Knowledge ---\n"
+    for chunk in chunks:
+        context += f"File: {chunk.filename} (part {chunk.ordinal + 1})\nContent:\n{chunk.content}\n\n"
+    context += "----------------------------\n"
+    return context
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import UploadFile
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from agent_runtime import AgentProfileCache, add_knowledge_file
+from db_worker import DBWorker
+from knowledge_index import KNOWLEDGE_CHUNK_CHARS, IngestedDocument, ingest_document
+from knowledge_store import acquire_blob
+from models import AgentKnowledgeFile
+
+logger = logging.getLogger(__name__)
+
+# Processes that chunk and tokenize uploads; 0 runs ingestion on a thread instead
+KNOWLEDGE_INGEST_WORKERS = int(os.getenv("KNOWLEDGE_INGEST_WORKERS", min(4, os.cpu_count() or 1)))
+# Uploads are streamed here and deleted once ingested
+KNOWLEDGE_SPOOL_DIR = os.getenv("KNOWLEDGE_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "knowledge-spool"))
+KNOWLEDGE_MAX_UPLOAD_MB = int(os.getenv("KNOWLEDGE_MAX_UPLOAD_MB", 200))
+
+SPOOL_READ_BYTES = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def mark_processing(session: Session, file_id: int) -> Optional[int]:
+    """Set the file's status to processing and return its agent id; None if the row is gone."""
+    knowledge = session.get(AgentKnowledgeFile, file_id)
+    if knowledge is None:
+        return None
+    knowledge.status = "processing"
+    session.add(knowledge)
+    session.commit()
+    return knowledge.agent_id
+
+
+def store_ingested(session: Session, file_id: int, document: IngestedDocument) -> Optional[str]:
+    """
+    Point the file at the blob for its text (storing the blob and chunks unless
+    another file already has them), mark it ready and return its filename;
+    None if it was deleted meanwhile.
+    """
+    try:
+        knowledge = session.get(AgentKnowledgeFile, file_id)
+        if knowledge is None:
+            return None
+        acquire_blob(session, document.sha256, document.content, document.chunks)
+    except IntegrityError:
+        # The same text was stored by a concurrent upload; reference that blob instead
+        session.rollback()
+        knowledge = session.get(AgentKnowledgeFile, file_id)
+        if knowledge is None:
+            return None
+        acquire_blob(session, document.sha256, document.content, document.chunks)
+    filename = knowledge.filename
+    knowledge.blob_sha256 = document.sha256
+    knowledge.chunk_count = len(document.chunks)
+    knowledge.status = "ready"
+    knowledge.error = None
+    session.add(knowledge)
+    session.commit()
+    return filename
+
+
+def mark_failed(session: Session, file_id: int, error: str):
+    knowledge = session.get(AgentKnowledgeFile, file_id)
+    if knowledge is not None:
+        knowledge.status = "failed"
+        knowledge.error = error
+        session.add(knowledge)
+        session.commit()
+
+
+class KnowledgeIngestor:
+    """
+    Background ingestion of knowledge uploads. The upload handler spools the
+    file to disk and inserts a "pending" row; the job then normalizes, chunks,
+    dedupes and tokenizes it on a process pool (off the event loop and the
+    GIL), stores it as a blob (see knowledge_store) through the DB worker
+    threads and adds its chunks to the agent's cached index. Progress is tracked in the row's status.
+
+    Jobs live in this process: files still pending when it stops stay pending
+    and have to be uploaded again.
+    """
+
+    def __init__(self, db: DBWorker, workers: int = KNOWLEDGE_INGEST_WORKERS, spool_dir: str = KNOWLEDGE_SPOOL_DIR):
+        self.db = db
+        self.workers = workers
+        self.spool_dir = spool_dir
+        self.max_bytes = KNOWLEDGE_MAX_UPLOAD_MB * 1024 * 1024
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._jobs: Dict[int, asyncio.Task] = {}
+        # Metrics
+        self.completed = 0
+        self.failed = 0
+        self.bytes_ingested = 0
+        self.chunks_stored = 0
+
+    async def spool(self, upload: UploadFile) -> str:
+        """Stream an upload into a file under spool_dir and return its path. Raises UploadTooLarge."""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.spool_dir, suffix=".upload")
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while chunk := await upload.read(SPOOL_READ_BYTES):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadTooLarge(f"File too large (max {KNOWLEDGE_MAX_UPLOAD_MB}MB)")
+                    out.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    def _pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers <= 0:
+            return None
+        if self._executor is None:
+            # spawn: forking would copy the event loop, DB connections and worker threads
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def submit(
+        self,
+        file_id: int,
+        path: str,
+        session_factory: Callable[[], Session],
+        profiles: AgentProfileCache
+    ) -> asyncio.Task:
+        """Start ingesting a spooled upload into the (pending) knowledge file row `file_id`."""
+        task = asyncio.get_running_loop().create_task(self._ingest(file_id, path, session_factory, profiles))
+        self._jobs[file_id] = task
+        task.add_done_callback(lambda _: self._jobs.pop(file_id, None))
+        return task
+
+    async def _ingest(self, file_id: int, path: str, session_factory: Callable[[], Session], profiles: AgentProfileCache):
+        try:
+            agent_id = await self.db.run_in_session(session_factory, mark_processing, file_id)
+            if agent_id is None:
+                return
+            size = os.path.getsize(path)
+            # Term counts only save work if there is a cached index to add them to; otherwise
+            # shipping them back costs more than the next profile build tokenizing the chunks
+            document = await asyncio.get_running_loop().run_in_executor(
+                self._pool(), ingest_document, path, KNOWLEDGE_CHUNK_CHARS, profiles.cached(agent_id)
+            )
+            filename = await self.db.run_in_session(session_factory, store_ingested, file_id, document)
+            if filename is None:
+                return  # deleted while it was being ingested
+            profiles.update(agent_id, lambda profile: add_knowledge_file(profile, file_id, filename, document))
+            self.completed += 1
+            self.bytes_ingested += size
+            self.chunks_stored += len(document.chunks)
+        except Exception as e:
+            logger.warning(f"Ingesting knowledge file {file_id} failed: {e}")
+            self.failed += 1
+            error = str(e) if isinstance(e, ValueError) else f"Ingestion failed: {e}"
+            try:
+                await self.db.run_in_session(session_factory, mark_failed, file_id, error)
+            except Exception as store_error:
+                logger.error(f"Could not mark knowledge file {file_id} failed: {store_error}")
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def wait(self, file_id: int):
+        """Until the job for file_id (if any) has finished."""
+        task = self._jobs.get(file_id)
+        if task is not None:
+            await asyncio.wait({task})
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "in_flight": len(self._jobs),
+            "completed": self.completed,
+            "failed": self.failed,
+            "mb_ingested": round(self.bytes_ingested / 1024 / 1024, 2),
+            "chunks_stored": self.chunks_stored,
+        }
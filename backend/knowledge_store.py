@@ -0,0 +1,78 @@
+"""
+Content-addressed storage for knowledge text.
+
+A knowledge file row is metadata only; its normalized text lives in a
+KnowledgeBlob keyed by SHA-256, with the blob's chunks alongside, so the same
+handbook attached to ten agents is stored and chunked once. Blobs are
+reference counted by the files pointing at them and deleted with their last
+file. None of these functions commit: the caller commits the reference
+change together with the file row it belongs to.
+"""
+from typing import Collection, Dict, Sequence
+
+from sqlmodel import Session, delete, insert, select, update
+
+from knowledge_index import KNOWLEDGE_CHUNK_CHARS, ingest_text
+from models import AgentKnowledgeFile, KnowledgeBlob, KnowledgeBlobChunk
+
+# Chunk rows per INSERT when storing a blob
+CHUNK_INSERT_BATCH = 1000
+
+
+def acquire_blob(session: Session, sha256: str, content: str, chunks: Sequence[str]) -> bool:
+    """
+    Take a reference on the blob for `content`, storing it and its chunks if
+    this is the first one; True if it was stored. If another session stores
+    the same blob concurrently this raises IntegrityError: roll back and
+    retry, which then takes a reference on theirs.
+    """
+    taken = session.exec(
+        update(KnowledgeBlob).where(KnowledgeBlob.sha256 == sha256).values(refcount=KnowledgeBlob.refcount + 1)
+    )
+    if taken.rowcount:
+        return False
+    session.exec(insert(KnowledgeBlob).values(
+        sha256=sha256, content=content, size_bytes=len(content.encode()), refcount=1
+    ))
+    rows = [{"blob_sha256": sha256, "ordinal": ordinal, "content": chunk} for ordinal, chunk in enumerate(chunks)]
+    for start in range(0, len(rows), CHUNK_INSERT_BATCH):
+        session.exec(insert(KnowledgeBlobChunk), params=rows[start:start + CHUNK_INSERT_BATCH])
+    return True
+
+
+def release_blob(session: Session, sha256: str) -> bool:
+    """Drop a reference on a blob, deleting it and its chunks if it was the last; True if deleted."""
+    session.exec(
+        update(KnowledgeBlob).where(KnowledgeBlob.sha256 == sha256).values(refcount=KnowledgeBlob.refcount - 1)
+    )
+    refcount = session.exec(select(KnowledgeBlob.refcount).where(KnowledgeBlob.sha256 == sha256)).first()
+    if refcount is None or refcount > 0:
+        return False
+    # One statement for the chunks (a large file has thousands) rather than an ORM cascade
+    session.exec(delete(KnowledgeBlobChunk).where(KnowledgeBlobChunk.blob_sha256 == sha256))
+    session.exec(delete(KnowledgeBlob).where(KnowledgeBlob.sha256 == sha256))
+    return True
+
+
+def load_blob_contents(session: Session, hashes: Collection[str]) -> Dict[str, str]:
+    """Text of the given blobs by hash; missing ones are left out."""
+    if not hashes:
+        return {}
+    return dict(session.exec(
+        select(KnowledgeBlob.sha256, KnowledgeBlob.content).where(KnowledgeBlob.sha256.in_(list(hashes)))
+    ).all())
+
+
+def add_knowledge_text(session: Session, agent_id: int, filename: str, text: str) -> AgentKnowledgeFile:
+    """Attach text to an agent as a ready knowledge file, bypassing background ingestion (seed data, tests)."""
+    document = ingest_text(text, KNOWLEDGE_CHUNK_CHARS, with_terms=False)
+    acquire_blob(session, document.sha256, document.content, document.chunks)
+    knowledge = AgentKnowledgeFile(
+        agent_id=agent_id,
+        filename=filename,
+        blob_sha256=document.sha256,
+        size_bytes=len(text.encode()),
+        chunk_count=len(document.chunks)
+    )
+    session.add(knowledge)
+    return knowledge
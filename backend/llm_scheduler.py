@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upstream calls allowed in flight across all callers
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 16))
+WAIT_SAMPLES = 500
+
+
+class Priority(IntEnum):
+    """Lower value is served first."""
+    INTERACTIVE = 0  # live WebSocket turns
+    API = 1          # REST /api/v1/chat/
+    BATCH = 2        # bulk / scripted jobs
+
+
+def _deadline_env(name: str, default: Optional[float]) -> Optional[float]:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    value = float(raw)
+    return value if value > 0 else None
+
+
+# How long a request may wait for admission before it is rejected (None = forever)
+DEFAULT_DEADLINES: Dict[Priority, Optional[float]] = {
+    Priority.INTERACTIVE: _deadline_env("LLM_DEADLINE_INTERACTIVE_S", 30.0),
+    Priority.API: _deadline_env("LLM_DEADLINE_API_S", 60.0),
+    Priority.BATCH: _deadline_env("LLM_DEADLINE_BATCH_S", None),
+}
+
+
+class AdmissionTimeout(Exception):
+    """A request waited longer than its admission deadline for an upstream slot."""
+
+    def __init__(self, priority: Priority, waited: float):
+        self.priority = priority
+        self.waited = waited
+        super().__init__(f"Upstream is busy: no {priority.name.lower()} slot within {waited:.1f}s")
+
+
+class _Waiter:
+    __slots__ = ("priority", "flow", "future", "enqueued")
+
+    def __init__(self, priority: Priority, flow: str, future: asyncio.Future):
+        self.priority = priority
+        self.flow = flow
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class LLMScheduler:
+    """
+    Admission control in front of ZaiClient.
+
+    At most `capacity` upstream calls run at once. Waiting requests are served
+    by strict priority class (interactive > API > batch); within a class, flows
+    (one per agent) share slots by weighted fair queuing (start-time fair
+    queuing over per-flow virtual finish tags), so one agent's burst cannot
+    starve the others. A request that is not admitted within its deadline
+    fails with AdmissionTimeout instead of queueing indefinitely.
+    """
+
+    def __init__(self, capacity: int = LLM_MAX_CONCURRENCY, deadlines: Optional[Dict[Priority, Optional[float]]] = None):
+        self.capacity = capacity
+        self.deadlines = dict(DEFAULT_DEADLINES if deadlines is None else deadlines)
+        self.weights: Dict[str, float] = {}
+        self.in_flight = 0
+        self._heap: List[Tuple[int, float, int, _Waiter]] = []
+        self._seq = itertools.count()
+        self._virtual_time: Dict[Priority, float] = {p: 0.0 for p in Priority}
+        self._flow_finish: Dict[Tuple[Priority, str], float] = {}
+        self.admitted: Dict[Priority, int] = {p: 0 for p in Priority}
+        self.rejected: Dict[Priority, int] = {p: 0 for p in Priority}
+        self.waits: Dict[Priority, Deque[float]] = {p: deque(maxlen=WAIT_SAMPLES) for p in Priority}
+
+    def set_weight(self, flow: str, weight: float):
+        """Relative share of a flow within its priority class (default 1)."""
+        self.weights[flow] = weight
+
+    def queued(self, priority: Optional[Priority] = None) -> int:
+        return sum(
+            1 for _, _, _, w in self._heap
+            if not w.future.done() and (priority is None or w.priority == priority)
+        )
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority, flow: str = "default", deadline: Optional[float] = -1.0, cost: float = 1.0):
+        """Hold one upstream slot for the duration of the block."""
+        await self.acquire(priority, flow, deadline, cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: Priority, flow: str = "default", deadline: Optional[float] = -1.0, cost: float = 1.0):
+        """
+        Wait for an upstream slot. `deadline` is seconds to wait for admission;
+        the default (-1) uses the class deadline and None waits forever.
+        """
+        if deadline is not None and deadline < 0:
+            deadline = self.deadlines.get(priority)
+
+        if self.in_flight < self.capacity and not self._heap:
+            self.in_flight += 1
+            self._admit(priority, 0.0)
+            return
+
+        waiter = _Waiter(priority, flow, asyncio.get_running_loop().create_future())
+        key = (priority, flow)
+        start = max(self._virtual_time[priority], self._flow_finish.get(key, 0.0))
+        self._flow_finish[key] = start + cost / self.weights.get(flow, 1.0)
+        heapq.heappush(self._heap, (int(priority), start, next(self._seq), waiter))
+        # Entries left behind by cancelled waiters may be all that blocked the fast path
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(waiter.future, deadline)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as we gave up: hand the slot on
+                self.release()
+            else:
+                waiter.future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected[priority] += 1
+                waited = time.monotonic() - waiter.enqueued
+                logger.warning(f"LLM admission timeout for {priority.name.lower()} flow {flow} after {waited:.1f}s")
+                raise AdmissionTimeout(priority, waited) from None
+            raise
+        self._admit(priority, time.monotonic() - waiter.enqueued)
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+        self._dispatch()
+
+    def _admit(self, priority: Priority, waited: float):
+        self.admitted[priority] += 1
+        self.waits[priority].append(waited)
+
+    def _dispatch(self):
+        while self._heap and self.in_flight < self.capacity:
+            _, start, _, waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue  # cancelled or timed out while queued
+            self._virtual_time[waiter.priority] = max(self._virtual_time[waiter.priority], start)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+        if not self._heap:
+            # Nothing queued: finish tags no longer matter, drop them
+            self._flow_finish.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        classes = {}
+        for p in Priority:
+            samples = sorted(self.waits[p])
+            classes[p.name.lower()] = {
+                "queued": self.queued(p),
+                "admitted": self.admitted[p],
+                "rejected": self.rejected[p],
+                "wait_p50_ms": int(samples[len(samples) // 2] * 1000) if samples else None,
+                "wait_p95_ms": int(samples[min(len(samples) - 1, int(0.95 * len(samples)))] * 1000) if samples else None,
+            }
+        return {"capacity": self.capacity, "in_flight": self.in_flight, "queued": self.queued(), "classes": classes}
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", 100))
+# Lag above this counts as a stall and is logged
+LOOP_LAG_STALL_MS = float(os.getenv("LOOP_LAG_STALL_MS", 100))
+LAG_SAMPLES = 600
+
+
+class LoopLagMonitor:
+    """
+    Measures event-loop lag: a task sleeps for `interval_ms` and records how
+    much later than scheduled it woke up. Anything blocking the loop (a
+    synchronous DB commit, CPU-heavy parsing) shows up as lag, and every
+    socket's stream is delayed by the same amount.
+    """
+
+    def __init__(self, interval_ms: float = LOOP_LAG_INTERVAL_MS, stall_ms: float = LOOP_LAG_STALL_MS):
+        self.interval_s = interval_ms / 1000.0
+        self.stall_s = stall_ms / 1000.0
+        self.samples: Deque[float] = deque(maxlen=LAG_SAMPLES)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def reset(self):
+        self.samples.clear()
+        self.max_lag = 0.0
+        self.stalls = 0
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval_s
+            await asyncio.sleep(self.interval_s)
+            self.record(max(0.0, time.monotonic() - expected))
+
+    def record(self, lag: float):
+        self.samples.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.stall_s:
+            self.stalls += 1
+            logger.warning(f"Event loop stalled for {lag * 1000:.0f}ms")
+
+    def stats(self) -> Dict[str, Any]:
+        ordered = sorted(self.samples)
+
+        def pct(p: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "interval_ms": self.interval_s * 1000,
+            "lag_p50_ms": pct(0.5),
+            "lag_p99_ms": pct(0.99),
+            "lag_max_ms": round(self.max_lag * 1000, 2),
+            "stalls": self.stalls,
+        }
@@ -8,10 +8,9 @@ from sqlmodel import SQLModel, text, Session
 from sqlalchemy.exc import OperationalError
 import logging
 
-from database import engine
-from dependencies import mcp_manager, zai_client
+from database import engine, dispose_async_engine
+from dependencies import mcp_manager, zai_client, db_worker, loop_monitor, write_buffer, knowledge_ingestor, chat_sessions
 from routers import mcp, chat, agents, websocket_chat, settings
-from models import SystemSetting
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -81,6 +80,7 @@ def seed_mcp_scripts():
 
 @app.on_event("startup")
 async def on_startup():
+    loop_monitor.start()
     # create_db_and_tables() # Enabled for local testing and initial setup
     
     # Run simple migration for new field
@@ -91,19 +91,26 @@ async def on_startup():
         logger.error(f"Migration script failed: {e}")
 
     seed_mcp_scripts()
-    # Load Z.ai Key from DB if exists
+    # Load Z.ai Keys from DB if exist
     try:
         with Session(engine) as session:
-            setting = session.get(SystemSetting, "zai_api_key")
-            if setting and setting.value:
-                logger.info("Loading Z.ai API Key from Database...")
-                zai_client.update_api_key(setting.value)
+            api_keys = settings.load_api_keys(session)
+            if api_keys:
+                logger.info(f"Loading {len(api_keys)} Z.ai API Key(s) from Database...")
+                zai_client.set_api_keys(api_keys)
     except Exception as e:
         logger.warning(f"Failed to load Z.ai key from DB on startup: {e}")
 
 @app.on_event("shutdown")
 async def on_shutdown():
     await mcp_manager.shutdown_all_mcps()
+    await loop_monitor.stop()
+    chat_sessions.close()
+    # Buffered chat writes must reach the DB before the worker threads go away
+    await write_buffer.close()
+    knowledge_ingestor.shutdown()
+    db_worker.shutdown()
+    await dispose_async_engine()
 
 
 def check_database_connection():
@@ -171,4 +178,6 @@ def serve_frontend_spa(full_path: str):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # permessage-deflate is negotiated with clients that offer it (uvicorn --ws-per-message-deflate)
+    deflate = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() not in ("0", "false", "no")
+    uvicorn.run(app, host="0.0.0.0", port=port, ws_per_message_deflate=deflate)
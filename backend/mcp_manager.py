@@ -18,6 +18,18 @@ class MCPManager:
         self.server_states: Dict[str, Dict[str, Any]] = {} # mcp_id -> {status, last_heartbeat, last_error, ...}
         self.default_timeout = 30 # seconds
 
+    def _set_state(self, mcp_id: str, **changes: Any):
+        """
+        Update an MCP's runtime state. State dicts are replaced, never changed
+        in place, so a status_snapshot() stays consistent after later updates.
+        """
+        base = self.server_states.get(mcp_id) or {"status": None, "last_heartbeat": None, "last_error": None}
+        self.server_states[mcp_id] = {**base, **changes}
+
+    def status_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """mcp_id -> runtime state for every registered MCP, without awaiting (for listings)."""
+        return dict(self.server_states)
+
     async def spawn_mcp(self, mcp_id: str, command: str, args: list[str], cwd: str = "/app", env: dict = None) -> dict:
         """
         Registers an MCP server configuration.
@@ -36,11 +48,7 @@ class MCPManager:
             env=full_env
         )
         self.server_configs[mcp_id] = server_params
-        self.server_states[mcp_id] = {
-            "status": "registered",
-            "last_heartbeat": None,
-            "last_error": None
-        }
+        self._set_state(mcp_id, status="registered", last_heartbeat=None, last_error=None)
         
         logger.info(f"MCP config {mcp_id} registered successfully.")
         return {"mcp_id": mcp_id, "status": "registered"}
@@ -71,7 +79,7 @@ class MCPManager:
         if not server_params:
             raise ValueError(f"MCP config for {mcp_id} not found. Register it first.")
         
-        self.server_states[mcp_id]["status"] = "listing_tools"
+        self._set_state(mcp_id, status="listing_tools")
         logger.info(f"Spawning temporary process to list tools for MCP {mcp_id}")
         
         try:
@@ -81,9 +89,9 @@ class MCPManager:
                     tools_data = await asyncio.wait_for(session.list_tools(), timeout=self.default_timeout)
                     
                     # Update state
-                    self.server_states[mcp_id]["status"] = "active"
-                    self.server_states[mcp_id]["last_heartbeat"] = datetime.now(timezone.utc).isoformat()
-                    self.server_states[mcp_id]["last_error"] = None
+                    self._set_state(
+                        mcp_id, status="active", last_heartbeat=datetime.now(timezone.utc).isoformat(), last_error=None
+                    )
                     
                     return tools_data.tools 
         except Exception as e:
@@ -91,8 +99,7 @@ class MCPManager:
             logger.error(error_msg)
             logger.error(traceback.format_exc())
             
-            self.server_states[mcp_id]["status"] = "error"
-            self.server_states[mcp_id]["last_error"] = str(e)
+            self._set_state(mcp_id, status="error", last_error=str(e))
             raise e
 
     async def call_mcp_tool(self, mcp_id: str, tool_name: str, tool_args: dict) -> dict:
@@ -103,7 +110,7 @@ class MCPManager:
         if not server_params:
             raise ValueError(f"MCP config for {mcp_id} not found. Register it first.")
         
-        self.server_states[mcp_id]["status"] = f"running_tool:{tool_name}"
+        self._set_state(mcp_id, status=f"running_tool:{tool_name}")
         logger.info(f"Spawning temporary process to call tool '{tool_name}' on MCP {mcp_id} with args: {tool_args}")
         
         try:
@@ -113,9 +120,9 @@ class MCPManager:
                     result = await asyncio.wait_for(session.call_tool(tool_name, arguments=tool_args), timeout=self.default_timeout)
                     
                     # Update state
-                    self.server_states[mcp_id]["status"] = "active"
-                    self.server_states[mcp_id]["last_heartbeat"] = datetime.now(timezone.utc).isoformat()
-                    self.server_states[mcp_id]["last_error"] = None
+                    self._set_state(
+                        mcp_id, status="active", last_heartbeat=datetime.now(timezone.utc).isoformat(), last_error=None
+                    )
                     
                     return result
         except Exception as e:
@@ -123,8 +130,7 @@ class MCPManager:
             logger.error(error_msg)
             logger.error(traceback.format_exc())
             
-            self.server_states[mcp_id]["status"] = "error"
-            self.server_states[mcp_id]["last_error"] = str(e)
+            self._set_state(mcp_id, status="error", last_error=str(e))
             raise e
 
     async def shutdown_all_mcps(self):
@@ -1,7 +1,12 @@
 import os
 import sys
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.exc import OperationalError
+from sqlmodel import Session
+
+from knowledge_index import KNOWLEDGE_CHUNK_CHARS, ingest_text
+from knowledge_store import acquire_blob
+from models import KnowledgeBlob, KnowledgeBlobChunk
 
 # Determine DB URL
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -14,22 +19,102 @@ if DATABASE_URL.startswith("postgres://"):
 
 engine = create_engine(DATABASE_URL)
 
+# (table, column, DDL type) added in place on startup; ADD COLUMN fails harmlessly if it exists.
+COLUMN_MIGRATIONS = [
+    ("zairag_agents", "reasoning_enabled", "BOOLEAN DEFAULT TRUE"),
+    ("zairag_agents", "context_budget_tokens", "INTEGER"),
+    ("zairag_agents", "fallback_model", "VARCHAR"),
+    ("zairag_agents", "hedge_enabled", "BOOLEAN DEFAULT FALSE"),
+    ("zairag_agents", "knowledge_mode", "VARCHAR"),
+    ("zairag_agents", "memory_window_tokens", "INTEGER"),
+    ("zairag_agents", "memory_pinned_turns", "INTEGER"),
+    ("zairag_agents", "memory_summary_model", "VARCHAR"),
+    ("zairag_chat_sessions", "cached_prompt_tokens", "INTEGER DEFAULT 0"),
+    ("zairag_chat_sessions", "memory_summary", "VARCHAR"),
+    ("zairag_chat_sessions", "summary_through_id", "INTEGER"),
+    ("zairag_agent_knowledge_files", "status", "VARCHAR DEFAULT 'ready'"),
+    ("zairag_agent_knowledge_files", "error", "VARCHAR"),
+    ("zairag_agent_knowledge_files", "size_bytes", "INTEGER"),
+    ("zairag_agent_knowledge_files", "chunk_count", "INTEGER"),
+    ("zairag_agent_knowledge_files", "blob_sha256", "VARCHAR REFERENCES zairag_knowledge_blobs (sha256)"),
+]
+
+# (index, table, columns) for the hot lookup paths; see the add_lookup_indexes revision
+INDEX_MIGRATIONS = [
+    ("ix_zairag_chat_messages_chat_session_id_id", "zairag_chat_messages", "chat_session_id, id"),
+    ("ix_zairag_chat_sessions_agent_id", "zairag_chat_sessions", "agent_id"),
+    ("ix_zairag_agent_knowledge_files_agent_id_filename", "zairag_agent_knowledge_files", "agent_id, filename"),
+    ("ix_zairag_agent_mcp_links_mcp_server_id", "zairag_agent_mcp_links", "mcp_server_id"),
+    ("ix_zairag_agent_knowledge_files_blob_sha256", "zairag_agent_knowledge_files", "blob_sha256"),
+]
+
+# Tables added since the initial schema, created with their indexes if missing (before
+# COLUMN_MIGRATIONS, which reference them)
+TABLE_MIGRATIONS = [KnowledgeBlob.__table__, KnowledgeBlobChunk.__table__]
+
+def migrate_knowledge_blobs():
+    """Move knowledge file text stored inline into blobs, then drop the inline column and per-file chunks."""
+    columns = {column["name"] for column in inspect(engine).get_columns("zairag_agent_knowledge_files")}
+    if "content" not in columns:
+        return
+    with Session(engine) as session:
+        rows = session.connection().execute(text(
+            "SELECT id, content FROM zairag_agent_knowledge_files WHERE status = 'ready' AND blob_sha256 IS NULL"
+        )).all()
+        for file_id, content in rows:
+            document = ingest_text(content, KNOWLEDGE_CHUNK_CHARS, with_terms=False)
+            acquire_blob(session, document.sha256, document.content, document.chunks)
+            session.connection().execute(
+                text("UPDATE zairag_agent_knowledge_files SET blob_sha256 = :sha256, chunk_count = :chunks WHERE id = :id"),
+                {"sha256": document.sha256, "chunks": len(document.chunks), "id": file_id}
+            )
+        session.commit()
+        print(f"Moved {len(rows)} knowledge files into blobs.")
+    with engine.connect() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS zairag_agent_knowledge_chunks"))
+        connection.execute(text("ALTER TABLE zairag_agent_knowledge_files DROP COLUMN content"))
+        connection.commit()
+        print("Dropped inline knowledge content.")
+
 def run_migration():
-    print("Checking for 'reasoning_enabled' column in 'zairag_agents'...")
+    for table in TABLE_MIGRATIONS:
+        try:
+            table.create(engine, checkfirst=True)
+            print(f"Ensured table '{table.name}'.")
+        except Exception as e:
+            print(f"Table migration failed: {e}")
+
+    for table, column, ddl in COLUMN_MIGRATIONS:
+        print(f"Checking for '{column}' column in '{table}'...")
+        try:
+            # One connection per column so a failed ALTER doesn't abort the others (Postgres)
+            with engine.connect() as connection:
+                # Check if column exists (Postgres specific check, or just try catch)
+                # Simplest for cross-db is just try to add it and catch error if exists
+                try:
+                    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                    connection.commit()
+                    print(f"Added column '{column}'.")
+                except Exception as e:
+                    # Likely already exists
+                    print(f"Column likely exists or error: {e}")
+                    
+        except Exception as e:
+            print(f"Migration failed: {e}")
+
     try:
-        with engine.connect() as connection:
-            # Check if column exists (Postgres specific check, or just try catch)
-            # Simplest for cross-db is just try to add it and catch error if exists
-            try:
-                connection.execute(text("ALTER TABLE zairag_agents ADD COLUMN reasoning_enabled BOOLEAN DEFAULT TRUE"))
-                connection.commit()
-                print("Added column 'reasoning_enabled'.")
-            except Exception as e:
-                # Likely already exists
-                print(f"Column likely exists or error: {e}")
-                
+        migrate_knowledge_blobs()
     except Exception as e:
-        print(f"Migration failed: {e}")
+        print(f"Knowledge blob migration failed: {e}")
+
+    for index, table, columns in INDEX_MIGRATIONS:
+        try:
+            with engine.connect() as connection:
+                connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({columns})"))
+                connection.commit()
+                print(f"Ensured index '{index}'.")
+        except Exception as e:
+            print(f"Index migration failed: {e}")
 
 if __name__ == "__main__":
     run_migration()
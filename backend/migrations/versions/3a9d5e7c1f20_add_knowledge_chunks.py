@@ -0,0 +1,46 @@
+"""add_knowledge_chunks
+
+Revision ID: 3a9d5e7c1f20
+Revises: 8f4c2b7d9e13
+Create Date: 2026-10-19 17:05:41.218734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3a9d5e7c1f20'
+down_revision: Union[str, Sequence[str], None] = '8f4c2b7d9e13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('zairag_agents', sa.Column('knowledge_mode', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    # Files uploaded before this revision have no chunks; they are chunked when the agent's profile is built
+    op.create_table('zairag_agent_knowledge_chunks',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('agent_id', sa.Integer(), nullable=False),
+    sa.Column('file_id', sa.Integer(), nullable=False),
+    sa.Column('ordinal', sa.Integer(), nullable=False),
+    sa.Column('content', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.ForeignKeyConstraint(['agent_id'], ['zairag_agents.id'], ),
+    sa.ForeignKeyConstraint(['file_id'], ['zairag_agent_knowledge_files.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_zairag_agent_knowledge_chunks_agent_id_file_id_ordinal', 'zairag_agent_knowledge_chunks',
+                    ['agent_id', 'file_id', 'ordinal'])
+    op.create_index('ix_zairag_agent_knowledge_chunks_file_id', 'zairag_agent_knowledge_chunks', ['file_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_zairag_agent_knowledge_chunks_file_id', table_name='zairag_agent_knowledge_chunks')
+    op.drop_index('ix_zairag_agent_knowledge_chunks_agent_id_file_id_ordinal', table_name='zairag_agent_knowledge_chunks')
+    op.drop_table('zairag_agent_knowledge_chunks')
+    op.drop_column('zairag_agents', 'knowledge_mode')
@@ -0,0 +1,28 @@
+"""add_session_cached_prompt_tokens
+
+Revision ID: 5b8f2d6c1e94
+Revises: d41b6e0a93c7
+Create Date: 2026-10-19 13:05:47.218406
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8f2d6c1e94'
+down_revision: Union[str, Sequence[str], None] = 'd41b6e0a93c7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('zairag_chat_sessions', sa.Column('cached_prompt_tokens', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('zairag_chat_sessions', 'cached_prompt_tokens')
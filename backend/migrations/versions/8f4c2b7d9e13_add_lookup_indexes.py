@@ -0,0 +1,42 @@
+"""add_lookup_indexes
+
+Revision ID: 8f4c2b7d9e13
+Revises: 5b8f2d6c1e94
+Create Date: 2026-10-19 15:22:08.640193
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f4c2b7d9e13'
+down_revision: Union[str, Sequence[str], None] = '5b8f2d6c1e94'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_zairag_chat_messages_chat_session_id_id', 'zairag_chat_messages', ['chat_session_id', 'id']),
+    ('ix_zairag_chat_sessions_agent_id', 'zairag_chat_sessions', ['agent_id']),
+    ('ix_zairag_agent_knowledge_files_agent_id_filename', 'zairag_agent_knowledge_files', ['agent_id', 'filename']),
+    ('ix_zairag_agent_mcp_links_mcp_server_id', 'zairag_agent_mcp_links', ['mcp_server_id']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # On Postgres build the indexes without blocking writes to the (large) message table;
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    concurrently = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=concurrently)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
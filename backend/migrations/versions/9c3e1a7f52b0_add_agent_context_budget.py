@@ -0,0 +1,28 @@
+"""add_agent_context_budget
+
+Revision ID: 9c3e1a7f52b0
+Revises: 4575cb94e281
+Create Date: 2026-10-19 09:12:44.318207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c3e1a7f52b0'
+down_revision: Union[str, Sequence[str], None] = '4575cb94e281'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('zairag_agents', sa.Column('context_budget_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('zairag_agents', 'context_budget_tokens')
@@ -0,0 +1,36 @@
+"""add_knowledge_ingestion_status
+
+Revision ID: b62e0f4d8a15
+Revises: 3a9d5e7c1f20
+Create Date: 2026-10-19 18:31:12.904417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b62e0f4d8a15'
+down_revision: Union[str, Sequence[str], None] = '3a9d5e7c1f20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Files stored before background ingestion are complete
+    op.add_column('zairag_agent_knowledge_files', sa.Column('status', sqlmodel.sql.sqltypes.AutoString(), nullable=False, server_default='ready'))
+    op.add_column('zairag_agent_knowledge_files', sa.Column('error', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    op.add_column('zairag_agent_knowledge_files', sa.Column('size_bytes', sa.Integer(), nullable=True))
+    op.add_column('zairag_agent_knowledge_files', sa.Column('chunk_count', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('zairag_agent_knowledge_files', 'chunk_count')
+    op.drop_column('zairag_agent_knowledge_files', 'size_bytes')
+    op.drop_column('zairag_agent_knowledge_files', 'error')
+    op.drop_column('zairag_agent_knowledge_files', 'status')
@@ -0,0 +1,30 @@
+"""add_agent_routing_policy
+
+Revision ID: d41b6e0a93c7
+Revises: 9c3e1a7f52b0
+Create Date: 2026-10-19 11:40:02.551938
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41b6e0a93c7'
+down_revision: Union[str, Sequence[str], None] = '9c3e1a7f52b0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('zairag_agents', sa.Column('fallback_model', sa.String(), nullable=True))
+    op.add_column('zairag_agents', sa.Column('hedge_enabled', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('zairag_agents', 'hedge_enabled')
+    op.drop_column('zairag_agents', 'fallback_model')
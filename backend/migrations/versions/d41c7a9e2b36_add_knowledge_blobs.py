@@ -0,0 +1,120 @@
+"""add_knowledge_blobs
+
+Revision ID: d41c7a9e2b36
+Revises: b62e0f4d8a15
+Create Date: 2026-10-19 21:07:45.118302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+from knowledge_index import KNOWLEDGE_CHUNK_CHARS, ingest_text
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41c7a9e2b36'
+down_revision: Union[str, Sequence[str], None] = 'b62e0f4d8a15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+files = sa.table('zairag_agent_knowledge_files',
+                 sa.column('id', sa.Integer), sa.column('agent_id', sa.Integer), sa.column('status', sa.String),
+                 sa.column('content', sa.String), sa.column('blob_sha256', sa.String),
+                 sa.column('chunk_count', sa.Integer))
+blobs = sa.table('zairag_knowledge_blobs',
+                 sa.column('sha256', sa.String), sa.column('content', sa.String),
+                 sa.column('size_bytes', sa.Integer), sa.column('refcount', sa.Integer))
+blob_chunks = sa.table('zairag_knowledge_blob_chunks',
+                       sa.column('blob_sha256', sa.String), sa.column('ordinal', sa.Integer), sa.column('content', sa.String))
+file_chunks = sa.table('zairag_agent_knowledge_chunks',
+                       sa.column('agent_id', sa.Integer), sa.column('file_id', sa.Integer),
+                       sa.column('ordinal', sa.Integer), sa.column('content', sa.String))
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('zairag_knowledge_blobs',
+    sa.Column('sha256', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('content', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('size_bytes', sa.Integer(), nullable=False),
+    sa.Column('refcount', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('sha256')
+    )
+    op.create_table('zairag_knowledge_blob_chunks',
+    sa.Column('blob_sha256', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('ordinal', sa.Integer(), nullable=False),
+    sa.Column('content', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.ForeignKeyConstraint(['blob_sha256'], ['zairag_knowledge_blobs.sha256'], ),
+    sa.PrimaryKeyConstraint('blob_sha256', 'ordinal')
+    )
+    op.add_column('zairag_agent_knowledge_files', sa.Column('blob_sha256', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+    # Move each ready file's text into a blob, one per distinct text. The text is normalized,
+    # hashed and chunked by ingest_text like an upload, so the blob dedupes with re-uploads
+    bind = op.get_bind()
+    refcounts = {}
+    file_ids = bind.execute(
+        sa.select(files.c.id).where(files.c.status == 'ready').order_by(files.c.id)
+    ).scalars().all()
+    for file_id in file_ids:
+        content = bind.execute(sa.select(files.c.content).where(files.c.id == file_id)).scalar_one()
+        document = ingest_text(content, KNOWLEDGE_CHUNK_CHARS, with_terms=False)
+        sha256 = document.sha256
+        if sha256 not in refcounts:
+            refcounts[sha256] = 0
+            bind.execute(blobs.insert().values(
+                sha256=sha256, content=document.content, size_bytes=len(document.content.encode()), refcount=0
+            ))
+            if document.chunks:
+                bind.execute(blob_chunks.insert(), [
+                    {'blob_sha256': sha256, 'ordinal': ordinal, 'content': chunk} for ordinal, chunk in enumerate(document.chunks)
+                ])
+        refcounts[sha256] += 1
+        bind.execute(files.update().where(files.c.id == file_id).values(blob_sha256=sha256, chunk_count=len(document.chunks)))
+    for sha256, refcount in refcounts.items():
+        bind.execute(blobs.update().where(blobs.c.sha256 == sha256).values(refcount=refcount))
+
+    op.drop_index('ix_zairag_agent_knowledge_chunks_file_id', table_name='zairag_agent_knowledge_chunks')
+    op.drop_index('ix_zairag_agent_knowledge_chunks_agent_id_file_id_ordinal', table_name='zairag_agent_knowledge_chunks')
+    op.drop_table('zairag_agent_knowledge_chunks')
+    with op.batch_alter_table('zairag_agent_knowledge_files') as batch_op:
+        batch_op.drop_column('content')
+        batch_op.create_index('ix_zairag_agent_knowledge_files_blob_sha256', ['blob_sha256'])
+        batch_op.create_foreign_key('fk_zairag_agent_knowledge_files_blob_sha256', 'zairag_knowledge_blobs',
+                                    ['blob_sha256'], ['sha256'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.add_column('zairag_agent_knowledge_files', sa.Column('content', sqlmodel.sql.sqltypes.AutoString(), nullable=False, server_default=''))
+    bind = op.get_bind()
+    bind.execute(files.update().values(
+        content=sa.select(blobs.c.content).where(blobs.c.sha256 == files.c.blob_sha256).scalar_subquery()
+    ).where(files.c.blob_sha256.is_not(None)))
+    op.create_table('zairag_agent_knowledge_chunks',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('agent_id', sa.Integer(), nullable=False),
+    sa.Column('file_id', sa.Integer(), nullable=False),
+    sa.Column('ordinal', sa.Integer(), nullable=False),
+    sa.Column('content', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.ForeignKeyConstraint(['agent_id'], ['zairag_agents.id'], ),
+    sa.ForeignKeyConstraint(['file_id'], ['zairag_agent_knowledge_files.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_zairag_agent_knowledge_chunks_agent_id_file_id_ordinal', 'zairag_agent_knowledge_chunks',
+                    ['agent_id', 'file_id', 'ordinal'])
+    op.create_index('ix_zairag_agent_knowledge_chunks_file_id', 'zairag_agent_knowledge_chunks', ['file_id'])
+    bind.execute(file_chunks.insert().from_select(
+        ['agent_id', 'file_id', 'ordinal', 'content'],
+        sa.select(files.c.agent_id, files.c.id, blob_chunks.c.ordinal, blob_chunks.c.content)
+        .join(blob_chunks, blob_chunks.c.blob_sha256 == files.c.blob_sha256)
+    ))
+    with op.batch_alter_table('zairag_agent_knowledge_files') as batch_op:
+        batch_op.drop_constraint('fk_zairag_agent_knowledge_files_blob_sha256', type_='foreignkey')
+        batch_op.drop_index('ix_zairag_agent_knowledge_files_blob_sha256')
+        batch_op.drop_column('blob_sha256')
+    op.drop_table('zairag_knowledge_blob_chunks')
+    op.drop_table('zairag_knowledge_blobs')
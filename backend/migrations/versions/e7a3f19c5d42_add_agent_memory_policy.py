@@ -0,0 +1,33 @@
+"""add_agent_memory_policy
+
+Revision ID: e7a3f19c5d42
+Revises: d41c7a9e2b36
+Create Date: 2026-10-19 22:40:03.561870
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a3f19c5d42'
+down_revision: Union[str, Sequence[str], None] = 'd41c7a9e2b36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('zairag_agents', sa.Column('memory_window_tokens', sa.Integer(), nullable=True))
+    op.add_column('zairag_agents', sa.Column('memory_pinned_turns', sa.Integer(), nullable=True))
+    op.add_column('zairag_agents', sa.Column('memory_summary_model', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('zairag_agents', 'memory_summary_model')
+    op.drop_column('zairag_agents', 'memory_pinned_turns')
+    op.drop_column('zairag_agents', 'memory_window_tokens')
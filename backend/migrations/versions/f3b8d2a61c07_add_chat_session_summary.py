@@ -0,0 +1,31 @@
+"""add_chat_session_summary
+
+Revision ID: f3b8d2a61c07
+Revises: e7a3f19c5d42
+Create Date: 2026-10-19 23:52:17.204913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b8d2a61c07'
+down_revision: Union[str, Sequence[str], None] = 'e7a3f19c5d42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('zairag_chat_sessions', sa.Column('memory_summary', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    op.add_column('zairag_chat_sessions', sa.Column('summary_through_id', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('zairag_chat_sessions', 'summary_through_id')
+    op.drop_column('zairag_chat_sessions', 'memory_summary')
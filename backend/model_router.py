@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+
+import httpx
+from openai import APIConnectionError
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Time-to-first-token samples kept per model for the hedge delay
+TTFT_WINDOW = int(os.getenv("ROUTER_TTFT_WINDOW", 200))
+# Don't hedge until the p95 is based on at least this many samples
+HEDGE_MIN_SAMPLES = int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", 20))
+HEDGE_MIN_DELAY_S = float(os.getenv("ROUTER_HEDGE_MIN_DELAY_S", 0.05))
+
+
+class RoutingPolicy(BaseModel):
+    """Per-agent routing: fail over to `fallback_model` on 429/5xx, optionally hedge slow starts."""
+
+    fallback_model: Optional[str] = None
+    hedge: bool = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.fallback_model) or self.hedge
+
+
+class RouteInfo(BaseModel):
+    """Which upstream request actually served a model call."""
+
+    model: str
+    kind: str  # primary | fallback | hedge
+    reason: Optional[str] = None
+    ttft_ms: Optional[int] = None
+
+
+# Called with each failure the router recovers from (failover, or another route winning)
+FailureCallback = Callable[[BaseException], None]
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Rate limits, upstream 5xx and transport failures are worth another route."""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(exc, (APIConnectionError, httpx.TransportError, asyncio.TimeoutError))
+
+
+_EXHAUSTED = object()
+
+
+class _Attempt:
+    """One upstream request, racing to produce its first item."""
+
+    def __init__(self, factory: Callable[[str], AsyncIterator], model: str, kind: str, reason: Optional[str] = None):
+        self.model = model
+        self.kind = kind
+        self.reason = reason
+        self.started = time.monotonic()
+        self.iterator = factory(model).__aiter__()
+        self.task = asyncio.ensure_future(self._first())
+
+    async def _first(self):
+        try:
+            return await self.iterator.__anext__()
+        except StopAsyncIteration:
+            return _EXHAUSTED
+
+    async def cancel(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        aclose = getattr(self.iterator, "aclose", None)
+        if aclose:
+            try:
+                await aclose()
+            except Exception as e:
+                logger.debug(f"Error closing cancelled {self.kind} stream for {self.model}: {e}")
+
+
+class RoutedStream:
+    """
+    Async iterator over the winning upstream stream. `route` is set once the
+    first item has arrived.
+    """
+
+    def __init__(
+        self,
+        router: "ModelRouter",
+        factory: Callable[[str], AsyncIterator],
+        model: str,
+        policy: RoutingPolicy,
+        key_suffix: str = "",
+        on_failure: Optional[FailureCallback] = None
+    ):
+        self.router = router
+        self.factory = factory
+        self.model = model
+        self.policy = policy
+        self.key_suffix = key_suffix
+        self.on_failure = on_failure
+        self.route: Optional[RouteInfo] = None
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        attempt = await self.router._race(self.factory, self.model, self.policy, self.key_suffix, self.on_failure)
+        self.route = RouteInfo(
+            model=attempt.model,
+            kind=attempt.kind,
+            reason=attempt.reason,
+            ttft_ms=int((time.monotonic() - attempt.started) * 1000)
+        )
+        self.router._record_route(self.route)
+        try:
+            first = attempt.task.result()
+            if first is _EXHAUSTED:
+                return
+            yield first
+            async for item in attempt.iterator:
+                yield item
+        finally:
+            aclose = getattr(attempt.iterator, "aclose", None)
+            if aclose:
+                await aclose()
+
+
+class ModelRouter:
+    """
+    Routes model calls according to an agent's RoutingPolicy.
+
+    Fallback: if the primary model fails with a 429/5xx before producing
+    anything, the same request is re-sent to the fallback model.
+    Hedging: if the primary has not produced its first item within the learned
+    p95 time-to-first-token, a duplicate request is fired and whichever starts
+    first wins; the loser is cancelled.
+    Failures recovered from this way never reach the caller, so they are
+    reported to `on_failure` instead (e.g. to back off a concurrency limit).
+    """
+
+    def __init__(self):
+        self.ttft_samples: Dict[str, Deque[float]] = {}
+        self.route_counts: Dict[str, int] = {}
+
+    def record_ttft(self, key: str, seconds: float):
+        self.ttft_samples.setdefault(key, deque(maxlen=TTFT_WINDOW)).append(seconds)
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        samples = self.ttft_samples.get(key)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+        return max(HEDGE_MIN_DELAY_S, p95)
+
+    def _record_route(self, route: RouteInfo):
+        label = f"{route.model}:{route.kind}"
+        self.route_counts[label] = self.route_counts.get(label, 0) + 1
+        if route.kind != "primary":
+            logger.info(f"Served by {route.kind} route {route.model} ({route.reason}, ttft {route.ttft_ms}ms)")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routes": dict(self.route_counts),
+            "hedge_delay_ms": {
+                key: int(delay * 1000)
+                for key in self.ttft_samples
+                if (delay := self.hedge_delay(key)) is not None
+            },
+        }
+
+    def stream(
+        self,
+        factory: Callable[[str], AsyncIterator],
+        model: str,
+        policy: Optional[RoutingPolicy] = None,
+        on_failure: Optional[FailureCallback] = None
+    ) -> RoutedStream:
+        """`factory(model)` must start a new upstream stream for the given model."""
+        return RoutedStream(self, factory, model, policy or RoutingPolicy(), on_failure=on_failure)
+
+    async def complete(
+        self,
+        factory: Callable[[str], Awaitable[Any]],
+        model: str,
+        policy: Optional[RoutingPolicy] = None,
+        on_failure: Optional[FailureCallback] = None
+    ):
+        """Non-streaming variant: returns (result, RouteInfo)."""
+
+        async def single(m: str):
+            yield await factory(m)
+
+        routed = RoutedStream(self, single, model, policy or RoutingPolicy(), key_suffix="#complete", on_failure=on_failure)
+        iterator = routed.__aiter__()
+        try:
+            result = await iterator.__anext__()
+        finally:
+            await iterator.aclose()
+        return result, routed.route
+
+    async def _race(
+        self, factory, model: str, policy: RoutingPolicy, key_suffix: str, on_failure: Optional[FailureCallback] = None
+    ) -> _Attempt:
+        pending: List[_Attempt] = [_Attempt(factory, model, "primary")]
+        fallback_available = bool(policy.fallback_model)
+        delay = self.hedge_delay(model + key_suffix) if policy.hedge else None
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    [a.task for a in pending], timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Hedge timer fired: duplicate the request and race both
+                    delay = None
+                    pending.append(_Attempt(factory, model, "hedge", reason="slow_first_token"))
+                    continue
+
+                for attempt in [a for a in pending if a.task in done]:
+                    pending.remove(attempt)
+                    exc = attempt.task.exception()
+                    if exc is None:
+                        self.record_ttft(attempt.model + key_suffix, time.monotonic() - attempt.started)
+                        for loser in pending:
+                            await loser.cancel()
+                        pending = []
+                        return attempt
+
+                    logger.warning(f"{attempt.kind} route {attempt.model} failed: {exc}")
+                    if fallback_available and is_retryable(exc):
+                        fallback_available = False
+                        # No hedge after a failover: it would duplicate the model that just failed
+                        delay = None
+                        status = getattr(exc, "status_code", None)
+                        pending.append(_Attempt(
+                            factory, policy.fallback_model, "fallback",
+                            reason=f"http_{status}" if status else type(exc).__name__
+                        ))
+                    elif not pending:
+                        raise exc
+                    # Another route carries on, so the caller won't see this failure
+                    if on_failure:
+                        on_failure(exc)
+        finally:
+            for attempt in pending:
+                await attempt.cancel()
+
+        raise RuntimeError("No route produced a response")
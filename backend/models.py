@@ -1,5 +1,6 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Literal, Optional
 
+from sqlalchemy import Index
 from sqlmodel import Field, Relationship, SQLModel
 
 
@@ -11,8 +12,9 @@ class SystemSetting(SQLModel, table=True):
 class AgentMCPServer(SQLModel, table=True):
     __tablename__ = "zairag_agent_mcp_links"
     agent_id: Optional[int] = Field(default=None, foreign_key="zairag_agents.id", primary_key=True)
+    # The primary key (agent_id, mcp_server_id) serves lookups by agent; this one by server
     mcp_server_id: Optional[int] = Field(
-        default=None, foreign_key="zairag_mcp_servers.id", primary_key=True
+        default=None, foreign_key="zairag_mcp_servers.id", primary_key=True, index=True
     )
 
 
@@ -23,6 +25,19 @@ class Agent(SQLModel, table=True):
     system_prompt: str
     model: str
     reasoning_enabled: bool = Field(default=True)
+    # Max estimated prompt tokens per request; None falls back to DEFAULT_CONTEXT_BUDGET_TOKENS.
+    context_budget_tokens: Optional[int] = Field(default=None)
+    # Routing policy: model to fail over to on 429/5xx, and whether to hedge slow first tokens.
+    fallback_model: Optional[str] = Field(default=None)
+    hedge_enabled: bool = Field(default=False)
+    # "retrieval" or "full" knowledge injection; None falls back to KNOWLEDGE_MODE.
+    knowledge_mode: Optional[str] = Field(default=None)
+    # Conversation memory (see chat_memory): history window in estimated tokens (0 keeps
+    # everything), recent turns always kept, model summarizing evicted turns. None falls
+    # back to MEMORY_WINDOW_TOKENS, MEMORY_PINNED_TURNS and MEMORY_SUMMARY_MODEL.
+    memory_window_tokens: Optional[int] = Field(default=None)
+    memory_pinned_turns: Optional[int] = Field(default=None)
+    memory_summary_model: Optional[str] = Field(default=None)
 
     chat_sessions: List["ChatSession"] = Relationship(back_populates="agent")
     mcp_servers: List["MCPServer"] = Relationship(
@@ -41,6 +56,13 @@ class AgentRead(SQLModel):
     system_prompt: str
     model: str
     reasoning_enabled: bool = True
+    context_budget_tokens: Optional[int] = None
+    fallback_model: Optional[str] = None
+    hedge_enabled: bool = False
+    knowledge_mode: Optional[str] = None
+    memory_window_tokens: Optional[int] = None
+    memory_pinned_turns: Optional[int] = None
+    memory_summary_model: Optional[str] = None
 
     linked_mcp_ids: List[int] = Field(default_factory=list)
     linked_mcp_count: int = 0
@@ -56,16 +78,58 @@ class AgentUpdate(SQLModel):
     system_prompt: Optional[str] = None
     model: Optional[str] = None
     reasoning_enabled: Optional[bool] = None
+    context_budget_tokens: Optional[int] = None
+    fallback_model: Optional[str] = None
+    hedge_enabled: Optional[bool] = None
+    knowledge_mode: Optional[Literal["retrieval", "full", ""]] = None
+    memory_window_tokens: Optional[int] = Field(default=None, ge=0)
+    memory_pinned_turns: Optional[int] = Field(default=None, ge=0)
+    memory_summary_model: Optional[str] = None
+
+
+class KnowledgeBlob(SQLModel, table=True):
+    """
+    Normalized knowledge text, stored once however many knowledge files (of
+    any agents) have it, keyed by its SHA-256. See knowledge_store.
+    """
+
+    __tablename__ = "zairag_knowledge_blobs"
+    sha256: str = Field(primary_key=True)
+    content: str
+    size_bytes: int = Field(default=0)
+    # Knowledge files pointing here; the blob and its chunks go when it drops to 0
+    refcount: int = Field(default=0)
+
+
+class KnowledgeBlobChunk(SQLModel, table=True):
+    """A retrieval-sized piece of a blob, cut when it was first stored."""
+
+    __tablename__ = "zairag_knowledge_blob_chunks"
+    blob_sha256: str = Field(foreign_key="zairag_knowledge_blobs.sha256", primary_key=True)
+    ordinal: int = Field(primary_key=True)
+    content: str
 
 
 class AgentKnowledgeFile(SQLModel, table=True):
+    """An agent's knowledge file: metadata only, the text is in its blob."""
+
     __tablename__ = "zairag_agent_knowledge_files"
+    # Matches load_knowledge_files: filter by agent, read in filename order
+    __table_args__ = (Index("ix_zairag_agent_knowledge_files_agent_id_filename", "agent_id", "filename"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     agent_id: int = Field(foreign_key="zairag_agents.id")
     filename: str
-    content: str
+    # Content address of the normalized text; None until ingestion finishes
+    blob_sha256: Optional[str] = Field(default=None, foreign_key="zairag_knowledge_blobs.sha256", index=True)
+    # Ingestion: pending (queued) -> processing -> ready, or failed with `error`
+    status: str = Field(default="ready")
+    error: Optional[str] = Field(default=None)
+    size_bytes: Optional[int] = Field(default=None)
+    chunk_count: Optional[int] = Field(default=None)
 
     agent: "Agent" = Relationship(back_populates="knowledge_files")
+    # Loaded on first access only
+    blob: Optional[KnowledgeBlob] = Relationship()
 
 
 class MCPServer(SQLModel, table=True):
@@ -93,11 +157,16 @@ class MCPServer(SQLModel, table=True):
 class ChatSession(SQLModel, table=True):
     __tablename__ = "zairag_chat_sessions"
     id: Optional[int] = Field(default=None, primary_key=True)
-    agent_id: int = Field(foreign_key="zairag_agents.id")
+    agent_id: int = Field(foreign_key="zairag_agents.id", index=True)
     
     total_tokens: int = Field(default=0)
     prompt_tokens: int = Field(default=0)
     completion_tokens: int = Field(default=0)
+    cached_prompt_tokens: int = Field(default=0)  # served from the upstream prefix cache
+    # Rolling summary of the conversation's older turns (see session_store), covering
+    # the messages up to and including summary_through_id
+    memory_summary: Optional[str] = None
+    summary_through_id: Optional[int] = None
 
     agent: "Agent" = Relationship(back_populates="chat_sessions")
     chat_messages: List["ChatMessage"] = Relationship(back_populates="chat_session")
@@ -105,6 +174,8 @@ class ChatSession(SQLModel, table=True):
 
 class ChatMessage(SQLModel, table=True):
     __tablename__ = "zairag_chat_messages"
+    # A session's history in insertion order without a sort; also serves the foreign key
+    __table_args__ = (Index("ix_zairag_chat_messages_chat_session_id_id", "chat_session_id", "id"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     chat_session_id: int = Field(foreign_key="zairag_chat_sessions.id")
     role: str
@@ -135,6 +206,10 @@ class ChatRequest(SQLModel):
     agent_id: int
     message: str
     include_reasoning: bool = True
+    # Scheduling class for the upstream calls; bulk/scripted jobs should send "batch"
+    priority: Literal["api", "batch"] = "api"
+    # Continue this chat session (from an earlier response or a WebSocket "done" event); omitted starts a new one
+    session_id: Optional[int] = None
 
 
 
@@ -144,3 +219,7 @@ class ChatResponse(SQLModel):
 
 
     response: str
+    # Which model route served each call when the agent has a routing policy
+    routes: List[Dict[str, Any]] = Field(default_factory=list)
+    # Send back as session_id to continue the conversation
+    session_id: Optional[int] = None
@@ -1,37 +1,109 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+import os
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, UploadFile, File
+from fastapi.responses import PlainTextResponse
 from sqlmodel import Session, select
-from typing import List
+from typing import Any, Callable, Dict, List, Optional
+from sqlalchemy import String, func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 
-from database import get_session
+from database import get_session, get_session_factory
+from async_db import AsyncDBSession, get_async_session
+from http_cache import LIST_PAGE_MAX, conditional_json, next_page
 from models import Agent, AgentMCPServer, MCPServer, AgentKnowledgeFile, AgentRead, AgentUpdate
+from agent_runtime import AgentProfileCache, remove_knowledge_file
+from knowledge_ingest import KnowledgeIngestor, UploadTooLarge
+from knowledge_store import load_blob_contents, release_blob
+from dependencies import get_agent_profiles, get_knowledge_ingestor
 
 router = APIRouter(prefix="/api/v1/agents", tags=["Agent Management"])
 
-@router.get("/", response_model=List[AgentRead])
-def list_agents(session: Session = Depends(get_session)):
-    agents = session.exec(select(Agent)).all()
-    results: List[AgentRead] = []
-
-    for agent in agents:
-        linked_ids = [
-            link_id
-            for link_id in session.exec(
-                select(AgentMCPServer.mcp_server_id).where(AgentMCPServer.agent_id == agent.id)
-            ).all()
-            if link_id is not None
-        ]
-
-        agent_data = agent.dict(exclude={"chat_sessions", "mcp_servers", "knowledge_files"})
-        results.append(
-            AgentRead(
-                **agent_data,
-                linked_mcp_ids=linked_ids,
-                linked_mcp_count=len(linked_ids)
+LINK_FIELDS = ("linked_mcp_ids", "linked_mcp_count")
+
+
+class id_list(FunctionElement):
+    """Comma-separated aggregate of an integer column, skipping NULLs (ids of an outer join)."""
+    type = String()
+    name = "id_list"
+    inherit_cache = True
+
+
+@compiles(id_list)
+def _compile_id_list(element, compiler, **kw):
+    return f"group_concat({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(id_list, "postgresql")
+def _compile_id_list_postgresql(element, compiler, **kw):
+    return f"string_agg(CAST({compiler.process(element.clauses, **kw)} AS TEXT), ',')"
+
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    """?fields=name,model -> AgentRead fields in declaration order (id is always included)."""
+    known = list(AgentRead.model_fields)
+    if not fields:
+        return known
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - set(known)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return [f for f in known if f in requested or f == "id"]
+
+
+def agent_listing_query(fields: List[str], after: Optional[int], limit: Optional[int]):
+    """One statement for a page of agents: the requested columns plus their MCP links aggregated per agent."""
+    columns = [getattr(Agent, f) for f in fields if f not in LINK_FIELDS]
+    statement = select(*columns)
+    if any(f in LINK_FIELDS for f in fields):
+        statement = (
+            statement.add_columns(
+                id_list(AgentMCPServer.mcp_server_id).label("linked_mcp_ids"),
+                func.count(AgentMCPServer.mcp_server_id).label("linked_mcp_count"),
             )
+            .outerjoin(AgentMCPServer, AgentMCPServer.agent_id == Agent.id)
+            .group_by(Agent.id)
         )
+    if after is not None:
+        statement = statement.where(Agent.id > after)
+    statement = statement.order_by(Agent.id)
+    if limit is not None:
+        statement = statement.limit(limit + 1)  # one extra row tells whether there is a next page
+    return statement
+
+
+def agent_listing_row(row: Any, fields: List[str]) -> Dict[str, Any]:
+    # exec() returns plain values for a single-column select (?fields=id)
+    data = row._asdict() if hasattr(row, "_asdict") else {"id": row}
+    item = {}
+    for field in fields:
+        if field == "linked_mcp_ids":
+            ids = data["linked_mcp_ids"]
+            item[field] = sorted(int(i) for i in ids.split(",")) if ids else []
+        else:
+            item[field] = data[field]
+    return item
+
+
+@router.get("/", response_model=List[AgentRead])
+async def list_agents(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=LIST_PAGE_MAX),
+    after: Optional[int] = Query(None, description="Keyset cursor: return agents with id greater than this"),
+    fields: Optional[str] = Query(None, description="Comma-separated AgentRead fields to return"),
+    session: AsyncDBSession = Depends(get_async_session)
+):
+    """
+    Agents ordered by id, with their linked MCP server ids, in a single query.
+    Without `limit` every agent is returned; with it, the X-Next-Cursor header
+    carries the `after` value for the next page when there is one. Responses
+    carry an ETag; a matching If-None-Match gets 304 with no body.
+    """
+    selected = parse_fields(fields)
+    rows = (await session.exec(agent_listing_query(selected, after, limit))).all()
 
-    return results
+    items, headers = next_page([agent_listing_row(row, selected) for row in rows], limit)
+    return conditional_json(request, items, headers)
 
 @router.post("/", response_model=Agent)
 def create_agent(agent: Agent, session: Session = Depends(get_session)):
@@ -41,7 +113,12 @@ def create_agent(agent: Agent, session: Session = Depends(get_session)):
     return agent
 
 @router.put("/{agent_id}", response_model=Agent)
-def update_agent(agent_id: int, payload: AgentUpdate, session: Session = Depends(get_session)):
+def update_agent(
+    agent_id: int,
+    payload: AgentUpdate,
+    session: Session = Depends(get_session),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
     agent = session.get(Agent, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
@@ -52,24 +129,48 @@ def update_agent(agent_id: int, payload: AgentUpdate, session: Session = Depends
         agent.system_prompt = payload.system_prompt
     if payload.model is not None:
         agent.model = payload.model
+    if payload.context_budget_tokens is not None:
+        agent.context_budget_tokens = payload.context_budget_tokens
+    if payload.fallback_model is not None:
+        # Empty string clears the fallback
+        agent.fallback_model = payload.fallback_model or None
+    if payload.hedge_enabled is not None:
+        agent.hedge_enabled = payload.hedge_enabled
+    if payload.knowledge_mode is not None:
+        # Empty string goes back to the KNOWLEDGE_MODE default
+        agent.knowledge_mode = payload.knowledge_mode or None
+    if payload.memory_window_tokens is not None:
+        agent.memory_window_tokens = payload.memory_window_tokens
+    if payload.memory_pinned_turns is not None:
+        agent.memory_pinned_turns = payload.memory_pinned_turns
+    if payload.memory_summary_model is not None:
+        # Empty string goes back to the MEMORY_SUMMARY_MODEL default
+        agent.memory_summary_model = payload.memory_summary_model or None
 
     session.add(agent)
     session.commit()
+    profiles.invalidate(agent_id)
     session.refresh(agent)
     return agent
 
 @router.delete("/{agent_id}")
-def delete_agent(agent_id: int, session: Session = Depends(get_session)):
+def delete_agent(agent_id: int, session: Session = Depends(get_session), profiles: AgentProfileCache = Depends(get_agent_profiles)):
     agent = session.get(Agent, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
 
     session.delete(agent)
     session.commit()
+    profiles.invalidate(agent_id)
     return {"message": "Agent deleted"}
 
 @router.post("/{agent_id}/link-mcp/{server_id}")
-def link_mcp_to_agent(agent_id: int, server_id: int, session: Session = Depends(get_session)):
+def link_mcp_to_agent(
+    agent_id: int,
+    server_id: int,
+    session: Session = Depends(get_session),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
     agent = session.get(Agent, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
@@ -92,28 +193,55 @@ def link_mcp_to_agent(agent_id: int, server_id: int, session: Session = Depends(
         # Likely duplicate link raced in; treat as success to keep UI happy
         return {"message": "MCP already linked to agent"}
 
+    profiles.invalidate(agent_id)
     return {"message": "Linked successfully"}
 
-@router.post("/{agent_id}/knowledge")
-async def upload_agent_knowledge(agent_id: int, file: UploadFile = File(...), session: Session = Depends(get_session)):
-    agent = session.get(Agent, agent_id)
+@router.post("/{agent_id}/knowledge", status_code=202, response_model=AgentKnowledgeFile)
+async def upload_agent_knowledge(
+    agent_id: int,
+    response: Response,
+    file: UploadFile = File(...),
+    wait: bool = Query(False, description="Respond once the file is ingested rather than when it is queued"),
+    session: AsyncDBSession = Depends(get_async_session),
+    session_factory: Callable[[], Session] = Depends(get_session_factory),
+    ingestor: KnowledgeIngestor = Depends(get_knowledge_ingestor),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
+    """
+    Queue a text file for ingestion (202, status "pending"); poll
+    GET /{agent_id}/knowledge/{file_id} until it is "ready" or "failed".
+    With ?wait=true the response is the finished file instead.
+    """
+    agent = await session.get(Agent, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
-    
-    content = await file.read()
+
     try:
-        content_str = content.decode("utf-8")
-    except UnicodeDecodeError:
-         raise HTTPException(status_code=400, detail="File must be valid UTF-8 text")
-         
-    knowledge = AgentKnowledgeFile(agent_id=agent_id, filename=file.filename, content=content_str)
+        path = await ingestor.spool(file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    knowledge = AgentKnowledgeFile(
+        agent_id=agent_id, filename=file.filename, status="pending", size_bytes=os.path.getsize(path)
+    )
     session.add(knowledge)
-    session.commit()
-    session.refresh(knowledge)
+    await session.commit()
+    await session.refresh(knowledge)
+    # Chunked, stored and added to the agent's cached index in the background
+    ingestor.submit(knowledge.id, path, session_factory, profiles)
+    if not wait:
+        return knowledge
+
+    await ingestor.wait(knowledge.id)
+    await session.refresh(knowledge)
+    if knowledge.status == "failed":
+        raise HTTPException(status_code=400, detail=knowledge.error)
+    response.status_code = 200
     return knowledge
 
 @router.get("/{agent_id}/knowledge", response_model=List[AgentKnowledgeFile])
 def list_agent_knowledge(agent_id: int, session: Session = Depends(get_session)):
+    """The agent's knowledge files, metadata only; see GET /{agent_id}/knowledge/{file_id}/content."""
     agent = session.get(Agent, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
@@ -121,12 +249,41 @@ def list_agent_knowledge(agent_id: int, session: Session = Depends(get_session))
     files = session.exec(select(AgentKnowledgeFile).where(AgentKnowledgeFile.agent_id == agent_id)).all()
     return files
 
+@router.get("/{agent_id}/knowledge/{file_id}", response_model=AgentKnowledgeFile)
+def get_agent_knowledge(agent_id: int, file_id: int, session: Session = Depends(get_session)):
+    """A knowledge file with its ingestion status."""
+    file = session.get(AgentKnowledgeFile, file_id)
+    if not file or file.agent_id != agent_id:
+        raise HTTPException(status_code=404, detail="File not found for this agent")
+    return file
+
+@router.get("/{agent_id}/knowledge/{file_id}/content", response_class=PlainTextResponse)
+def get_agent_knowledge_content(agent_id: int, file_id: int, session: Session = Depends(get_session)):
+    """A ready knowledge file's normalized text."""
+    file = session.get(AgentKnowledgeFile, file_id)
+    if not file or file.agent_id != agent_id:
+        raise HTTPException(status_code=404, detail="File not found for this agent")
+    if file.blob_sha256 is None:
+        raise HTTPException(status_code=409, detail=f"File is {file.status}")
+    return load_blob_contents(session, [file.blob_sha256]).get(file.blob_sha256, "")
+
 @router.delete("/{agent_id}/knowledge/{file_id}")
-def delete_agent_knowledge(agent_id: int, file_id: int, session: Session = Depends(get_session)):
+def delete_agent_knowledge(
+    agent_id: int,
+    file_id: int,
+    session: Session = Depends(get_session),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
     file = session.get(AgentKnowledgeFile, file_id)
     if not file or file.agent_id != agent_id:
         raise HTTPException(status_code=404, detail="File not found for this agent")
     
+    blob_sha256 = file.blob_sha256
     session.delete(file)
+    session.flush()
+    if blob_sha256:
+        # The text (and its chunks) goes with the last file using it
+        release_blob(session, blob_sha256)
     session.commit()
+    profiles.update(agent_id, lambda profile: remove_knowledge_file(profile, file_id))
     return {"message": "File deleted"}
@@ -1,16 +1,25 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
-from typing import List, Dict, Any
+from sqlmodel import Session
+from typing import Callable, List, Dict, Any, Optional, Tuple
+from contextlib import AsyncExitStack
 import json
 import logging
-import os
 from openai import RateLimitError
 
-from database import get_session
-from models import Agent, AgentMCPServer, ChatRequest, ChatResponse, MCPServer, AgentKnowledgeFile
-from dependencies import get_mcp_manager, get_zai_client
+from async_db import AsyncDBSession, get_async_session
+from chat_memory import ChatMemory
+from database import get_session_factory
+from db_worker import DBWorker
+from models import ChatRequest, ChatResponse
+from dependencies import get_mcp_manager, get_zai_client, get_token_estimator, get_model_router, get_llm_scheduler, get_agent_profiles, get_db_worker, get_chat_sessions, get_write_buffer
 from mcp_manager import MCPManager
 from zai_client import ZaiClient
+from token_budget import TokenEstimator, PromptBudgetExceeded
+from model_router import ModelRouter, RoutingPolicy
+from llm_scheduler import LLMScheduler, Priority, AdmissionTimeout
+from agent_runtime import AgentProfileCache, AgentRuntimeProfile, compile_agent_profile, load_agent_setup, retrieve_knowledge
+from session_store import ChatSessionStore, create_chat_session, load_session, memory_settings, store_messages, store_summary
+from write_behind import WriteBehindBuffer
 
 logger = logging.getLogger(__name__)
 
@@ -19,159 +28,194 @@ router = APIRouter(prefix="/api/v1/chat", tags=["Chat"])
 @router.post("/", response_model=ChatResponse)
 async def chat_with_agent(
     request: ChatRequest, 
-    session: Session = Depends(get_session),
+    session: AsyncDBSession = Depends(get_async_session),
     mcp_manager: MCPManager = Depends(get_mcp_manager),
-    zai_client: ZaiClient = Depends(get_zai_client)
+    zai_client: ZaiClient = Depends(get_zai_client),
+    estimator: TokenEstimator = Depends(get_token_estimator),
+    router: ModelRouter = Depends(get_model_router),
+    scheduler: LLMScheduler = Depends(get_llm_scheduler),
+    profiles: AgentProfileCache = Depends(get_agent_profiles),
+    sessions: ChatSessionStore = Depends(get_chat_sessions),
+    db: DBWorker = Depends(get_db_worker),
+    writes: WriteBehindBuffer = Depends(get_write_buffer),
+    session_factory: Callable[[], Session] = Depends(get_session_factory)
 ):
-    # 1. Load Agent
-    agent = session.get(Agent, request.agent_id)
-    if not agent:
+    # 1-3. Agent profile: system prompt with knowledge (fixed order so the prompt prefix
+    # is cache-friendly), tools with their tool_name -> mcp_server_id map, and settings.
+    # Cached per agent; servers whose tools fail to load are logged and skipped
+    async def build_profile(version: int) -> Optional[AgentRuntimeProfile]:
+        setup = await session.run_sync(load_agent_setup, request.agent_id)
+        return await compile_agent_profile(setup, mcp_manager, version) if setup else None
+
+    profile = await profiles.get(request.agent_id, build_profile)
+    if not profile:
         raise HTTPException(status_code=404, detail="Agent not found")
+    tools, tool_map = profile.tools, profile.tool_map
+    injected_context = profile.knowledge_context
 
-    # 1.5. Inject Knowledge Files into System Prompt
-    knowledge_files = session.exec(select(AgentKnowledgeFile).where(AgentKnowledgeFile.agent_id == agent.id)).all()
-    injected_context = ""
-    if knowledge_files:
-        injected_context = "\n\n--- Contextual Information ---\n"
-        for k_file in knowledge_files:
-            injected_context += f"File: {k_file.filename}\nContent:\n{k_file.content}\n\n"
-        injected_context += "----------------------------\n\n"
-    
-    final_system_prompt = agent.system_prompt + injected_context
-
-    # 2. Load Linked MCP Servers
-    links = session.exec(select(AgentMCPServer).where(AgentMCPServer.agent_id == agent.id)).all()
-    mcp_server_ids = [link.mcp_server_id for link in links]
-    
-    # 3. Fetch Tools and Build Map
-    tools = []
-    tool_map = {} # tool_name -> mcp_server_id
-    
-    # Determine paths relative to this file's parent (backend/)
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    scripts_dir = os.getenv("MCP_SCRIPTS_DIR", os.path.join(base_dir, "mcp-runtime-scripts"))
-
-    for server_id in mcp_server_ids:
-        try:
-            # Ensure server is "started" (registered in manager)
-            mcp_server_db = session.get(MCPServer, server_id)
-            if mcp_server_db:
-                # Check if registered
-                status = await mcp_manager.get_mcp_status(str(server_id))
-                if status.get("status") == "not found":
-                     # Register it
-                     env_vars = {}
-                     if mcp_server_db.env_vars:
-                         try:
-                             env_vars = json.loads(mcp_server_db.env_vars)
-                         except:
-                             pass
-                    
-                     args = []
-                     if mcp_server_db.args:
-                         try:
-                             args = json.loads(mcp_server_db.args)
-                         except:
-                             pass
-                     
-                     if not args and mcp_server_db.command == "python":
-                         # Resolve full path
-                         full_script_path = os.path.join(scripts_dir, mcp_server_db.script)
-                         args = [full_script_path]
-
-                     await mcp_manager.spawn_mcp(
-                         str(server_id), 
-                         mcp_server_db.command, 
-                         args,
-                         cwd=mcp_server_db.cwd,
-                         env=env_vars
-                     )
-
-            server_tools = await mcp_manager.list_mcp_tools(str(server_id))
-            for tool in server_tools:
-                tool_def = tool.model_dump(exclude_none=True)
-                
-                openai_tool = {
-                    "type": "function",
-                    "function": {
-                        "name": tool_def["name"],
-                        "description": tool_def.get("description"),
-                        "parameters": tool_def.get("inputSchema") 
-                    }
-                }
-                tools.append(openai_tool)
-                tool_map[tool_def["name"]] = str(server_id)
-                
-        except Exception as e:
-            logger.warning(f"Error fetching tools from server {server_id}: {e}")
-            # Continue without these tools
-
-    # 4. Prepare Chat History
-    messages = [
-        {"role": "system", "content": final_system_prompt},
-        {"role": "user", "content": request.message}
-    ]
-
-    # 5. Chat Loop (Handle Tool Calls)
-    max_turns = 5
-    for _ in range(max_turns):
-        # Call Z.ai
-        try:
-            message = await zai_client.chat(
+    # 3.5 Chat Session: continue request.session_id (its memory kept in process, else reloaded
+    # from its summary and latest messages) or start a new one
+    settings = memory_settings(profile, estimator, zai_client, scheduler)
+    chat_session_id = request.session_id
+
+    async def save_summary(summary: str, through_id: int):
+        # Summaries land after the response, so they get their own session on the worker
+        await db.run_in_session(session_factory, store_summary, chat_session_id, summary, through_id)
+
+    if chat_session_id is None:
+        # A new session is only stored once its first turn succeeds, so rejected turns leave none behind
+        memory = ChatMemory(*settings)
+        lock = AsyncExitStack()
+    else:
+        chat = await sessions.open(
+            chat_session_id, request.agent_id, settings,
+            lambda: session.run_sync(load_session, chat_session_id, profile.memory, settings[2]),
+            save_summary
+        )
+        if chat is None:
+            raise HTTPException(status_code=404, detail="Chat session not found")
+        memory, lock = chat.memory, chat.lock
+
+    # One request at a time per session, so concurrent turns don't interleave
+    async with lock:
+        # 4. Prepare Chat History: the session's memory, then (in retrieval mode) the knowledge
+        # chunks relevant to the message that it doesn't carry already
+        messages = memory.messages()
+        turn_start = len(messages)
+        knowledge, chunk_ids = retrieve_knowledge(
+            profile, request.message, lambda text: estimator.count_text(text, profile.model), exclude=memory.sent_chunks()
+        )
+        if knowledge:
+            messages.append(knowledge)
+        messages.append({"role": "user", "content": request.message})
+        # (role, content) rows stored once the turn has succeeded
+        stored: List[Tuple[str, str]] = [("user", request.message)]
+        # Token usage of each completion, added to the session once the turn is stored
+        usages: List[Dict[str, Any]] = []
+
+        # 5. Chat Loop (Handle Tool Calls)
+        routing = RoutingPolicy(fallback_model=profile.fallback_model, hedge=profile.hedge_enabled)
+        routes = []
+        priority = Priority.BATCH if request.priority == "batch" else Priority.API
+
+        def call_model(model: str):
+            # Fail fast on the primary when a fallback model can take over
+            fail_fast = routing.fallback_model and model != routing.fallback_model
+            return zai_client.chat_once(
                 messages=messages,
-                model=agent.model,
+                model=model,
                 tools=tools if tools else None,
-                include_reasoning=agent.reasoning_enabled
+                include_reasoning=profile.reasoning_enabled,
+                max_retries=0 if fail_fast else None,
+                on_usage=usages.append
             )
-        except RateLimitError:
-            logger.error("Z.ai Rate Limit Exceeded")
-            raise HTTPException(status_code=429, detail="Z.ai API Rate Limit Exceeded. Please try again later.")
-        except Exception as e:
-             raise HTTPException(status_code=500, detail=f"Z.ai Error: {str(e)}")
-
-        # Append assistant message to history
-        messages.append(message)
-
-        # Check for tool calls
-        if message.tool_calls:
-            for tool_call in message.tool_calls:
-                tool_name = tool_call.function.name
-                tool_args_str = tool_call.function.arguments
-                tool_args = json.loads(tool_args_str)
+
+        max_turns = 5
+        for _ in range(max_turns):
+            # Refuse to send prompts that won't fit the agent's context budget
+            try:
+                budget = estimator.check(
+                    messages,
+                    tools if tools else None,
+                    model=profile.model,
+                    knowledge_context=injected_context,
+                    budget=profile.context_budget_tokens
+                )
+            except PromptBudgetExceeded as e:
+                raise HTTPException(status_code=413, detail={"message": str(e), "budget": e.report.model_dump()})
+
+            # Call Z.ai (admitted by the scheduler behind live WebSocket turns)
+            served_model = profile.model
+            calls = len(usages)
+            try:
+                async with scheduler.slot(priority, flow=f"agent:{profile.agent_id}"):
+                    if routing.enabled:
+                        message, route = await router.complete(call_model, profile.model, routing)
+                        routes.append(route.model_dump())
+                        served_model = route.model
+                    else:
+                        message = await zai_client.chat(
+                            messages=messages,
+                            model=profile.model,
+                            tools=tools if tools else None,
+                            include_reasoning=profile.reasoning_enabled,
+                            on_usage=usages.append
+                        )
+            except AdmissionTimeout as e:
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+            except RateLimitError:
+                logger.error("Z.ai Rate Limit Exceeded")
+                raise HTTPException(status_code=429, detail="Z.ai API Rate Limit Exceeded. Please try again later.")
+            except Exception as e:
+                 raise HTTPException(status_code=500, detail=f"Z.ai Error: {str(e)}")
+            # Calibrate the estimator against the upstream's count for the prompt just sent
+            if len(usages) > calls:
+                estimator.observe(served_model, budget.total, usages[-1].get("prompt_tokens") or 0)
+
+            # Append assistant message to history
+            messages.append(message.model_dump(exclude_none=True))
+            if message.content:
+                stored.append(("assistant", message.content))
+
+            # Check for tool calls
+            if message.tool_calls:
+                for tool_call in message.tool_calls:
+                    tool_name = tool_call.function.name
+                    tool_args_str = tool_call.function.arguments
+                    tool_args = json.loads(tool_args_str)
                 
-                if tool_name in tool_map:
-                    server_id = tool_map[tool_name]
-                    try:
-                        # Execute Tool
-                        result = await mcp_manager.call_mcp_tool(server_id, tool_name, tool_args)
+                    if tool_name in tool_map:
+                        server_id = tool_map[tool_name]
+                        try:
+                            # Execute Tool
+                            result = await mcp_manager.call_mcp_tool(server_id, tool_name, tool_args)
                         
-                        # Format result for OpenAI
-                        content_str = str(result)
-                        if isinstance(result, list):
-                             content_str = "\n".join([c.text for c in result if c.type == 'text'])
-                        elif hasattr(result, 'content') and isinstance(result.content, list):
-                             content_str = "\n".join([c.text for c in result.content if c.type == 'text'])
+                            # Format result for OpenAI
+                            content_str = str(result)
+                            if isinstance(result, list):
+                                 content_str = "\n".join([c.text for c in result if c.type == 'text'])
+                            elif hasattr(result, 'content') and isinstance(result.content, list):
+                                 content_str = "\n".join([c.text for c in result.content if c.type == 'text'])
 
+                            messages.append({
+                                "role": "tool",
+                                "tool_call_id": tool_call.id,
+                                "content": content_str
+                            })
+                        except Exception as e:
+                            logger.error(f"Error executing tool {tool_name}: {e}")
+                            messages.append({
+                                "role": "tool",
+                                "tool_call_id": tool_call.id,
+                                "content": f"Error executing tool: {str(e)}"
+                            })
+                    else:
                         messages.append({
                             "role": "tool",
                             "tool_call_id": tool_call.id,
-                            "content": content_str
+                            "content": "Tool not found or not linked to this agent."
                         })
-                    except Exception as e:
-                        logger.error(f"Error executing tool {tool_name}: {e}")
-                        messages.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call.id,
-                            "content": f"Error executing tool: {str(e)}"
-                        })
-                else:
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": "Tool not found or not linked to this agent."
-                    })
+                    stored.append(("tool", f"Tool: {tool_name}\nResult: {messages[-1]['content']}"))
+            else:
+                # No tool calls, final response
+                reply = message.content
+                break
         else:
-            # No tool calls, final response
-            return ChatResponse(response=message.content)
-            
-    return ChatResponse(response="Max chat turns reached.")
+            reply = "Max chat turns reached."
+
+        # 6. Store the turn and keep it in the session's memory
+        if chat_session_id is None:
+            chat_session_id = await session.run_sync(create_chat_session, request.agent_id)
+            memory = sessions.create(chat_session_id, request.agent_id, settings, save_summary).memory
+        last_id = await session.run_sync(store_messages, chat_session_id, stored)
+        memory.add_turn(messages[turn_start:], chunk_ids, last_id)
+        writes.add_usage(
+            chat_session_id,
+            prompt_tokens=sum(usage.get("prompt_tokens") or 0 for usage in usages),
+            completion_tokens=sum(usage.get("completion_tokens") or 0 for usage in usages),
+            total_tokens=sum(usage.get("total_tokens") or 0 for usage in usages),
+            cached_prompt_tokens=sum(
+                (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0 for usage in usages
+            )
+        )
+        return ChatResponse(response=reply, routes=routes, session_id=chat_session_id)
@@ -1,6 +1,6 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, File
 from sqlmodel import Session, select
-from typing import List
+from typing import Any, Dict, List, Optional
 import shutil
 import os
 import hashlib
@@ -8,45 +8,63 @@ import json
 import logging
 
 from database import get_session
+from async_db import AsyncDBSession, get_async_session
+from http_cache import LIST_PAGE_MAX, conditional_json, next_page
 from models import MCPServer
-from dependencies import get_mcp_manager
+from dependencies import get_mcp_manager, get_script_index, get_agent_profiles
+from agent_runtime import AgentProfileCache
 from mcp_manager import MCPManager
+from script_index import ScriptIndex
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1/mcp", tags=["MCP Management"])
 
+def server_listing_item(
+    server: MCPServer, runtime: Optional[Dict[str, Any]], script_exists: bool
+) -> Dict[str, Any]:
+    """The stored row with runtime status merged in; the ORM object is left untouched."""
+    item = server.model_dump()
+    if runtime is not None:
+        item["status"] = runtime.get("status")
+        item["last_heartbeat"] = runtime.get("last_heartbeat")
+        item["last_error"] = runtime.get("last_error")
+    else:
+        # Not registered with the manager: startable unless the script is missing
+        item["status"] = "ready" if script_exists else "missing_script"
+    return item
+
+
 @router.get("/servers", response_model=List[MCPServer])
-async def list_mcp_servers(session: Session = Depends(get_session), mcp_manager: MCPManager = Depends(get_mcp_manager)):
-    servers = session.exec(select(MCPServer)).all()
-    
-    # Determine paths relative to this file's parent (backend/) to ensure compatibility
-    # with different environments (Docker, Railway, Local).
-    # This file is in routers/, so parent is backend/
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    scripts_dir = os.getenv("MCP_SCRIPTS_DIR", os.path.join(base_dir, "mcp-runtime-scripts"))
-    
-    # Enrich with runtime status if available
-    for server in servers:
-        status_info = await mcp_manager.get_mcp_status(str(server.id))
-        
-        # Check script existence
-        # We join directly to support subdirectories (e.g. "billing-v2/main.py")
-        script_path = os.path.join(scripts_dir, server.script)
-        script_exists = os.path.exists(script_path)
-
-        if status_info.get("status") != "not found":
-             server.status = status_info.get("status")
-             server.last_heartbeat = status_info.get("last_heartbeat")
-             server.last_error = status_info.get("last_error")
-        else:
-             # Not running, check if script is missing
-             if not script_exists:
-                 server.status = "missing_script"
-             else:
-                 server.status = "ready" # Ready to start
-
-    return servers
+async def list_mcp_servers(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=LIST_PAGE_MAX),
+    after: Optional[int] = Query(None, description="Keyset cursor: return servers with id greater than this"),
+    session: AsyncDBSession = Depends(get_async_session),
+    mcp_manager: MCPManager = Depends(get_mcp_manager),
+    scripts: ScriptIndex = Depends(get_script_index)
+):
+    """
+    MCP servers ordered by id with their runtime status: one query, merged
+    with the manager's status snapshot and the cached script listing. Paged
+    with `limit`/`after` (X-Next-Cursor) and revalidated with ETag /
+    If-None-Match, like the agent listing.
+    """
+    statement = select(MCPServer).order_by(MCPServer.id)
+    if after is not None:
+        statement = statement.where(MCPServer.id > after)
+    if limit is not None:
+        statement = statement.limit(limit + 1)
+    servers = (await session.exec(statement)).all()
+
+    states = mcp_manager.status_snapshot()
+    scripts.refresh()
+    items = [
+        server_listing_item(server, states.get(str(server.id)), scripts.exists(server.script))
+        for server in servers
+    ]
+    items, headers = next_page(items, limit)
+    return conditional_json(request, items, headers)
 
 @router.post("/servers", response_model=MCPServer)
 def create_mcp_server(server: MCPServer, session: Session = Depends(get_session)):
@@ -67,21 +85,33 @@ def create_mcp_server(server: MCPServer, session: Session = Depends(get_session)
     return server
 
 @router.delete("/servers/{server_id}")
-async def delete_mcp_server(server_id: int, session: Session = Depends(get_session), mcp_manager: MCPManager = Depends(get_mcp_manager)):
-    server = session.get(MCPServer, server_id)
+async def delete_mcp_server(
+    server_id: int,
+    session: AsyncDBSession = Depends(get_async_session),
+    mcp_manager: MCPManager = Depends(get_mcp_manager),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
+    server = await session.get(MCPServer, server_id)
     if not server:
         raise HTTPException(status_code=404, detail="Server not found")
     
     # Stop if running
     await mcp_manager.terminate_mcp(str(server_id))
     
-    session.delete(server)
-    session.commit()
+    await session.delete(server)
+    await session.commit()
+    # Linked agents' tool lists change; server changes are rare, so drop every profile
+    profiles.invalidate()
     return {"ok": True}
 
 @router.post("/servers/{server_id}/start")
-async def start_mcp_server(server_id: int, session: Session = Depends(get_session), mcp_manager: MCPManager = Depends(get_mcp_manager)):
-    server = session.get(MCPServer, server_id)
+async def start_mcp_server(
+    server_id: int,
+    session: AsyncDBSession = Depends(get_async_session),
+    mcp_manager: MCPManager = Depends(get_mcp_manager),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
+    server = await session.get(MCPServer, server_id)
     if not server:
         raise HTTPException(status_code=404, detail="Server not found")
 
@@ -132,14 +162,20 @@ async def start_mcp_server(server_id: int, session: Session = Depends(get_sessio
             cwd=server.cwd,
             env=env_vars
         )
+        profiles.invalidate()
         return result
     except Exception as e:
         logger.error(f"Failed to start MCP {server_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/servers/{server_id}/stop")
-async def stop_mcp_server(server_id: int, mcp_manager: MCPManager = Depends(get_mcp_manager)):
+async def stop_mcp_server(
+    server_id: int,
+    mcp_manager: MCPManager = Depends(get_mcp_manager),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
     await mcp_manager.terminate_mcp(str(server_id))
+    profiles.invalidate()
     return {"message": "Server stopped"}
 
 @router.get("/servers/{server_id}/status")
@@ -164,7 +200,11 @@ async def call_mcp_server_tool(server_id: int, tool_name: str, tool_args: dict,
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/upload")
-async def upload_mcp_script(file: UploadFile = File(...)):
+async def upload_mcp_script(
+    file: UploadFile = File(...),
+    scripts: ScriptIndex = Depends(get_script_index),
+    profiles: AgentProfileCache = Depends(get_agent_profiles)
+):
     """
     Upload an MCP asset (server script or data). Allows .py and .json so data
     files like bill.json can ship alongside the server script.
@@ -203,6 +243,9 @@ async def upload_mcp_script(file: UploadFile = File(...)):
             buffer.write(chunk)
             
     checksum = sha256_hash.hexdigest()
+    scripts.invalidate()
+    # A replaced script can expose different tools
+    profiles.invalidate()
         
     return {
         "filename": filename, 
@@ -1,18 +1,61 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
-from typing import Dict
+from sqlmodel import Session
+from typing import Dict, List
 from pydantic import BaseModel
+import json
 
 from database import get_session
 from models import SystemSetting
 from dependencies import get_zai_client
 from zai_client import ZaiClient
+from key_pool import key_id, mask_key
 
 router = APIRouter(prefix="/api/v1/settings", tags=["System Settings"])
 
 class APIKeyRequest(BaseModel):
     api_key: str
 
+class APIKeysRequest(BaseModel):
+    api_keys: List[str]
+
+
+def load_api_keys(session: Session) -> List[str]:
+    """
+    Configured Z.ai keys. The pool lives in "zai_api_keys" (JSON list);
+    "zai_api_key" always mirrors its first key so single-key readers keep working.
+    """
+    pool = session.get(SystemSetting, "zai_api_keys")
+    if pool and pool.value:
+        try:
+            keys = [k for k in json.loads(pool.value) if k]
+            if keys:
+                return keys
+        except ValueError:
+            pass
+    single = session.get(SystemSetting, "zai_api_key")
+    return [single.value] if single and single.value else []
+
+
+def _save_setting(session: Session, key: str, value: str):
+    setting = session.get(SystemSetting, key)
+    if not setting:
+        setting = SystemSetting(key=key, value=value)
+    else:
+        setting.value = value
+    session.add(setting)
+
+
+def save_api_keys(session: Session, zai_client: ZaiClient, api_keys: List[str]):
+    keys = list(dict.fromkeys(k for k in api_keys if k))
+    _save_setting(session, "zai_api_keys", json.dumps(keys))
+    _save_setting(session, "zai_api_key", keys[0] if keys else "")
+    session.commit()
+
+    # Update live client
+    zai_client.set_api_keys(keys)
+    return keys
+
+
 @router.get("/zai-key")
 def get_zai_key(session: Session = Depends(get_session)):
     setting = session.get(SystemSetting, "zai_api_key")
@@ -28,17 +71,51 @@ def update_zai_key(
     session: Session = Depends(get_session),
     zai_client: ZaiClient = Depends(get_zai_client)
 ):
-    setting = session.get(SystemSetting, "zai_api_key")
-    if not setting:
-        setting = SystemSetting(key="zai_api_key", value=request.api_key)
-        session.add(setting)
-    else:
-        setting.value = request.api_key
-        session.add(setting)
-    
-    session.commit()
-    
-    # Update live client
-    zai_client.update_api_key(request.api_key)
-    
+    # Setting the single key replaces the whole pool
+    save_api_keys(session, zai_client, [request.api_key])
     return {"status": "updated"}
+
+@router.get("/zai-keys")
+def list_zai_keys(session: Session = Depends(get_session)):
+    return [{"id": key_id(k), "masked_key": mask_key(k)} for k in load_api_keys(session)]
+
+@router.put("/zai-keys")
+def replace_zai_keys(
+    request: APIKeysRequest,
+    session: Session = Depends(get_session),
+    zai_client: ZaiClient = Depends(get_zai_client)
+):
+    if not any(request.api_keys):
+        raise HTTPException(status_code=400, detail="At least one API key is required")
+    keys = save_api_keys(session, zai_client, request.api_keys)
+    return {"status": "updated", "count": len(keys)}
+
+@router.post("/zai-keys")
+def add_zai_key(
+    request: APIKeyRequest,
+    session: Session = Depends(get_session),
+    zai_client: ZaiClient = Depends(get_zai_client)
+):
+    keys = load_api_keys(session)
+    if request.api_key in keys:
+        raise HTTPException(status_code=409, detail="API key already configured")
+    keys = save_api_keys(session, zai_client, keys + [request.api_key])
+    return {"status": "added", "id": key_id(request.api_key), "count": len(keys)}
+
+@router.delete("/zai-keys/{id}")
+def delete_zai_key(
+    id: str,
+    session: Session = Depends(get_session),
+    zai_client: ZaiClient = Depends(get_zai_client)
+):
+    keys = load_api_keys(session)
+    remaining = [k for k in keys if key_id(k) != id]
+    if len(remaining) == len(keys):
+        raise HTTPException(status_code=404, detail="API key not found")
+    save_api_keys(session, zai_client, remaining)
+    return {"status": "deleted", "count": len(remaining)}
+
+@router.get("/zai-keys/stats")
+def get_zai_key_stats(zai_client: ZaiClient = Depends(get_zai_client)) -> Dict:
+    """Live per-key load, 429 cooldowns and request/token counters."""
+    return zai_client.pool.stats()
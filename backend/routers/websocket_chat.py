@@ -1,166 +1,297 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from sqlmodel import Session, select
+from sqlmodel import Session
 import json
 import logging
 import asyncio
-import os
-from typing import List, Dict, Any, Tuple
+from contextlib import AsyncExitStack
+from typing import Callable, List, Dict, Any, Optional, Tuple
+from pydantic import BaseModel, Field
 
-from database import get_session
-from models import Agent, AgentMCPServer, MCPServer, AgentKnowledgeFile, ChatSession, ChatMessage
-from dependencies import get_mcp_manager, get_zai_client
+from database import get_session_factory
+from dependencies import get_mcp_manager, get_zai_client, get_token_estimator, get_model_router, get_llm_scheduler, get_chat_limiter, get_tool_pool, get_db_worker, get_loop_monitor, get_write_buffer, get_agent_profiles, get_knowledge_ingestor, get_chat_sessions
 from mcp_manager import MCPManager
 from zai_client import ZaiClient
+from token_budget import TokenEstimator, PromptBudgetExceeded, PromptBudgetReport
+from model_router import ModelRouter, RoutingPolicy, RouteInfo
+from llm_scheduler import LLMScheduler, Priority, AdmissionTimeout
+from adaptive_limiter import AIMDLimiter, QueueTimeout
+from ws_writer import ConnectionWriter
+from ws_protocol import JSON, UnsupportedWireFormat, WireFormat, negotiate
+from db_worker import DBWorker
+from loop_monitor import LoopLagMonitor
+from write_behind import WriteBehindBuffer
+from agent_runtime import AgentProfileCache, AgentRuntimeProfile, compile_agent_profile, load_agent_setup, retrieve_knowledge
+from knowledge_ingest import KnowledgeIngestor
+from session_store import ChatSessionStore, create_chat_session, last_message_id, load_session, memory_settings, store_summary
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1/ws", tags=["WebSocket Chat"])
 
-# Global Semaphore to limit concurrent Active Chats (Queue Manager)
-MAX_CONCURRENT_CHATS = 5
-chat_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHATS)
-
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
+        # Each connection is written by its own task so slow clients never block the upstream stream
+        self.writers: Dict[WebSocket, ConnectionWriter] = {}
+        self.closed_totals = {"tokens_in": 0, "frames_sent": 0, "bytes_sent": 0, "dropped_chars": 0, "overflows": 0}
+        # wire format -> [tokens_in, token_bytes_sent] of closed connections
+        self.closed_by_protocol: Dict[str, List[int]] = {}
+
+    async def connect(self, websocket: WebSocket, wire_format: WireFormat = JSON, subprotocol: Optional[str] = None):
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        writer = ConnectionWriter(websocket, wire_format=wire_format)
+        writer.start()
+        self.writers[websocket] = writer
+
+    async def disconnect(self, websocket: WebSocket):
+        """Flush queued events and forget the connection (safe to call twice)."""
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        writer = self.writers.pop(websocket, None)
+        if writer:
+            await writer.close()
+            for key in self.closed_totals:
+                self.closed_totals[key] += getattr(writer, key)
+            counts = self.closed_by_protocol.setdefault(writer.wire_format.name, [0, 0])
+            counts[0] += writer.tokens_in
+            counts[1] += writer.token_bytes_sent
 
     async def send_json(self, websocket: WebSocket, data: dict):
-        await websocket.send_json(data)
+        # Only queues; raises WebSocketDisconnect if the client is gone or too far behind
+        writer = self.writers.get(websocket)
+        if writer is None:
+            await websocket.send_json(data)
+            return
+        writer.send(data)
+
+    def stats(self) -> Dict[str, Any]:
+        totals = dict(self.closed_totals)
+        for writer in self.writers.values():
+            for key in totals:
+                totals[key] += getattr(writer, key)
+        totals["buffered_chars"] = sum(w.buffered_chars for w in self.writers.values())
+        totals["tokens_per_frame"] = round(totals["tokens_in"] / totals["frames_sent"], 2) if totals["frames_sent"] else None
+        # Token-frame payload bytes per upstream token, by wire format (before permessage-deflate)
+        by_protocol = {name: list(counts) for name, counts in self.closed_by_protocol.items()}
+        for writer in self.writers.values():
+            counts = by_protocol.setdefault(writer.wire_format.name, [0, 0])
+            counts[0] += writer.tokens_in
+            counts[1] += writer.token_bytes_sent
+        totals["protocols"] = {
+            name: {
+                "connections": sum(1 for w in self.writers.values() if w.wire_format.name == name),
+                "tokens_in": tokens,
+                "token_bytes_sent": token_bytes,
+                "bytes_per_token": round(token_bytes / tokens, 2) if tokens else None,
+            }
+            for name, (tokens, token_bytes) in by_protocol.items()
+        }
+        return totals
 
 manager = ConnectionManager()
 
-def save_message(session: Session, chat_session_id: int, role: str, content: str):
-    msg = ChatMessage(chat_session_id=chat_session_id, role=role, content=content)
-    session.add(msg)
-    session.commit()
+class TurnStats(BaseModel):
+    """Token usage, routing and messages for one user turn (all model calls in run_chat_loop)."""
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    budget: Optional[PromptBudgetReport] = None
+    routes: List[RouteInfo] = Field(default_factory=list)
+    # (role, content) rows for the database, written once the turn has succeeded
+    stored: List[Tuple[str, str]] = Field(default_factory=list)
+
+@router.get("/metrics")
+def get_chat_metrics(
+    chat_limiter: AIMDLimiter = Depends(get_chat_limiter),
+    scheduler: LLMScheduler = Depends(get_llm_scheduler),
+    db: DBWorker = Depends(get_db_worker),
+    loop_monitor: LoopLagMonitor = Depends(get_loop_monitor),
+    writes: WriteBehindBuffer = Depends(get_write_buffer),
+    profiles: AgentProfileCache = Depends(get_agent_profiles),
+    ingestor: KnowledgeIngestor = Depends(get_knowledge_ingestor),
+    sessions: ChatSessionStore = Depends(get_chat_sessions)
+):
+    """
+    Adaptive chat concurrency limit, upstream scheduler queues, DB offloading, write batching, event-loop lag,
+    agent profile caching, knowledge ingestion and chat session memory.
+    """
+    return {
+        "active_connections": len(manager.active_connections),
+        "writers": manager.stats(),
+        "chat_limiter": chat_limiter.stats(),
+        "llm_scheduler": scheduler.stats(),
+        "db_worker": db.stats(),
+        "write_behind": writes.stats(),
+        "event_loop": loop_monitor.stats(),
+        "agent_profiles": profiles.stats(),
+        "knowledge_ingest": ingestor.stats(),
+        "chat_sessions": sessions.stats()
+    }
 
 @router.websocket("/chat/{agent_id}")
 async def websocket_endpoint(
     websocket: WebSocket, 
     agent_id: int,
-    session: Session = Depends(get_session),
+    session_id: Optional[int] = None,
+    session_factory: Callable[[], Session] = Depends(get_session_factory),
     mcp_manager: MCPManager = Depends(get_mcp_manager),
-    zai_client: ZaiClient = Depends(get_zai_client)
+    zai_client: ZaiClient = Depends(get_zai_client),
+    estimator: TokenEstimator = Depends(get_token_estimator),
+    router: ModelRouter = Depends(get_model_router),
+    scheduler: LLMScheduler = Depends(get_llm_scheduler),
+    chat_limiter: AIMDLimiter = Depends(get_chat_limiter),
+    tool_pool: asyncio.Semaphore = Depends(get_tool_pool),
+    db: DBWorker = Depends(get_db_worker),
+    writes: WriteBehindBuffer = Depends(get_write_buffer),
+    profiles: AgentProfileCache = Depends(get_agent_profiles),
+    sessions: ChatSessionStore = Depends(get_chat_sessions)
 ):
-    await manager.connect(websocket)
     try:
-        # 1. Load Agent
-        agent = session.get(Agent, agent_id)
-        if not agent:
+        wire_format, subprotocol = negotiate(websocket)
+    except UnsupportedWireFormat as e:
+        await websocket.accept()
+        await websocket.send_json({"type": "error", "content": str(e)})
+        await websocket.close(code=1003)
+        return
+    await manager.connect(websocket, wire_format, subprotocol)
+    try:
+        # 1. Agent profile: system prompt, tools and settings, cached per agent
+        # (on a miss all DB work goes through the worker threads so other sockets keep streaming)
+        async def build_profile(version: int) -> Optional[AgentRuntimeProfile]:
+            setup = await db.run_in_session(session_factory, load_agent_setup, agent_id)
+            return await compile_agent_profile(setup, mcp_manager, version) if setup else None
+
+        profile = await profiles.get(agent_id, build_profile)
+        if not profile:
             await manager.send_json(websocket, {"type": "error", "content": "Agent not found"})
+            await manager.disconnect(websocket)
             await websocket.close()
             return
             
-        # 1.5 Create Chat Session
-        chat_session = ChatSession(agent_id=agent.id)
-        session.add(chat_session)
-        session.commit()
-        session.refresh(chat_session)
-
-        # 2. Inject Knowledge
-        knowledge_files = session.exec(select(AgentKnowledgeFile).where(AgentKnowledgeFile.agent_id == agent.id)).all()
-        injected_context = ""
-        if knowledge_files:
-            injected_context = "\n\n--- Contextual Information ---\n"
-            for k_file in knowledge_files:
-                injected_context += f"File: {k_file.filename}\nContent:\n{k_file.content}\n\n"
-            injected_context += "----------------------------\n\n"
-        
-        final_system_prompt = agent.system_prompt + injected_context
-        
-        # 3. Setup Tools
-        links = session.exec(select(AgentMCPServer).where(AgentMCPServer.agent_id == agent.id)).all()
-        mcp_server_ids = [link.mcp_server_id for link in links]
-        tools = []
-        tool_map = {} 
-
-        for server_id in mcp_server_ids:
-            try:
-                mcp_server_db = session.get(MCPServer, server_id)
-                if mcp_server_db:
-                    status = await mcp_manager.get_mcp_status(str(server_id))
-                    if status.get("status") == "not found":
-                         # Resolve script path
-                         base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                         scripts_dir = os.getenv("MCP_SCRIPTS_DIR", os.path.join(base_dir, "mcp-runtime-scripts"))
-                         full_script_path = os.path.join(scripts_dir, mcp_server_db.script)
-                         
-                         # Parse env_vars
-                         env_vars = {}
-                         if mcp_server_db.env_vars:
-                             try:
-                                 env_vars = json.loads(mcp_server_db.env_vars)
-                             except Exception:
-                                 logger.warning(f"Invalid env_vars for MCP {server_id}")
-
-                         await mcp_manager.spawn_mcp(str(server_id), "python", [full_script_path], env=env_vars)
-                
-                server_tools = await mcp_manager.list_mcp_tools(str(server_id))
-                for tool in server_tools:
-                    tool_def = tool.model_dump(exclude_none=True)
-                    openai_tool = {
-                        "type": "function",
-                        "function": {
-                            "name": tool_def["name"],
-                            "description": tool_def.get("description"),
-                            "parameters": tool_def.get("inputSchema") 
-                        }
-                    }
-                    tools.append(openai_tool)
-                    tool_map[tool_def["name"]] = str(server_id)
-            except Exception as e:
-                logger.warning(f"Error loading tools for server {server_id}: {e}")
-                # Notify client of the error
-                await manager.send_json(websocket, {
-                    "type": "token", 
-                    "content": f"\n\n[System Warning: Failed to load MCP tools for '{mcp_server_db.name if mcp_server_db else server_id}'. Error: {str(e)}]\n\n"
-                })
+        # 1.5 Chat Session: resume ?session_id= (its memory kept in process, else reloaded from its
+        # summary and latest messages) or create one. The history sent with each turn is bounded by
+        # the agent's memory policy: a window of recent turns, older ones folded into a summary in
+        # the background. All DB work runs in short sessions on the worker threads, so an open
+        # socket holds no pooled connection
+        settings = memory_settings(profile, estimator, zai_client, scheduler)
+
+        def summary_saver(chat_session_id: int):
+            return lambda summary, through_id: db.run_in_session(
+                session_factory, store_summary, chat_session_id, summary, through_id
+            )
+
+        if session_id is None:
+            chat_session_id = await db.run_in_session(session_factory, create_chat_session, agent_id)
+            chat = sessions.create(chat_session_id, agent_id, settings, summary_saver(chat_session_id))
+        else:
+            chat_session_id = session_id
+            chat = await sessions.open(
+                session_id, agent_id, settings,
+                lambda: db.run_in_session(session_factory, load_session, session_id, profile.memory, settings[2]),
+                summary_saver(session_id)
+            )
+            if chat is None:
+                await manager.send_json(websocket, {"type": "error", "content": "Chat session not found"})
+                await manager.disconnect(websocket)
+                await websocket.close()
+                return
+
+        # 2-3. Full-mode knowledge is already in the system prompt (retrieved chunks are added
+        # per message); tools that failed to load are reported
+        tools, tool_map = profile.tools, profile.tool_map
+        for warning in profile.warnings:
+            # Notify client of the error
+            await manager.send_json(websocket, {
+                "type": "token", 
+                "content": f"\n\n[System Warning: {warning}]\n\n"
+            })
 
         # 4. Message Loop
-        messages = [{"role": "system", "content": final_system_prompt}]
+        routing = RoutingPolicy(fallback_model=profile.fallback_model, hedge=profile.hedge_enabled)
         
         while True:
             # Wait for user input
             try:
-                data = await websocket.receive_text()
-                # Parse if JSON, else treat as string
-                try:
-                    payload = json.loads(data)
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                # Payload object in the connection's format, else treat as string
+                payload = wire_format.decode(message)
+                if isinstance(payload, dict):
                     user_msg = payload.get("message", "")
                     include_reasoning = payload.get("include_reasoning", True)
-                except:
-                    user_msg = data
+                else:
+                    user_msg = payload
                     include_reasoning = True
                 
-                messages.append({"role": "user", "content": user_msg})
-                save_message(session, chat_session.id, "user", user_msg)
+                # One turn at a time per session, even if another connection resumed it
+                async with chat.lock:
+                    memory = chat.memory
+                    messages = memory.messages()
+                    turn_start = len(messages)
+                    # Chunks already in the prompt aren't sent again
+                    knowledge, chunk_ids = retrieve_knowledge(
+                        profile, user_msg, lambda text: estimator.count_text(text, profile.model), exclude=memory.sent_chunks()
+                    )
+                    if knowledge:
+                        messages.append(knowledge)
+                    messages.append({"role": "user", "content": user_msg})
 
-                # Queue Manager: Acquire Semaphore
-                async with chat_semaphore:
                     # Start Multi-Turn Loop
-                    prompt_tok, compl_tok, total_tok = await run_chat_loop(
-                        websocket, zai_client, mcp_manager, messages, agent.model, tools, tool_map, session, chat_session.id, include_reasoning
+                    try:
+                        stats = await run_chat_loop(
+                            websocket, zai_client, mcp_manager, messages, profile.model, tools, tool_map, include_reasoning,
+                            estimator=estimator, knowledge_context=profile.knowledge_context, budget_tokens=profile.context_budget_tokens,
+                            router=router, routing=routing, tools_key=f"agent:{agent_id}",
+                            scheduler=scheduler, flow=f"agent:{agent_id}",
+                            # LLM slots are held per model call, not across tool execution
+                            limiter=chat_limiter, tool_pool=tool_pool
+                        )
+                    except PromptBudgetExceeded as e:
+                        # The turn isn't kept (in memory or stored), so the user can retry with a shorter message
+                        await manager.send_json(websocket, {"type": "error", "content": str(e), "budget": e.report.model_dump()})
+                        continue
+                    except (QueueTimeout, AdmissionTimeout) as e:
+                        # Saturated: the turn isn't kept, so the user can simply resend it
+                        await manager.send_json(websocket, {"type": "error", "code": "busy", "content": str(e)})
+                        continue
+                
+                    # Store the turn and its token usage, then make it durable before "done"
+                    await writes.add_message(chat_session_id, "user", user_msg)
+                    for role, content in stats.stored:
+                        await writes.add_message(chat_session_id, role, content)
+                    writes.add_usage(
+                        chat_session_id,
+                        prompt_tokens=stats.prompt_tokens,
+                        completion_tokens=stats.completion_tokens,
+                        total_tokens=stats.total_tokens,
+                        cached_prompt_tokens=stats.cached_prompt_tokens
                     )
-                    
-                    # Update Session Token Usage
-                    chat_session.prompt_tokens += prompt_tok
-                    chat_session.completion_tokens += compl_tok
-                    chat_session.total_tokens += total_tok
-                    session.add(chat_session)
-                    session.commit()
-
-                # Send Done signal for this turn
-                await manager.send_json(websocket, {"type": "done", "tokens": {"prompt": prompt_tok, "completion": compl_tok, "total": total_tok}})
+                    # The turn's last stored message marks how far a summary of it reaches
+                    last_id = None
+                    if await writes.flush():
+                        last_id = await db.run_in_session(session_factory, last_message_id, chat_session_id)
+                    memory.add_turn(messages[turn_start:], chunk_ids, last_id)
+
+                    # Send Done signal for this turn
+                    await manager.send_json(websocket, {
+                        "type": "done",
+                        "tokens": {
+                            "prompt": stats.prompt_tokens,
+                            "completion": stats.completion_tokens,
+                            "total": stats.total_tokens,
+                            "cached": stats.cached_prompt_tokens
+                        },
+                        "budget": stats.budget.model_dump() if stats.budget else None,
+                        "routes": [route.model_dump() for route in stats.routes],
+                        "session_id": chat_session_id
+                    })
 
             except WebSocketDisconnect:
-                manager.disconnect(websocket)
+                await manager.disconnect(websocket)
                 break
             except Exception as e:
                 logger.error(f"WS Error: {e}")
@@ -169,7 +300,10 @@ async def websocket_endpoint(
 
     except Exception as e:
          logger.error(f"Critical WS Error: {e}")
-         await manager.disconnect(websocket)
+    finally:
+        # Deliver anything still queued (e.g. a final error) before the socket closes.
+        # The session's memory stays in the store for a reconnect
+        await manager.disconnect(websocket)
 
 
 async def run_chat_loop(
@@ -180,24 +314,44 @@ async def run_chat_loop(
     model: str, 
     tools: List[Dict], 
     tool_map: Dict,
-    session: Session,
-    chat_session_id: int,
-    include_reasoning: bool = True
-) -> Tuple[int, int, int]:
+    include_reasoning: bool = True,
+    estimator: Optional[TokenEstimator] = None,
+    knowledge_context: str = "",
+    budget_tokens: Optional[int] = None,
+    router: Optional[ModelRouter] = None,
+    routing: Optional[RoutingPolicy] = None,
+    tools_key: Optional[str] = None,
+    scheduler: Optional[LLMScheduler] = None,
+    flow: str = "default",
+    limiter: Optional[AIMDLimiter] = None,
+    tool_pool: Optional[asyncio.Semaphore] = None
+) -> TurnStats:
     max_turns = 5
     
-    total_prompt_tokens = 0
-    total_completion_tokens = 0
-    total_tokens_sum = 0
+    stats = TurnStats()
+
+    async def notify_queued(position: int, eta_ms: Optional[int]):
+        await manager.send_json(websocket, {"type": "queued", "position": position, "eta_ms": eta_ms})
 
     for turn in range(max_turns):
+        # Check the prompt fits the agent's context budget before sending it
+        if estimator:
+            stats.budget = estimator.check(
+                messages, tools, model=model, knowledge_context=knowledge_context, budget=budget_tokens
+            )
+
         # Stream response from Z.ai
-        stream = zai_client.chat_stream(
-            messages=messages,
-            model=model,
-            tools=tools if tools else None,
-            stream_options={"include_usage": True} 
-        )
+        def open_stream(stream_model: str):
+            # Fail fast on the primary when a fallback model can take over
+            fail_fast = routing is not None and routing.fallback_model and stream_model != routing.fallback_model
+            return zai_client.stream_deltas(
+                messages=messages,
+                model=stream_model,
+                tools=tools if tools else None,
+                tools_key=tools_key,
+                stream_options={"include_usage": True},
+                max_retries=0 if fail_fast else None
+            )
 
         current_content = ""
         tool_calls = []
@@ -206,60 +360,76 @@ async def run_chat_loop(
         # Usage tracking for this turn
         turn_usage = None
 
-        async for chunk in stream:
-            # Check for usage field first
-            if hasattr(chunk, "usage") and chunk.usage:
-                turn_usage = chunk.usage
-
-            if not chunk.choices:
-                continue
-
-            delta = chunk.choices[0].delta
-            
-            # Handle Content
-            response_text = delta.content
-            if include_reasoning and not response_text and hasattr(delta, "reasoning_content") and delta.reasoning_content:
-                response_text = delta.reasoning_content
-
-            if response_text:
-                current_content += response_text
-                await manager.send_json(websocket, {"type": "token", "content": response_text})
-
-            # Handle Tool Calls
-            if delta.tool_calls:
-                for tc_delta in delta.tool_calls:
-                    if tc_delta.id:
-                        # New Tool Call starting
-                        if current_tool_call:
-                            tool_calls.append(current_tool_call)
+        # Hold the chat slot and an upstream slot only while the model is streaming;
+        # they are released before tools run and re-acquired for the next model call
+        async with AsyncExitStack() as admission:
+            slot = None
+            if limiter:
+                slot = await admission.enter_async_context(limiter.slot(flow=flow, on_queued=notify_queued))
+            if scheduler:
+                await admission.enter_async_context(scheduler.slot(Priority.INTERACTIVE, flow=flow))
+            # Overloads the router fails over from still count against the chat limit
+            on_failure = slot.failed if slot else None
+            stream = router.stream(open_stream, model, routing, on_failure=on_failure) if router else open_stream(model)
+            # Each item is a StreamDelta tuple: (content, reasoning, tool_calls, usage)
+            async for content, reasoning, tc_deltas, usage in stream:
+                if usage:
+                    turn_usage = usage
+
+                # Handle Content
+                response_text = content
+                if include_reasoning and not response_text and reasoning:
+                    response_text = reasoning
+
+                if response_text:
+                    current_content += response_text
+                    await manager.send_json(websocket, {"type": "token", "content": response_text})
+
+                # Handle Tool Calls (raw OpenAI tool_call delta dicts)
+                if tc_deltas:
+                    for tc_delta in tc_deltas:
+                        function = tc_delta.get("function") or {}
+                        if tc_delta.get("id"):
+                            # New Tool Call starting
+                            if current_tool_call:
+                                tool_calls.append(current_tool_call)
                         
-                        current_tool_call = {
-                            "id": tc_delta.id,
-                            "function": {
-                                "name": tc_delta.function.name,
-                                "arguments": ""
-                            },
-                            "type": "function"
-                        }
+                            current_tool_call = {
+                                "id": tc_delta["id"],
+                                "function": {
+                                    "name": function.get("name"),
+                                    "arguments": ""
+                                },
+                                "type": "function"
+                            }
                     
-                    if current_tool_call and tc_delta.function.arguments:
-                        current_tool_call["function"]["arguments"] += tc_delta.function.arguments
+                        if current_tool_call and function.get("arguments"):
+                            current_tool_call["function"]["arguments"] += function["arguments"]
 
         # Append last tool call if any
         if current_tool_call:
             tool_calls.append(current_tool_call)
 
+        served_model = model
+        if router and stream.route:
+            stats.routes.append(stream.route)
+            served_model = stream.route.model
+
         # Accumulate Tokens
         if turn_usage:
-            total_prompt_tokens += turn_usage.prompt_tokens
-            total_completion_tokens += turn_usage.completion_tokens
-            total_tokens_sum += turn_usage.total_tokens
+            stats.prompt_tokens += turn_usage.get("prompt_tokens") or 0
+            stats.completion_tokens += turn_usage.get("completion_tokens") or 0
+            stats.total_tokens += turn_usage.get("total_tokens") or 0
+            # Prompt tokens served from the upstream prefix cache
+            stats.cached_prompt_tokens += (turn_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+            if estimator and stats.budget:
+                estimator.observe(served_model, stats.budget.total, turn_usage.get("prompt_tokens") or 0)
 
         # Construct the assistant message for history
         assistant_msg = {"role": "assistant"}
         if current_content:
             assistant_msg["content"] = current_content
-            save_message(session, chat_session_id, "assistant", current_content)
+            stats.stored.append(("assistant", current_content))
             
         if tool_calls:
             assistant_msg["tool_calls"] = tool_calls
@@ -271,7 +441,7 @@ async def run_chat_loop(
 
         # If no tools called, we are done with this turn loop (wait for user)
         if not tool_calls:
-            return total_prompt_tokens, total_completion_tokens, total_tokens_sum
+            return stats
 
         # Execute Tools
         for tool_call in tool_calls:
@@ -287,8 +457,9 @@ async def run_chat_loop(
                     args = json.loads(args_str)
                     server_id = tool_map[fn_name]
                     
-                    # Call MCP
-                    result = await mcp_manager.call_mcp_tool(server_id, fn_name, args)
+                    # Call MCP (tool work has its own pool, separate from LLM slots)
+                    async with tool_pool if tool_pool else AsyncExitStack():
+                        result = await mcp_manager.call_mcp_tool(server_id, fn_name, args)
                     
                     # Format result
                     if isinstance(result, list):
@@ -311,8 +482,8 @@ async def run_chat_loop(
                 "tool_call_id": call_id,
                 "content": result_content
             })
-            save_message(session, chat_session_id, "tool", f"Tool: {fn_name}\nResult: {result_content}")
+            stats.stored.append(("tool", f"Tool: {fn_name}\nResult: {result_content}"))
         
         # Loop continues to next turn to let AI process tool results
         
-    return total_prompt_tokens, total_completion_tokens, total_tokens_sum
+    return stats
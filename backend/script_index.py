@@ -0,0 +1,62 @@
+import os
+from typing import Dict, Optional, Set
+
+from agent_runtime import mcp_scripts_dir
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ScriptIndex:
+    """
+    The set of files under the MCP scripts directory, rescanned only when the
+    mtime of one of its directories changes (creating, deleting or renaming a
+    file updates the mtime of the directory holding it). Answers "does this
+    server's script exist?" for a whole listing with one stat per directory
+    instead of one per server.
+
+    With no `directory`, MCP_SCRIPTS_DIR is resolved on every refresh, as
+    mcp_scripts_dir() does elsewhere.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self._directory = directory
+        self._root: Optional[str] = None
+        self._mtimes: Dict[str, Optional[int]] = {}
+        self._files: Set[str] = set()
+        self.scans = 0
+
+    def invalidate(self):
+        """Rescan on the next refresh (after writing into the directory, in case mtimes are coarse)."""
+        self._root = None
+
+    def refresh(self):
+        """Rescan if the directory moved or any of its directories changed."""
+        root = self._directory or mcp_scripts_dir()
+        if root == self._root and all(_mtime(path) == mtime for path, mtime in self._mtimes.items()):
+            return
+        files: Set[str] = set()
+        mtimes: Dict[str, Optional[int]] = {root: _mtime(root)}
+        for dirpath, _, filenames in os.walk(root):
+            mtimes[dirpath] = _mtime(dirpath)
+            rel = os.path.relpath(dirpath, root)
+            files.update(os.path.normpath(os.path.join(rel, name)) for name in filenames)
+        self._root, self._mtimes, self._files = root, mtimes, files
+        self.scans += 1
+
+    def exists(self, script: str) -> bool:
+        """
+        Whether `script` (relative to the scripts directory, subdirectories
+        allowed) existed at the last refresh().
+        """
+        if self._root is None:
+            self.refresh()
+        relative = os.path.normpath(script)
+        if os.path.isabs(relative) or relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            # Outside the indexed tree
+            return os.path.exists(os.path.join(self._root, script))
+        return relative in self._files
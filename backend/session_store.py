@@ -0,0 +1,269 @@
+"""
+Chat sessions that outlive a connection.
+
+A WebSocket reconnecting with ?session_id= or a REST call sending session_id
+continues an existing conversation. Recently used sessions are kept hot: an LRU
+of their live ChatMemory, so resuming costs nothing. Any other session is
+rebuilt from the database on first use: the rolling summary stored on its
+ChatSession, then only the newest ChatMessage rows after it that the memory
+window can use, read back a page at a time. The full history is never loaded.
+
+Tool calls aren't stored structurally (only "Tool: name\\nResult: ..." text),
+so a reloaded tool result is replayed to the model as assistant text.
+"""
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlmodel import Session, func, select, update
+
+from agent_runtime import AgentRuntimeProfile, load_chat_history
+from chat_memory import ChatMemory, MemoryPolicy, Summarizer, SummarySaver, summarizer
+from llm_scheduler import LLMScheduler
+from models import ChatMessage, ChatSession
+from token_budget import TokenEstimator
+from zai_client import ZaiClient
+
+# Sessions whose memory is kept in process; the least recently used are reloaded on demand
+CHAT_SESSION_CACHE_SIZE = int(os.getenv("CHAT_SESSION_CACHE_SIZE", 1000))
+# Messages read per query when loading a session's recent history
+HISTORY_PAGE = 50
+
+# ChatMemory.configure() arguments: system prompt, policy, message counter, summarizer
+MemorySettings = Tuple[str, MemoryPolicy, Callable[[Dict[str, Any]], int], Summarizer]
+
+
+class StoredTurn(NamedTuple):
+    messages: List[Dict[str, Any]]
+    last_message_id: int
+
+
+class StoredSession(NamedTuple):
+    """What a ChatMemory needs to resume a session: its summary and latest turns, oldest first."""
+
+    agent_id: int
+    summary: str
+    turns: List[StoredTurn]
+
+
+def memory_settings(
+    profile: AgentRuntimeProfile, estimator: TokenEstimator, zai_client: ZaiClient, scheduler: LLMScheduler
+) -> MemorySettings:
+    """A session memory's settings for the agent's current profile."""
+    return (
+        profile.system_prompt,
+        profile.memory,
+        lambda message: estimator.count_message(message, profile.model),
+        summarizer(zai_client, scheduler, profile.memory.summary_model, flow=f"agent:{profile.agent_id}")
+    )
+
+
+# Blocking DB helpers, run on the DB worker (or a request's session)
+
+def create_chat_session(session: Session, agent_id: int) -> int:
+    chat_session = ChatSession(agent_id=agent_id)
+    session.add(chat_session)
+    session.commit()
+    return chat_session.id
+
+
+def last_message_id(session: Session, chat_session_id: int) -> Optional[int]:
+    return session.exec(
+        select(func.max(ChatMessage.id)).where(ChatMessage.chat_session_id == chat_session_id)
+    ).one()
+
+
+def store_messages(session: Session, chat_session_id: int, messages: List[Tuple[str, str]]) -> Optional[int]:
+    """Append (role, content) messages to a session and commit; the id of the last one."""
+    rows = [ChatMessage(chat_session_id=chat_session_id, role=role, content=content) for role, content in messages]
+    session.add_all(rows)
+    session.flush()
+    last_id = rows[-1].id if rows else None
+    session.commit()
+    return last_id
+
+
+def store_summary(session: Session, chat_session_id: int, summary: str, through_id: int):
+    """Save a session's summary unless a newer one (covering more messages) is already stored."""
+    session.exec(
+        update(ChatSession)
+        .where(ChatSession.id == chat_session_id)
+        .where((ChatSession.summary_through_id.is_(None)) | (ChatSession.summary_through_id < through_id))
+        .values(memory_summary=summary, summary_through_id=through_id)
+    )
+    session.commit()
+
+
+def stored_message(message: ChatMessage) -> Dict[str, Any]:
+    """A stored message as sent to the model."""
+    role = "assistant" if message.role == "tool" else message.role
+    return {"role": role, "content": message.content}
+
+
+def load_session(
+    session: Session, chat_session_id: int, policy: MemoryPolicy, count_message: Callable[[Dict[str, Any]], int]
+) -> Optional[StoredSession]:
+    """
+    The session's summary and the whole turns stored after it, newest first
+    until they fill the policy's window plus (with a summary model) a window of
+    evicted turns to fold into the summary; the last `pinned_turns` are always
+    included. None if the session doesn't exist.
+    """
+    chat_session = session.get(ChatSession, chat_session_id)
+    if chat_session is None:
+        return None
+    max_tokens = None
+    if policy.window_tokens > 0:
+        max_tokens = policy.window_tokens * (2 if policy.summary_model else 1)
+
+    turns: List[StoredTurn] = []
+    tokens = 0
+    # Messages of the turn being read, newest first; a turn starts at its user message
+    current: List[ChatMessage] = []
+    before_id = None
+    full = False
+    while not full:
+        page = load_chat_history(
+            session, chat_session_id, HISTORY_PAGE, after_id=chat_session.summary_through_id, before_id=before_id
+        )
+        for message in reversed(page):
+            current.append(message)
+            if message.role != "user":
+                continue
+            turn = [stored_message(m) for m in reversed(current)]
+            turn_tokens = sum(count_message(m) for m in turn)
+            if max_tokens is not None and len(turns) >= max(policy.pinned_turns, 1) and tokens + turn_tokens > max_tokens:
+                full = True
+                break
+            turns.append(StoredTurn(turn, current[0].id))
+            tokens += turn_tokens
+            current = []
+        if len(page) < HISTORY_PAGE:
+            break
+        before_id = page[0].id
+    turns.reverse()
+    return StoredSession(chat_session.agent_id, chat_session.memory_summary or "", turns)
+
+
+class HotSession:
+    """A session's live memory. Hold `lock` for a whole turn so turns from two connections don't interleave."""
+
+    def __init__(self, chat_session_id: int, agent_id: int, memory: ChatMemory):
+        self.chat_session_id = chat_session_id
+        self.agent_id = agent_id
+        self.memory = memory
+        self.lock = asyncio.Lock()
+
+
+class ChatSessionStore:
+    """
+    The hot tier: live memories of the `max_sessions` most recently used chat
+    sessions. Evicting one only drops it from process memory (a summary in
+    progress still lands and is saved); its next use reloads it via
+    load_session().
+    """
+
+    def __init__(self, max_sessions: int = CHAT_SESSION_CACHE_SIZE):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[int, HotSession]" = OrderedDict()
+        # chat_session_id -> load in progress, shared by concurrent opens
+        self._loads: Dict[int, asyncio.Future] = {}
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.loaded_turns = 0
+        self.evictions = 0
+
+    def create(
+        self, chat_session_id: int, agent_id: int, settings: MemorySettings, save_summary: Optional[SummarySaver] = None
+    ) -> HotSession:
+        """Start the memory of a new session."""
+        return self._add(HotSession(chat_session_id, agent_id, ChatMemory(*settings, save_summary=save_summary)))
+
+    async def open(
+        self,
+        chat_session_id: int,
+        agent_id: int,
+        settings: MemorySettings,
+        load: Callable[[], Awaitable[Optional[StoredSession]]],
+        save_summary: Optional[SummarySaver] = None
+    ) -> Optional[HotSession]:
+        """
+        An existing session, with its memory set up for the agent's current
+        profile; on a miss restored from load(). None if the session doesn't
+        exist or belongs to another agent.
+        """
+        hot = self._sessions.get(chat_session_id)
+        if hot is not None:
+            self._sessions.move_to_end(chat_session_id)
+            self.hits += 1
+        else:
+            self.misses += 1
+            pending = self._loads.get(chat_session_id)
+            if pending is not None:
+                await asyncio.wait({pending})
+            if pending is not None and not pending.cancelled():
+                hot = pending.result()
+            else:
+                # No load running, or the shared one failed: load here so the error reaches this caller too
+                hot = await self._load(chat_session_id, agent_id, settings, load, save_summary)
+        if hot is None or hot.agent_id != agent_id:
+            return None
+        hot.memory.configure(*settings)
+        return hot
+
+    async def _load(
+        self,
+        chat_session_id: int,
+        agent_id: int,
+        settings: MemorySettings,
+        load: Callable[[], Awaitable[Optional[StoredSession]]],
+        save_summary: Optional[SummarySaver]
+    ) -> Optional[HotSession]:
+        future = asyncio.get_running_loop().create_future()
+        self._loads[chat_session_id] = future
+        try:
+            stored = await load()
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            if self._loads.get(chat_session_id) is future:
+                del self._loads[chat_session_id]
+        hot = None
+        # The memory is set up for the requesting agent, so another agent's session isn't kept
+        if stored is not None and stored.agent_id == agent_id:
+            memory = ChatMemory(*settings, save_summary=save_summary)
+            memory.restore(stored.summary, [(turn.messages, turn.last_message_id) for turn in stored.turns])
+            self.loads += 1
+            self.loaded_turns += len(stored.turns)
+            hot = self._add(HotSession(chat_session_id, agent_id, memory))
+        future.set_result(hot)
+        return hot
+
+    def _add(self, hot: HotSession) -> HotSession:
+        self._sessions[hot.chat_session_id] = hot
+        self._sessions.move_to_end(hot.chat_session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+        return hot
+
+    def close(self):
+        """Cancel summaries still in progress (on shutdown)."""
+        for hot in self._sessions.values():
+            hot.memory.close()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "loads": self.loads,
+            "loaded_turns": self.loaded_turns,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,309 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from openai import RateLimitError
+from unittest.mock import MagicMock, AsyncMock
+from mcp.types import Tool, TextContent
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session, get_session_factory
+from dependencies import get_mcp_manager, get_zai_client, get_llm_scheduler, get_chat_limiter, get_tool_pool, get_write_buffer
+from models import Agent, AgentMCPServer, MCPServer
+from db_worker import DBWorker
+from write_behind import WriteBehindBuffer
+from fake_zai_server import create_app, FakeZaiConfig, ScriptedToolCall
+from adaptive_limiter import AIMDLimiter, QueueTimeout
+from llm_scheduler import LLMScheduler
+from zai_client import ZaiClient
+
+
+def rate_limit_error():
+    response = httpx.Response(429, request=httpx.Request("POST", "http://fake-zai/chat/completions"))
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+@pytest.mark.asyncio
+async def test_limit_grows_additively_while_healthy():
+    limiter = AIMDLimiter(initial=2, floor=1, ceiling=4)
+    for _ in range(20):
+        async with limiter.slot():
+            pass
+    assert limiter.limit == 4  # capped at the ceiling
+    assert limiter.stats()["increases"] == 2
+
+
+@pytest.mark.asyncio
+async def test_overload_halves_the_limit_once_per_window():
+    limiter = AIMDLimiter(initial=8, floor=2, ceiling=16)
+
+    async def failing_call():
+        async with limiter.slot():
+            await asyncio.sleep(0.01)
+            raise rate_limit_error()
+
+    # A burst of concurrent 429s only backs off once
+    results = await asyncio.gather(*(failing_call() for _ in range(4)), return_exceptions=True)
+    assert all(isinstance(r, RateLimitError) for r in results)
+    assert limiter.limit == 4
+    assert limiter.stats()["overloads"] == 4
+
+    for _ in range(3):
+        with pytest.raises(RateLimitError):
+            await failing_call()
+    assert limiter.limit == 2  # never below the floor
+
+    # Unrelated errors are not a congestion signal
+    with pytest.raises(ValueError):
+        async with limiter.slot():
+            raise ValueError("bad tool arguments")
+    assert limiter.limit == 2
+
+
+@pytest.mark.asyncio
+async def test_slow_calls_hold_the_limit():
+    limiter = AIMDLimiter(initial=1, floor=1, ceiling=8, latency_tolerance=2.0)
+    async with limiter.slot():
+        await asyncio.sleep(0.01)
+    for _ in range(3):
+        async with limiter.slot():
+            await asyncio.sleep(0.05)
+    assert limiter.limit == 2  # only the first, fast call counted
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_admitted_in_order_and_queue_is_reported():
+    limiter = AIMDLimiter(initial=1, floor=1, ceiling=1)
+    await limiter.acquire()
+    order = []
+
+    async def waiter(i):
+        await limiter.acquire()
+        order.append(i)
+        limiter.release()
+
+    tasks = [asyncio.create_task(waiter(i)) for i in range(3)]
+    await asyncio.sleep(0)
+    assert limiter.stats()["queued"] == 3
+    limiter.release()
+    await asyncio.gather(*tasks)
+    assert order == [0, 1, 2]
+    assert limiter.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_agents_are_served_round_robin_with_positions():
+    limiter = AIMDLimiter(initial=1, floor=1, ceiling=1)
+    await limiter.acquire()
+    order = []
+    positions = {}
+
+    async def waiter(label, flow):
+        async def on_queued(position, eta_ms):
+            positions.setdefault(label, []).append(position)
+
+        await limiter.acquire(flow, on_queued)
+        order.append(label)
+        await asyncio.sleep(0)
+        limiter.release()
+
+    tasks = []
+    for label, flow in [("a1", "agent:1"), ("a2", "agent:1"), ("a3", "agent:1"), ("b1", "agent:2")]:
+        tasks.append(asyncio.create_task(waiter(label, flow)))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    limiter.release()
+    await asyncio.gather(*tasks)
+
+    # agent:2 arrived last but doesn't wait behind agent:1's whole backlog
+    assert order == ["a1", "b1", "a2", "a3"]
+    assert positions["a1"] == [1]
+
+
+@pytest.mark.asyncio
+async def test_position_and_eta_follow_round_robin_order():
+    limiter = AIMDLimiter(initial=1, floor=1, ceiling=1)
+    limiter.on_success(2.0)  # recent calls take ~2s
+    await limiter.acquire()
+    seen = {}
+
+    async def waiter(label, flow):
+        async def on_queued(position, eta_ms):
+            seen.setdefault(label, (position, eta_ms))
+
+        await limiter.acquire(flow, on_queued)
+
+    tasks = []
+    for label, flow in [("a1", "agent:1"), ("a2", "agent:1"), ("a3", "agent:1"), ("b1", "agent:2")]:
+        tasks.append(asyncio.create_task(waiter(label, flow)))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    live = {label: limiter.position(w) for label, w in zip(["a1", "a2", "a3"], limiter._queues["agent:1"])}
+    live["b1"] = limiter.position(limiter._queues["agent:2"][0])
+    assert live == {"a1": 1, "b1": 2, "a2": 3, "a3": 4}
+    assert seen["a2"] == (2, 4000)  # b1 had not arrived yet when a2 queued
+    assert seen["b1"] == (2, 4000)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert limiter.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_wait_is_capped():
+    limiter = AIMDLimiter(initial=1, floor=1, ceiling=1, max_queue_wait=0.1)
+    await limiter.acquire()
+    with pytest.raises(QueueTimeout):
+        await limiter.acquire()
+    assert limiter.stats()["busy_rejections"] == 1
+    assert limiter.queued == 0
+    limiter.release()
+    await asyncio.wait_for(limiter.acquire(), 1)
+
+
+def test_metrics_endpoint_reports_limit_and_queues():
+    metrics = TestClient(app).get("/api/v1/ws/metrics").json()
+    assert {"limit", "floor", "ceiling", "in_flight", "queued"} <= set(metrics["chat_limiter"])
+    assert metrics["llm_scheduler"]["capacity"] > 0
+
+
+def test_llm_slots_are_released_while_tools_run():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+    agent = Agent(name="Calc", system_prompt="You add numbers.", model="glm-4.5-flash")
+    server = MCPServer(name="calc", script="calc.py")
+    session.add_all([agent, server])
+    session.commit()
+    session.add(AgentMCPServer(agent_id=agent.id, mcp_server_id=server.id))
+    session.commit()
+
+    limiter = AIMDLimiter(initial=1, floor=1, ceiling=1)
+    scheduler = LLMScheduler(capacity=1)
+    tool_pool = asyncio.Semaphore(1)
+    seen = {}
+
+    async def call_tool(server_id, name, args):
+        seen.update(limiter=limiter.in_flight, scheduler=scheduler.in_flight, tool_pool_locked=tool_pool.locked())
+        return [TextContent(type="text", text="3")]
+
+    mcp_manager = MagicMock()
+    mcp_manager.get_mcp_status = AsyncMock(return_value={"status": "active"})
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[Tool(name="add", inputSchema={"type": "object"})])
+    mcp_manager.call_mcp_tool = AsyncMock(side_effect=call_tool)
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2, tool_calls=[ScriptedToolCall(name="add", arguments={"a": 1})]))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_llm_scheduler] = lambda: scheduler
+    app.dependency_overrides[get_chat_limiter] = lambda: limiter
+    app.dependency_overrides[get_tool_pool] = lambda: tool_pool
+    try:
+        client = TestClient(app)
+        with client.websocket_connect(f"/api/v1/ws/chat/{agent.id}") as websocket:
+            websocket.send_json({"message": "add"})
+            while websocket.receive_json()["type"] not in ("done", "error"):
+                pass
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+
+    assert seen == {"limiter": 0, "scheduler": 0, "tool_pool_locked": True}
+    # Both model calls (before and after the tool) went through the limiter
+    assert limiter.successes == 2
+    assert limiter.in_flight == 0 and scheduler.in_flight == 0
+
+
+def test_websocket_reports_queue_position_then_busy():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+    agent = Agent(name="Busy", system_prompt="Be brief.", model="glm-4.5-flash")
+    session.add(agent)
+    session.commit()
+
+    mcp_manager = MagicMock()
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    limiter = AIMDLimiter(initial=1, floor=1, ceiling=1, max_queue_wait=0.3)
+    limiter.in_flight = 1  # another chat holds the only slot
+
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_chat_limiter] = lambda: limiter
+    try:
+        client = TestClient(app)
+        with client.websocket_connect(f"/api/v1/ws/chat/{agent.id}") as websocket:
+            websocket.send_json({"message": "hi"})
+            assert websocket.receive_json() == {"type": "queued", "position": 1, "eta_ms": None}
+            busy = websocket.receive_json()
+            assert (busy["type"], busy["code"]) == ("error", "busy")
+
+            # The connection survives; once the slot frees up the resent message goes through
+            limiter.in_flight = 0
+            websocket.send_json({"message": "hi"})
+            events = []
+            while not events or events[-1]["type"] not in ("done", "error"):
+                events.append(websocket.receive_json())
+            assert events[-1]["type"] == "done"
+            assert "".join(e["content"] for e in events if e["type"] == "token") == "token0 token1 "
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+    assert fake.state.stats.requests == 1
+
+
+def test_overload_the_router_fails_over_from_shrinks_the_limit():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+    agent = Agent(name="Routed", system_prompt="Be brief.", model="glm-4.6", fallback_model="glm-4.5-flash")
+    session.add(agent)
+    session.commit()
+
+    mcp_manager = MagicMock()
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    # The primary model is always rate limited; the fallback answers
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2, rate_limit_models=["glm-4.6"]))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    limiter = AIMDLimiter(initial=8, floor=1, ceiling=8)
+
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_chat_limiter] = lambda: limiter
+    try:
+        client = TestClient(app)
+        with client.websocket_connect(f"/api/v1/ws/chat/{agent.id}") as websocket:
+            websocket.send_json({"message": "hi"})
+            events = []
+            while not events or events[-1]["type"] not in ("done", "error"):
+                events.append(websocket.receive_json())
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+
+    # The turn succeeded on the fallback, but the primary's 429 still backed the limit off
+    assert events[-1]["type"] == "done" and events[-1]["routes"][0]["kind"] == "fallback"
+    assert limiter.overloads == 1 and limiter.limit == 4
@@ -0,0 +1,134 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session
+from models import Agent, AgentMCPServer, MCPServer
+
+
+@pytest.fixture(name="engine")
+def engine_fixture():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    saved_overrides = dict(app.dependency_overrides)
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_session_override
+    yield engine
+    app.dependency_overrides.clear()
+    app.dependency_overrides.update(saved_overrides)
+
+
+def seed(engine, agents: int, servers: int = 3):
+    """Agent i is linked to the first i % (servers + 1) servers."""
+    with Session(engine) as session:
+        mcp_servers = [MCPServer(name=f"mcp-{i}", script="s.py") for i in range(servers)]
+        rows = [Agent(name=f"agent-{i}", system_prompt="Be brief.", model="glm-4.5-flash") for i in range(agents)]
+        session.add_all(mcp_servers + rows)
+        session.commit()
+        for i, agent in enumerate(rows):
+            for server in reversed(mcp_servers[:i % (servers + 1)]):
+                session.add(AgentMCPServer(agent_id=agent.id, mcp_server_id=server.id))
+        session.commit()
+        return [server.id for server in mcp_servers]
+
+
+def recorded_selects(engine, fn):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        result = fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return statements, result
+
+
+def test_statement_count_does_not_grow_with_agents(engine):
+    client = TestClient(app)
+    seed(engine, 3)
+    few, response = recorded_selects(engine, lambda: client.get("/api/v1/agents/"))
+    assert len(response.json()) == 3
+
+    seed(engine, 200)
+    many, response = recorded_selects(engine, lambda: client.get("/api/v1/agents/"))
+    assert len(response.json()) == 203
+    assert len(few) == len(many) == 1
+
+
+def test_listing_shape_and_linked_ids(engine):
+    server_ids = seed(engine, 5)
+    agents = TestClient(app).get("/api/v1/agents/").json()
+
+    assert [a["linked_mcp_count"] for a in agents] == [0, 1, 2, 3, 0]
+    assert agents[3]["linked_mcp_ids"] == sorted(server_ids)
+    assert agents[0] == {
+        "id": agents[0]["id"], "name": "agent-0", "system_prompt": "Be brief.", "model": "glm-4.5-flash",
+        "reasoning_enabled": True, "context_budget_tokens": None, "fallback_model": None, "hedge_enabled": False,
+        "knowledge_mode": None, "memory_window_tokens": None, "memory_pinned_turns": None, "memory_summary_model": None,
+        "linked_mcp_ids": [], "linked_mcp_count": 0,
+    }
+
+
+def test_keyset_pagination_walks_every_agent_once(engine):
+    seed(engine, 7)
+    client = TestClient(app)
+    everything = [a["id"] for a in client.get("/api/v1/agents/").json()]
+
+    seen, after = [], None
+    while True:
+        params = {"limit": 3} if after is None else {"limit": 3, "after": after}
+        response = client.get("/api/v1/agents/", params=params)
+        assert response.status_code == 200
+        seen += [a["id"] for a in response.json()]
+        after = response.headers.get("X-Next-Cursor")
+        if after is None:
+            break
+    assert seen == everything
+    assert client.get("/api/v1/agents/", params={"limit": 0}).status_code == 422
+
+
+def test_field_selection(engine):
+    seed(engine, 3)
+    client = TestClient(app)
+
+    agents = client.get("/api/v1/agents/", params={"fields": "name,linked_mcp_count"}).json()
+    assert [sorted(a) for a in agents] == [["id", "linked_mcp_count", "name"]] * 3
+    assert [a["linked_mcp_count"] for a in agents] == [0, 1, 2]
+
+    # Without link fields the MCP links aren't joined at all
+    statements, response = recorded_selects(engine, lambda: client.get("/api/v1/agents/", params={"fields": "id"}))
+    assert [sorted(a) for a in response.json()] == [["id"]] * 3
+    assert "zairag_agent_mcp_links" not in statements[0]
+
+    response = client.get("/api/v1/agents/", params={"fields": "name,secret"})
+    assert response.status_code == 400 and "secret" in response.json()["detail"]
+
+
+def test_etag_revalidation(engine):
+    seed(engine, 3)
+    client = TestClient(app)
+
+    first = client.get("/api/v1/agents/")
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "no-cache"
+
+    unchanged = client.get("/api/v1/agents/", headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304 and unchanged.content == b""
+    assert unchanged.headers["ETag"] == etag
+
+    agent_id = first.json()[0]["id"]
+    client.put(f"/api/v1/agents/{agent_id}", json={"name": "renamed"})
+    changed = client.get("/api/v1/agents/", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert changed.json()[0]["name"] == "renamed"
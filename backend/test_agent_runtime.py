@@ -0,0 +1,192 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock, AsyncMock
+from mcp.types import Tool
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from agent_runtime import (
+    AgentProfileCache, build_knowledge_context, build_system_prompt, compile_agent_profile, load_agent_setup,
+    load_agent_tools, load_knowledge_files
+)
+from database import get_session, get_session_factory
+from db_worker import DBWorker
+from dependencies import get_agent_profiles, get_mcp_manager, get_write_buffer, get_zai_client
+from fake_zai_server import FakeZaiConfig
+from knowledge_store import add_knowledge_text, load_blob_contents
+from main import app
+from models import Agent, AgentMCPServer, MCPServer
+from test_fake_zai_server import make_client
+from write_behind import WriteBehindBuffer
+
+
+@pytest.fixture(name="session")
+def session_fixture():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_prompt_is_byte_stable_regardless_of_upload_order(session):
+    agent = Agent(name="Docs", system_prompt="You answer from the docs.", model="glm-4.5-flash")
+    session.add(agent)
+    session.commit()
+    for name in ("zeta.md", "alpha.md", "mid.md"):
+        add_knowledge_text(session, agent.id, name, f"content of {name}")
+    session.commit()
+
+    files = load_knowledge_files(session, agent.id)
+    contents = load_blob_contents(session, [f.blob_sha256 for f in files])
+    prompt = build_system_prompt(agent, build_knowledge_context(files, contents))
+    assert prompt == build_system_prompt(agent, build_knowledge_context(list(reversed(files)), contents))
+    assert "content of alpha.md" in prompt
+    assert prompt.index("alpha.md") < prompt.index("mid.md") < prompt.index("zeta.md")
+    assert prompt.startswith("You answer from the docs.")
+
+    # Per-request content goes after everything cacheable
+    with_volatile = build_system_prompt(agent, build_knowledge_context(files, contents), "\nToday is Monday.")
+    assert with_volatile.startswith(prompt)
+
+
+@pytest.mark.asyncio
+async def test_tools_are_sorted_and_failures_reported(session):
+    agent = Agent(name="Ops", system_prompt="You run ops.", model="glm-4.5-flash")
+    good = MCPServer(name="good", script="good.py")
+    bad = MCPServer(name="bad", script="bad.py")
+    session.add_all([agent, good, bad])
+    session.commit()
+    session.add(AgentMCPServer(agent_id=agent.id, mcp_server_id=good.id))
+    session.add(AgentMCPServer(agent_id=agent.id, mcp_server_id=bad.id))
+    session.commit()
+
+    async def list_tools(server_id):
+        if server_id == str(bad.id):
+            raise RuntimeError("boom")
+        return [Tool(name=n, inputSchema={"type": "object"}) for n in ("restart", "deploy", "logs")]
+
+    mcp_manager = MagicMock()
+    mcp_manager.get_mcp_status = AsyncMock(return_value={"status": "active"})
+    mcp_manager.list_mcp_tools = AsyncMock(side_effect=list_tools)
+
+    tools, tool_map, warnings = await load_agent_tools(session, agent.id, mcp_manager)
+    assert [t["function"]["name"] for t in tools] == ["deploy", "logs", "restart"]
+    assert tool_map == {"deploy": str(good.id), "logs": str(good.id), "restart": str(good.id)}
+    assert warnings == ["Failed to load MCP tools for 'bad'. Error: boom"]
+
+
+def ops_tools_manager():
+    mcp_manager = MagicMock()
+    mcp_manager.get_mcp_status = AsyncMock(return_value={"status": "active"})
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[Tool(name="deploy", inputSchema={"type": "object"})])
+    return mcp_manager
+
+
+@pytest.mark.asyncio
+async def test_profile_is_compiled_from_the_agent_rows(session):
+    agent = Agent(
+        name="Ops", system_prompt="You run ops.", model="glm-4.5-flash", context_budget_tokens=4000, knowledge_mode="full"
+    )
+    server = MCPServer(name="ops", script="ops.py")
+    session.add_all([agent, server])
+    session.commit()
+    session.add(AgentMCPServer(agent_id=agent.id, mcp_server_id=server.id))
+    add_knowledge_text(session, agent.id, "runbook.md", "restart first")
+    session.commit()
+
+    profile = await compile_agent_profile(load_agent_setup(session, agent.id), ops_tools_manager(), version=7)
+    assert profile.version == 7 and profile.model == "glm-4.5-flash" and profile.context_budget_tokens == 4000
+    assert profile.system_prompt == build_system_prompt(agent, profile.knowledge_context)
+    assert "restart first" in profile.knowledge_context
+    assert profile.tool_map == {"deploy": str(server.id)} and not profile.warnings
+    assert load_agent_setup(session, agent.id + 1) is None
+
+
+@pytest.mark.asyncio
+async def test_profile_cache_shares_builds_and_drops_racing_ones():
+    cache = AgentProfileCache()
+    builds = []
+
+    async def build(version):
+        builds.append(version)
+        await asyncio.sleep(0.01)
+        return MagicMock(warnings=[], version=version)
+
+    # Concurrent misses share one build, later calls hit
+    first = await asyncio.gather(*(cache.get(1, build) for _ in range(5)))
+    assert len(builds) == 1 and all(p is first[0] for p in first)
+    assert await cache.get(1, build) is first[0]
+
+    # An invalidation during a build keeps that (possibly stale) result out of the cache
+    task = asyncio.create_task(cache.get(2, build))
+    await asyncio.sleep(0)
+    cache.invalidate(2)
+    await task
+    await cache.get(2, build)
+    assert len(builds) == 3
+
+    # Unknown agents are not cached
+    async def missing(version):
+        builds.append(version)
+        return None
+
+    assert await cache.get(3, missing) is None and await cache.get(3, missing) is None
+    assert len(builds) == 5
+    cache.invalidate()
+    assert cache.stats()["profiles"] == 0
+
+
+def test_write_endpoints_invalidate_the_profile():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        agent = Agent(name="Ops", system_prompt="You run ops.", model="glm-4.5-flash")
+        server = MCPServer(name="ops", script="ops.py")
+        session.add_all([agent, server])
+        session.commit()
+        agent_id, server_id = agent.id, server.id
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    mcp_manager = ops_tools_manager()
+    profiles = AgentProfileCache()
+    _, zai = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2))
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_agent_profiles] = lambda: profiles
+    try:
+        client = TestClient(app)
+
+        def chat():
+            assert client.post("/api/v1/chat/", json={"agent_id": agent_id, "message": "hi"}).status_code == 200
+            return asyncio.run(profiles.get(agent_id, None))
+
+        profile = chat()
+        assert chat() is profile and profiles.stats()["hits"] >= 1
+        assert profile.tools == []
+
+        client.post(f"/api/v1/agents/{agent_id}/link-mcp/{server_id}")
+        profile = chat()
+        assert profile.tool_map == {"deploy": str(server_id)}
+
+        client.post(
+            f"/api/v1/agents/{agent_id}/knowledge", params={"wait": True}, files={"file": ("kb.txt", b"new facts", "text/plain")}
+        )
+        # New knowledge is added to the cached profile's index rather than rebuilding it
+        assert chat() is profile
+        assert [chunk.content for chunk in profile.knowledge_index.chunks] == ["new facts"]
+
+        client.put(f"/api/v1/agents/{agent_id}", json={"system_prompt": "You deploy."})
+        assert chat().system_prompt.startswith("You deploy.")
+        assert mcp_manager.list_mcp_tools.await_count == 2  # once per rebuild with the link, not per chat
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
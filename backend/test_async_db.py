@@ -0,0 +1,121 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+from unittest.mock import AsyncMock, MagicMock
+
+from main import app
+from async_db import get_async_session
+from database import async_url, get_session, get_session_factory
+from db_worker import DBWorker
+from dependencies import get_mcp_manager, get_write_buffer, get_zai_client
+from fake_zai_server import create_app, FakeZaiConfig
+from knowledge_store import add_knowledge_text
+from models import Agent, AgentMCPServer, MCPServer
+from write_behind import WriteBehindBuffer
+from zai_client import ZaiClient
+
+
+def test_async_url_picks_the_async_driver():
+    assert async_url("postgresql://u:p@db:5432/chat") == "postgresql+asyncpg://u:p@db:5432/chat"
+    assert async_url("postgresql+psycopg2://u:p@db/chat") == "postgresql+asyncpg://u:p@db/chat"
+    assert async_url("sqlite:////tmp/app.db") == "sqlite+aiosqlite:////tmp/app.db"
+
+
+def seed(engine):
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        agents = [Agent(name=f"agent-{i}", system_prompt="Be brief.", model="glm-4.5-flash") for i in range(3)]
+        server = MCPServer(name="calc", script="calc.py")
+        session.add_all(agents + [server])
+        session.commit()
+        session.add(AgentMCPServer(agent_id=agents[0].id, mcp_server_id=server.id))
+        add_knowledge_text(session, agents[0].id, "kb.txt", "facts")
+        session.commit()
+        return agents[0].id
+
+
+def exercise_routes(agent_id, engine):
+    """list_agents, knowledge upload and a REST chat turn through the async session dependency."""
+    mcp_manager = MagicMock()
+    mcp_manager.get_mcp_status = AsyncMock(return_value={"status": "active"})
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    # Where the background ingestion job stores the upload
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+
+    client = TestClient(app)
+    agents = client.get("/api/v1/agents/").json()
+    assert [a["linked_mcp_count"] for a in agents] == [1, 0, 0]
+
+    uploaded = client.post(
+        f"/api/v1/agents/{agent_id}/knowledge", params={"wait": True}, files={"file": ("more.txt", b"more facts", "text/plain")}
+    )
+    assert uploaded.status_code == 200 and uploaded.json()["id"] > 0 and uploaded.json()["status"] == "ready"
+
+    response = client.post("/api/v1/chat/", json={"agent_id": agent_id, "message": "hello"})
+    assert response.status_code == 200, response.text
+    assert response.json()["response"]
+    assert fake.state.stats.requests == 1
+    assert len(client.get(f"/api/v1/agents/{agent_id}/knowledge").json()) == 2
+
+
+def test_threaded_session_runs_queries_off_the_event_loop():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    agent_id = seed(engine)
+    session = Session(engine)
+    on_loop = []
+    original_get = Session.get
+
+    def recording_get(self, *args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError:
+            on_loop.append(False)
+        return original_get(self, *args, **kwargs)
+
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    try:
+        Session.get = recording_get
+        exercise_routes(agent_id, engine)
+    finally:
+        Session.get = original_get
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+    assert on_loop and not any(on_loop)
+
+
+def test_routes_on_an_async_engine(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("greenlet")
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    url = f"sqlite:///{tmp_path / 'async.db'}"
+    engine = create_engine(url)
+    agent_id = seed(engine)
+    async_engine = create_async_engine(async_url(url))
+
+    async def async_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_async_session] = async_session_override
+    app.dependency_overrides[get_session] = lambda: Session(engine)  # sync routes
+    try:
+        exercise_routes(agent_id, engine)
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        asyncio.run(async_engine.dispose())
@@ -0,0 +1,185 @@
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock, MagicMock
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from chat_memory import SUMMARY_HEADER, ChatMemory, MemoryPolicy, format_transcript
+from database import get_session, get_session_factory
+from db_worker import DBWorker
+from dependencies import get_mcp_manager, get_write_buffer, get_zai_client
+from fake_zai_server import FakeZaiConfig, create_app
+from main import app
+from models import Agent
+from token_budget import TokenEstimator
+from write_behind import WriteBehindBuffer
+from zai_client import ZaiClient
+
+
+def turn(i):
+    return [{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"}]
+
+
+class FakeSummarizer:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    async def __call__(self, previous, messages):
+        self.calls.append((previous, [m["content"] for m in messages]))
+        if self.fail:
+            raise RuntimeError("upstream down")
+        return f"summary {len(self.calls)}"
+
+
+def ten_per_message(message):
+    return 10
+
+
+@pytest.mark.asyncio
+async def test_evicted_turns_stay_until_their_summary_lands():
+    summarize = FakeSummarizer()
+    memory = ChatMemory("Be brief.", MemoryPolicy(window_tokens=100, pinned_turns=2, summary_model="cheap"),
+                        ten_per_message, summarize)
+    for i in range(5):
+        memory.add_turn(turn(i))
+    assert len(memory.messages()) == 11 and not summarize.calls
+
+    # 120 tokens > 100: the oldest turns go, down to 60% of the window
+    memory.add_turn(turn(5))
+    assert [m["content"] for m in memory.messages()[1:3]] == ["q0", "a0"]
+    await memory.settle()
+
+    assert summarize.calls == [("", ["q0", "a0", "q1", "a1", "q2", "a2"])]
+    prompt = memory.messages()
+    assert prompt[0] == {"role": "system", "content": "Be brief."}
+    assert prompt[1] == {"role": "system", "content": SUMMARY_HEADER + "summary 1"}
+    assert [m["content"] for m in prompt[2:]] == ["q3", "a3", "q4", "a4", "q5", "a5"]
+
+
+@pytest.mark.asyncio
+async def test_prompt_size_stays_flat_as_the_session_grows():
+    memory = ChatMemory("Be brief.", MemoryPolicy(window_tokens=200, pinned_turns=2, summary_model="cheap"),
+                        ten_per_message, FakeSummarizer())
+    sizes = []
+    for i in range(300):
+        memory.add_turn(turn(i) + [{"role": "tool", "tool_call_id": str(i), "content": "x"}])
+        await memory.settle()
+        sizes.append(len(memory.messages()))
+    assert max(sizes[50:]) == max(sizes[:50]) <= 2 + 200 // 10
+    assert memory.summaries > 0 and memory.dropped_turns == 0
+
+
+@pytest.mark.asyncio
+async def test_pinned_turns_are_kept_past_the_window():
+    memory = ChatMemory("Be brief.", MemoryPolicy(window_tokens=15, pinned_turns=2, summary_model=""), ten_per_message)
+    for i in range(4):
+        memory.add_turn(turn(i))
+    # Without a summary model evicted turns are dropped at once
+    assert [m["content"] for m in memory.messages()[1:]] == ["q2", "a2", "q3", "a3"]
+    assert memory.dropped_turns == 2
+
+
+@pytest.mark.asyncio
+async def test_failing_summaries_keep_turns_but_bound_the_backlog():
+    summarize = FakeSummarizer(fail=True)
+    memory = ChatMemory("Be brief.", MemoryPolicy(window_tokens=100, pinned_turns=1, summary_model="cheap"),
+                        ten_per_message, summarize)
+    for i in range(6):
+        memory.add_turn(turn(i))
+    await memory.settle()
+    assert memory.summary_failures == 1 and len(memory.messages()) == 13
+
+    for i in range(6, 40):
+        memory.add_turn(turn(i))
+        await memory.settle()
+    assert sum(t.tokens for t in memory.evicted) <= 100 and memory.dropped_turns > 0
+    assert len(memory.messages()) <= 1 + 2 * 100 // 10
+    assert memory.summary_failures == len(summarize.calls)
+
+
+@pytest.mark.asyncio
+async def test_knowledge_chunks_can_be_sent_again_once_summarized():
+    memory = ChatMemory("Be brief.", MemoryPolicy(window_tokens=30, pinned_turns=1, summary_model="cheap"),
+                        ten_per_message, FakeSummarizer())
+    memory.add_turn([{"role": "system", "content": "chunk"}] + turn(0), chunk_ids=[3, 4])
+    memory.add_turn(turn(1), chunk_ids=[5])
+    assert memory.sent_chunks() == {3, 4, 5}
+    await memory.settle()
+    assert memory.sent_chunks() == {5}
+
+
+def test_transcript_skips_knowledge_and_trims_tool_results():
+    transcript = format_transcript([
+        {"role": "system", "content": "--- Relevant Knowledge ---"},
+        {"role": "user", "content": "deploy it"},
+        {"role": "assistant", "tool_calls": [{"function": {"name": "deploy", "arguments": "{\"env\": \"prod\"}"}}]},
+        {"role": "tool", "content": "y" * 5000},
+        {"role": "assistant", "content": "Deployed."},
+    ])
+    lines = transcript.split("\n")
+    assert lines[:2] == ["User: deploy it", "Assistant called deploy({\"env\": \"prod\"})"]
+    assert len(lines[2]) < 1100 and lines[3] == "Assistant: Deployed."
+
+
+def test_summary_counts_as_history_in_the_budget():
+    estimator = TokenEstimator()
+    messages = [
+        {"role": "system", "content": "Be brief."},
+        {"role": "system", "content": SUMMARY_HEADER + "the user likes tea " * 20},
+        {"role": "user", "content": "hi"},
+    ]
+    report = estimator.report(messages)
+    assert report.knowledge == 0 and report.history > report.system_prompt
+
+
+class RecordingTransport(httpx.ASGITransport):
+    def __init__(self, app):
+        super().__init__(app=app)
+        self.bodies = []
+
+    async def handle_async_request(self, request):
+        self.bodies.append(json.loads(await request.aread()))
+        return await super().handle_async_request(request)
+
+
+def test_websocket_prompts_stay_bounded_with_a_rolling_summary():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        agent = Agent(name="Chatty", system_prompt="Be brief.", model="glm-4.5-flash",
+                      memory_window_tokens=120, memory_pinned_turns=1, memory_summary_model="glm-4.5-air")
+        session.add(agent)
+        session.commit()
+        agent_id = agent.id
+
+    transport = RecordingTransport(create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=5)))
+    mcp_manager = MagicMock()
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: Session(engine)
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: ZaiClient(
+        api_key="test-key", base_url="http://fake-zai", transport=transport
+    )
+    try:
+        with TestClient(app).websocket_connect(f"/api/v1/ws/chat/{agent_id}") as websocket:
+            for i in range(15):
+                websocket.send_json({"message": f"question {i} " * 8})
+                while websocket.receive_json()["type"] != "done":
+                    pass
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+
+    chats = [body for body in transport.bodies if body["model"] == "glm-4.5-flash"]
+    summaries = [body for body in transport.bodies if body["model"] == "glm-4.5-air"]
+    assert len(chats) == 15 and summaries
+    assert "question 0" in summaries[0]["messages"][1]["content"]
+    assert max(len(body["messages"]) for body in chats[5:]) <= max(len(body["messages"]) for body in chats[:5]) + 1
+    assert any(m["content"].startswith(SUMMARY_HEADER) for m in chats[-1]["messages"] if m["role"] == "system")
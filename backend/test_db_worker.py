@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+from contextlib import ExitStack
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlalchemy.pool import QueuePool
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session, get_session_factory
+from dependencies import get_zai_client, get_write_buffer
+from db_worker import DBWorker
+from fake_zai_server import FakeZaiConfig
+from loop_monitor import LoopLagMonitor
+from models import Agent, ChatMessage, ChatSession
+from write_behind import WriteBehindBuffer
+from test_fake_zai_server import make_client
+
+
+@pytest.mark.asyncio
+async def test_monitor_sees_a_blocked_loop():
+    monitor = LoopLagMonitor(interval_ms=10, stall_ms=100)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    time.sleep(0.2)  # a synchronous commit on the loop
+    await asyncio.sleep(0.05)
+    await monitor.stop()
+    assert monitor.stats()["lag_max_ms"] >= 150
+    assert monitor.stalls == 1
+
+
+@pytest.mark.asyncio
+async def test_blocking_work_on_the_worker_does_not_stall_the_loop():
+    monitor = LoopLagMonitor(interval_ms=10, stall_ms=100)
+    worker = DBWorker(threads=2)
+    monitor.start()
+    results = await asyncio.gather(*(worker.run(time.sleep, 0.2) for _ in range(4)))
+    await monitor.stop()
+    worker.shutdown()
+    assert results == [None] * 4
+    assert monitor.stalls == 0 and monitor.max_lag < 0.1
+    assert worker.stats()["calls"] == 4 and worker.stats()["max_ms"] >= 200
+
+
+def test_websocket_chat_commits_off_the_event_loop(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+    agent = Agent(name="Echo", system_prompt="Be brief.", model="glm-4.5-flash")
+    session.add(agent)
+    session.commit()
+
+    threads = []
+    original = WriteBehindBuffer._write
+
+    def recording_write(self, *args):
+        threads.append(threading.current_thread().name)
+        original(self, *args)
+
+    monkeypatch.setattr(WriteBehindBuffer, "_write", recording_write)
+    _, zai = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3))
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    try:
+        with TestClient(app).websocket_connect(f"/api/v1/ws/chat/{agent.id}") as websocket:
+            websocket.send_json({"message": "hello"})
+            while websocket.receive_json()["type"] != "done":
+                pass
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+
+    assert len(threads) == 1 and all(name.startswith("db") for name in threads)
+    assert [m.role for m in session.exec(select(ChatMessage))] == ["user", "assistant"]
+    assert session.exec(select(ChatSession)).one().total_tokens > 0
+    session.close()
+
+
+def test_open_sockets_far_exceed_the_connection_pool(tmp_path):
+    # Two pooled connections; a socket that pinned one would make the third connect time out
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'chat.db'}", connect_args={"check_same_thread": False},
+        poolclass=QueuePool, pool_size=2, max_overflow=0, pool_timeout=2
+    )
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        agent = Agent(name="Echo", system_prompt="Be brief.", model="glm-4.5-flash")
+        session.add(agent)
+        session.commit()
+        agent_id = agent.id
+
+    _, zai = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2))
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    sockets = 40
+    try:
+        with ExitStack() as stack:
+            client = TestClient(app)
+            opened = [stack.enter_context(client.websocket_connect(f"/api/v1/ws/chat/{agent_id}")) for _ in range(sockets)]
+            # Every socket is open and set up, yet none holds a connection (setup may still be
+            # finishing its last short session when connect returns; a pinned one never comes back)
+            deadline = time.monotonic() + 2
+            while engine.pool.checkedout() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert engine.pool.checkedout() == 0
+            for websocket in opened:
+                websocket.send_json({"message": "hello"})
+                while websocket.receive_json()["type"] != "done":
+                    pass
+            assert engine.pool.checkedout() == 0
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+
+    with Session(engine) as session:
+        assert len(session.exec(select(ChatSession)).all()) == sockets
+        assert len(session.exec(select(ChatMessage)).all()) == 2 * sockets
@@ -0,0 +1,208 @@
+import pytest
+import httpx
+from openai import RateLimitError
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock, AsyncMock
+from mcp.types import Tool, TextContent
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session, get_session_factory
+from dependencies import get_mcp_manager, get_zai_client, get_write_buffer
+from db_worker import DBWorker
+from write_behind import WriteBehindBuffer
+from models import Agent, AgentMCPServer, MCPServer, ChatSession, ChatMessage
+from fake_zai_server import create_app, FakeZaiConfig, ScriptedToolCall
+from zai_client import ZaiClient
+
+
+def make_client(config: FakeZaiConfig, raw_streaming: bool = False):
+    fake = create_app(config)
+    client = ZaiClient(
+        api_key="test-key",
+        base_url="http://fake-zai",
+        transport=httpx.ASGITransport(app=fake),
+        raw_streaming=raw_streaming
+    )
+    return fake, client
+
+
+@pytest.mark.asyncio
+async def test_stream_with_reasoning_and_usage():
+    fake, client = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=5, reasoning_tokens=2))
+
+    content, reasoning, usage = "", "", None
+    async for chunk in client.chat_stream(
+        messages=[{"role": "user", "content": "hi"}],
+        stream_options={"include_usage": True}
+    ):
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        content += delta.content or ""
+        reasoning += getattr(delta, "reasoning_content", None) or ""
+
+    assert content == "token0 token1 token2 token3 token4 "
+    assert reasoning == "think0 think1 "
+    assert usage.completion_tokens == 7
+    assert usage.total_tokens == usage.prompt_tokens + 7
+    assert fake.state.stats.streamed == 1
+
+
+@pytest.mark.asyncio
+async def test_non_streaming_scripted_tool_call():
+    config = FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, tool_calls=[ScriptedToolCall(name="add", arguments={"a": 1, "b": 2})])
+    _, client = make_client(config)
+    tools = [{"type": "function", "function": {"name": "add", "parameters": {"type": "object"}}}]
+
+    message = await client.chat(messages=[{"role": "user", "content": "add"}], tools=tools)
+    assert message.tool_calls[0].function.name == "add"
+    assert message.tool_calls[0].function.arguments == '{"a": 1, "b": 2}'
+
+    # Once a tool result is in the history the fake answers with text.
+    message = await client.chat(
+        messages=[
+            {"role": "user", "content": "add"},
+            {"role": "assistant", "tool_calls": [{"id": "c1", "type": "function", "function": {"name": "add", "arguments": "{}"}}]},
+            {"role": "tool", "tool_call_id": "c1", "content": "3"},
+        ],
+        tools=tools
+    )
+    assert not message.tool_calls
+    assert message.content.startswith("token0")
+
+
+@pytest.mark.asyncio
+async def test_injected_rate_limit():
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, rate_limit_every=2, retry_after_s=3))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=fake), base_url="http://fake-zai") as http:
+        body = {"model": "glm-4.5-flash", "messages": [{"role": "user", "content": "hi"}]}
+        first = await http.post("/chat/completions", json=body)
+        second = await http.post("/chat/completions", json=body)
+
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert second.headers["retry-after"] == "3.0"
+    assert fake.state.stats.rate_limited == 1
+
+
+async def collect_deltas(client: ZaiClient, **kwargs):
+    content, reasoning, usage, tool_calls = "", "", None, []
+    async for delta in client.stream_deltas(stream_options={"include_usage": True}, **kwargs):
+        content += delta.content or ""
+        reasoning += delta.reasoning or ""
+        usage = delta.usage or usage
+        for tc in delta.tool_calls or []:
+            tool_calls.append((tc.get("id") is not None, (tc.get("function") or {}).get("arguments")))
+    return content, reasoning, usage, tool_calls
+
+
+@pytest.mark.asyncio
+async def test_raw_sse_path_matches_sdk_path():
+    config = FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=4, reasoning_tokens=2)
+    messages = [{"role": "user", "content": "hi"}]
+    _, sdk = make_client(config)
+    _, raw = make_client(config, raw_streaming=True)
+
+    assert await collect_deltas(raw, messages=messages) == await collect_deltas(sdk, messages=messages)
+
+    config.tool_calls = [ScriptedToolCall(name="add", arguments={"a": 1})]
+    tools = [{"type": "function", "function": {"name": "add", "parameters": {"type": "object"}}}]
+    raw_result = await collect_deltas(raw, messages=messages, tools=tools, tools_key="agent:1")
+    assert raw_result[3] == [(True, ""), (False, '{"a"'), (False, ': 1}')]
+    assert raw_result[3] == (await collect_deltas(sdk, messages=messages, tools=tools))[3]
+
+
+@pytest.mark.asyncio
+async def test_raw_sse_path_skips_empty_data_lines():
+    messages = [{"role": "user", "content": "hi"}]
+    _, plain = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3), raw_streaming=True)
+    _, padded = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3, keepalive_lines=True),
+                            raw_streaming=True)
+
+    result = await collect_deltas(padded, messages=messages)
+    assert result[0] == "token0 token1 token2 " and result[2]["completion_tokens"] == 3
+    assert result == await collect_deltas(plain, messages=messages)
+@pytest.mark.asyncio
+async def test_raw_sse_path_caches_tools_json_and_maps_errors():
+    fake, raw = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, rate_limit_models=["glm-4.6"]), raw_streaming=True)
+    tools = [{"type": "function", "function": {"name": "add", "parameters": {"type": "object"}}}]
+
+    first = raw._tools_json(tools, "agent:1")
+    assert raw._tools_json(tools, "agent:1") is first
+    # A new tool list under the same key is re-serialized
+    assert raw._tools_json(list(tools), "agent:1") is not first
+
+    with pytest.raises(RateLimitError):
+        async for _ in raw.chat_stream_raw(messages=[], model="glm-4.6", tools=tools, tools_key="agent:1"):
+            pass
+    assert fake.state.stats.rate_limited == 1
+
+
+@pytest.mark.parametrize("raw_streaming", [False, True])
+def test_websocket_chat_full_stack_against_fake_upstream(raw_streaming):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+
+    agent = Agent(name="Calc", system_prompt="You add numbers.", model="glm-4.5-flash")
+    server = MCPServer(name="calc", script="calc.py")
+    session.add(agent)
+    session.add(server)
+    session.commit()
+    session.add(AgentMCPServer(agent_id=agent.id, mcp_server_id=server.id))
+    session.commit()
+
+    mcp_manager = MagicMock()
+    mcp_manager.get_mcp_status = AsyncMock(return_value={"status": "active"})
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[
+        Tool(name="add", description="Add two numbers", inputSchema={"type": "object"})
+    ])
+    mcp_manager.call_mcp_tool = AsyncMock(return_value=[TextContent(type="text", text="3")])
+
+    config = FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3, tool_calls=[ScriptedToolCall(name="add", arguments={"a": 1, "b": 2})])
+    fake, zai = make_client(config, raw_streaming=raw_streaming)
+    writes = WriteBehindBuffer(lambda: Session(engine), DBWorker())
+
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_write_buffer] = lambda: writes
+    try:
+        client = TestClient(app)
+        events = []
+        with client.websocket_connect(f"/api/v1/ws/chat/{agent.id}") as websocket:
+            websocket.send_json({"message": "what is 1 + 2?"})
+            while True:
+                event = websocket.receive_json()
+                events.append(event)
+                if event["type"] in ("done", "error"):
+                    break
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+
+    # Consecutive tokens may be coalesced into fewer frames
+    types = [e["type"] for e in events]
+    assert [t for i, t in enumerate(types) if t != "token" or types[i - 1] != "token"] == ["tool_start", "tool_end", "token", "done"]
+    assert "".join(e["content"] for e in events if e["type"] == "token") == "token0 token1 token2 "
+    assert events[1]["result"] == "3"
+    assert events[-1]["tokens"]["total"] > 0
+    mcp_manager.call_mcp_tool.assert_awaited_once_with(str(server.id), "add", {"a": 1, "b": 2})
+    assert fake.state.stats.streamed == 2
+
+    # The turn is flushed in one batch before "done" is sent
+    assert writes.flushes == 1 and writes.rows_written == 4
+    chat_session = session.exec(select(ChatSession)).one()
+    assert chat_session.total_tokens == events[-1]["tokens"]["total"]
+    # The follow-up request after the tool call re-sends the same prefix
+    assert events[-1]["tokens"]["cached"] > 0
+    assert chat_session.cached_prompt_tokens == events[-1]["tokens"]["cached"]
+    roles = [m.role for m in session.exec(select(ChatMessage).order_by(ChatMessage.id))]
+    assert roles == ["user", "tool", "assistant"]
+    session.close()
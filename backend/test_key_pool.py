@@ -0,0 +1,154 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from openai import RateLimitError
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session
+from dependencies import get_zai_client
+from fake_zai_server import create_app, FakeZaiConfig
+from key_pool import key_id
+from zai_client import ZaiClient
+
+
+def make_client(config: FakeZaiConfig, api_keys):
+    fake = create_app(config)
+    client = ZaiClient(api_keys=api_keys, base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    return fake, client
+
+
+@pytest.mark.asyncio
+async def test_each_key_has_its_own_connection_pool():
+    fake, client = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2), ["key-a-1111", "key-b-2222"])
+    first, second = client.pool.keys
+    # Connection limits are per key, so adding keys adds upstream concurrency
+    assert first.http_client is not second.http_client
+
+    client.set_api_keys(["key-b-2222", "key-c-3333"])
+    assert client.pool.keys[0].http_client is second.http_client
+    assert client.pool.keys[1].http_client not in (first.http_client, second.http_client)
+
+    # Raw streaming goes out on the key's own client too
+    deltas = [delta async for delta in client.chat_stream_raw(messages=[{"role": "user", "content": "hi"}])]
+    assert "".join(d.content or "" for d in deltas) == "token0 token1 "
+    assert fake.state.stats.requests == 1
+
+
+
+@pytest.mark.asyncio
+async def test_removed_keys_close_their_http_client_once_released():
+    fake, client = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2), ["key-a-1111", "key-b-2222", "key-c-3333"])
+    first, second, third = client.pool.keys
+    busy = client.pool.acquire()
+    assert busy is first
+
+    client.set_api_keys(["key-c-3333"])
+    await asyncio.sleep(0)
+    # The idle removed key is closed right away, the busy one waits for its request
+    assert second.http_client.is_closed
+    assert not first.http_client.is_closed
+    assert not third.http_client.is_closed
+
+    client.pool.release(busy)
+    await asyncio.sleep(0)
+    assert first.http_client.is_closed
+    assert client.pool.retired == []
+
+    deltas = [delta async for delta in client.chat_stream_raw(messages=[{"role": "user", "content": "hi"}])]
+    assert "".join(d.content or "" for d in deltas) == "token0 token1 "
+    assert not third.http_client.is_closed
+
+async def burst(client: ZaiClient, n: int):
+    async def one():
+        return await client.chat_once(messages=[{"role": "user", "content": "hi"}], max_retries=0)
+
+    return await asyncio.gather(*(one() for _ in range(n)), return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_throughput_scales_with_number_of_keys():
+    # Each key only allows one request in flight
+    config = FakeZaiConfig(ttft_ms=50, tokens_per_sec=0, response_tokens=2, max_concurrent_per_key=1)
+
+    fake, single = make_client(config, ["key-only"])
+    results = await burst(single, 4)
+    assert sum(isinstance(r, RateLimitError) for r in results) == 3
+
+    fake, pooled = make_client(config, ["key-a", "key-b", "key-c", "key-d"])
+    results = await burst(pooled, 4)
+    assert not any(isinstance(r, Exception) for r in results)
+    assert fake.state.stats.requests_by_key == {"key-a": 1, "key-b": 1, "key-c": 1, "key-d": 1}
+
+    stats = pooled.pool.stats()
+    assert stats["requests"] == 4
+    assert all(k["completion_tokens"] == 2 and k["prompt_tokens"] > 0 for k in stats["keys"])
+    assert all(k["in_flight"] == 0 for k in stats["keys"])
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_key_is_sidelined():
+    config = FakeZaiConfig(ttft_ms=100, tokens_per_sec=0, response_tokens=2, max_concurrent_per_key=1, retry_after_s=30)
+    fake, client = make_client(config, ["key-a", "key-b"])
+
+    # Occupy key-a directly so the pool's next pick collides with it upstream
+    blocker = asyncio.create_task(client.pool.keys[0].client.chat.completions.create(
+        model="glm-4.5-flash", messages=[{"role": "user", "content": "hold"}]
+    ))
+    await asyncio.sleep(0.02)
+
+    chunks = [c async for c in client.stream_deltas(messages=[{"role": "user", "content": "hi"}], stream_options={"include_usage": True})]
+    await blocker
+    assert "".join(c.content or "" for c in chunks) == "token0 token1 "
+
+    key_a, key_b = client.pool.stats()["keys"]
+    assert key_a["rate_limited"] == 1 and key_a["cooldown_remaining_s"] > 20
+    assert key_b["requests"] == 1 and key_b["completion_tokens"] == 2
+    # While key-a cools down everything goes to key-b
+    assert client.pool.acquire() is client.pool.keys[1]
+
+
+def test_settings_manage_key_pool():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    zai = ZaiClient(api_key="initial-key")
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    try:
+        client = TestClient(app)
+        response = client.put("/api/v1/settings/zai-keys", json={"api_keys": ["first-key-1111", "second-key-2222"]})
+        assert response.json() == {"status": "updated", "count": 2}
+        assert [k.api_key for k in zai.pool.keys] == ["first-key-1111", "second-key-2222"]
+
+        response = client.post("/api/v1/settings/zai-keys", json={"api_key": "third-key-3333"})
+        assert response.json()["count"] == 3
+        assert client.post("/api/v1/settings/zai-keys", json={"api_key": "third-key-3333"}).status_code == 409
+
+        listed = client.get("/api/v1/settings/zai-keys").json()
+        assert [k["masked_key"] for k in listed] == ["firs...1111", "seco...2222", "thir...3333"]
+        # The legacy single-key endpoint reports the first key of the pool
+        assert client.get("/api/v1/settings/zai-key").json()["masked_key"] == "firs...1111"
+
+        assert client.delete(f"/api/v1/settings/zai-keys/{key_id('first-key-1111')}").json()["count"] == 2
+        assert client.delete("/api/v1/settings/zai-keys/unknown").status_code == 404
+        assert client.get("/api/v1/settings/zai-key").json()["masked_key"] == "seco...2222"
+
+        stats = client.get("/api/v1/settings/zai-keys/stats").json()
+        assert [k["masked_key"] for k in stats["keys"]] == ["seco...2222", "thir...3333"]
+
+        # Setting the single key replaces the pool
+        client.post("/api/v1/settings/zai-key", json={"api_key": "solo-key-4444"})
+        assert [k["masked_key"] for k in client.get("/api/v1/settings/zai-keys").json()] == ["solo...4444"]
+        assert zai.api_key == "solo-key-4444"
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import time
+from collections import Counter
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock, AsyncMock
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from agent_runtime import AgentProfileCache, compile_agent_profile, load_agent_setup, retrieve_knowledge
+from database import get_session, get_session_factory
+from dependencies import get_mcp_manager, get_write_buffer, get_zai_client
+from fake_zai_server import FakeZaiConfig, create_app
+from db_worker import DBWorker
+from knowledge_index import BM25Index, KnowledgeChunk, chunk_text, ingest_document, tokenize
+from knowledge_ingest import KnowledgeIngestor
+from main import app
+from models import Agent, AgentKnowledgeFile, KnowledgeBlob, KnowledgeBlobChunk
+from token_budget import TokenEstimator
+from write_behind import WriteBehindBuffer
+from zai_client import ZaiClient
+
+DOCS = {
+    "billing.md": "Invoices are sent on the first of the month.\n\nRefunds take five business days to process.",
+    "deploy.md": "Deploys run from the main branch.\n\nRoll back with the previous release tag.",
+    "office.md": "The office is closed on public holidays.",
+}
+
+
+def count_tokens(text: str) -> int:
+    return TokenEstimator().count_text(text)
+
+
+def test_chunking_packs_paragraphs_and_splits_long_ones():
+    text = "first paragraph\n\nsecond paragraph\n\n" + "word " * 100
+    chunks = chunk_text(text, max_chars=120)
+    assert chunks[0] == "first paragraph\n\nsecond paragraph"
+    assert all(len(c) <= 120 for c in chunks)
+    # Long paragraphs are cut at spaces, losing nothing but the whitespace
+    assert " ".join(chunks[1:]).split() == ["word"] * 100
+    assert chunk_text("") == [] and chunk_text("x" * 250, max_chars=100) == ["x" * 100, "x" * 100, "x" * 50]
+
+
+def test_tokenize_splits_cjk_into_characters():
+    assert tokenize("Refund-Policy v2_draft") == ["refund", "policy", "v2", "draft"]
+    assert tokenize("退款 policy") == ["退", "款", "policy"]
+
+
+def test_bm25_ranks_rare_matching_terms_first():
+    index = BM25Index([
+        KnowledgeChunk("a.md", 0, "the service restarts nightly"),
+        KnowledgeChunk("b.md", 0, "the refund window is thirty days"),
+        KnowledgeChunk("c.md", 0, "the the the refund refund policy"),
+    ])
+    hits = index.search("how does the refund policy work", k=3)
+    assert [i for _, i in hits] == [2, 1, 0]
+    assert hits[0][0] > hits[1][0] > hits[2][0] > 0
+    assert index.search("kubernetes", k=3) == []
+    # Filenames are searchable too
+    assert index.search("a.md", k=1)[0][1] == 0
+
+
+def test_retrieve_respects_top_k_budget_and_exclusions():
+    index = BM25Index([KnowledgeChunk("kb.md", i, f"refund rule {i} " + "detail " * (10 + 40 * (i % 2)))
+                       for i in range(6)])
+    assert len(index.retrieve("refund", count_tokens, top_k=3)) == 3
+
+    small = count_tokens(index.chunks[0].content)
+    chosen = index.retrieve("refund", count_tokens, top_k=6, budget_tokens=2 * small)
+    assert sum(count_tokens(index.chunks[i].content) for i in chosen) <= 2 * small
+    assert all(i % 2 == 0 for i in chosen)  # the long chunks never fit
+
+    first = index.retrieve("refund", count_tokens, top_k=2)
+    assert not set(first) & set(index.retrieve("refund", count_tokens, top_k=2, exclude=first))
+
+
+def test_ingest_normalizes_and_dedupes(tmp_path):
+    path = tmp_path / "export.txt"
+    footer = "Confidential. Do not distribute."
+    path.write_bytes(("\ufeffCafe\u0301 menu\r\n\r\n\r\n\r\nSoup  \x00\r\n\r\n" + footer).encode())
+    document = ingest_document(str(path), max_chars=40)
+    assert document.content == f"Caf\u00e9 menu\n\nSoup\n\n{footer}"
+    assert document.chunks == ["Caf\u00e9 menu\n\nSoup", footer]
+    assert document.chunk_terms[0] == {"café": 1, "menu": 1, "soup": 1}
+
+    path.write_text("\n\n".join([footer, "Page one text.", footer, "Page two text.", footer]))
+    document = ingest_document(str(path), max_chars=40)
+    assert document.chunks == [footer, "Page one text.", "Page two text."]
+    assert document.duplicate_chunks == 2
+
+    path.write_bytes(b"\xff\xfe binary")
+    with pytest.raises(ValueError, match="UTF-8"):
+        ingest_document(str(path))
+
+
+def test_incremental_index_matches_a_rebuild():
+    a = [KnowledgeChunk("a.md", i, f"refund policy part {i} " * (i + 1), 1) for i in range(3)]
+    b = [KnowledgeChunk("b.md", i, f"deploy refund notes {i}", 2) for i in range(2)]
+    index = BM25Index(a)
+    for chunk in b:
+        index.add(chunk, Counter(tokenize(chunk.content)))
+    rebuilt = BM25Index(a + b)
+    assert index.search("refund deploy", 5) == rebuilt.search("refund deploy", 5)
+
+    assert index.remove_file(1) == 3 and len(index) == 2
+    only_b = BM25Index(b)
+    # Same scores as an index built from b alone; indices still point into the full list
+    assert [score for score, _ in index.search("refund deploy", 5)] == [s for s, _ in only_b.search("refund deploy", 5)]
+    assert [index.chunks[i].file_id for _, i in index.search("refund policy", 5)] == [2, 2]
+    assert index.remove_file(1) == 0
+
+
+@pytest.fixture(name="engine")
+def engine_fixture(tmp_path):
+    # A file database: ingestion jobs commit from several worker threads at once, which a
+    # single shared in-memory connection can't take
+    engine = create_engine(f"sqlite:///{tmp_path / 'knowledge.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    saved_overrides = dict(app.dependency_overrides)
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    yield engine
+    app.dependency_overrides.clear()
+    app.dependency_overrides.update(saved_overrides)
+
+
+def create_agent(engine, **fields) -> int:
+    with Session(engine) as session:
+        agent = Agent(name="Support", system_prompt="Answer from the docs.", model="glm-4.5-flash", **fields)
+        session.add(agent)
+        session.commit()
+        return agent.id
+
+
+def upload_docs(client: TestClient, agent_id: int):
+    for name, content in DOCS.items():
+        response = client.post(
+            f"/api/v1/agents/{agent_id}/knowledge", params={"wait": True}, files={"file": (name, content.encode(), "text/plain")}
+        )
+        assert response.status_code == 200 and response.json()["status"] == "ready"
+
+
+def test_same_text_is_stored_once_and_freed_with_its_last_file(engine):
+    first_id, second_id = create_agent(engine), create_agent(engine)
+    client = TestClient(app)
+    upload_docs(client, first_id)
+    upload_docs(client, second_id)
+
+    with Session(engine) as session:
+        blobs = session.exec(select(KnowledgeBlob)).all()
+        assert len(blobs) == 3 and {blob.refcount for blob in blobs} == {2}
+        chunks = session.exec(select(KnowledgeBlobChunk)).all()
+        assert sorted(c.content for c in chunks) == sorted(chunk_text(content)[0] for content in DOCS.values())
+
+    listing = client.get(f"/api/v1/agents/{first_id}/knowledge").json()
+    assert "content" not in listing[0] and listing[0]["blob_sha256"]
+    file_id = listing[0]["id"]
+    text = client.get(f"/api/v1/agents/{first_id}/knowledge/{file_id}/content")
+    assert text.status_code == 200 and text.text == DOCS[listing[0]["filename"]]
+
+    # Still used by the second agent
+    assert client.delete(f"/api/v1/agents/{first_id}/knowledge/{file_id}").status_code == 200
+    with Session(engine) as session:
+        assert session.get(KnowledgeBlob, listing[0]["blob_sha256"]).refcount == 1
+    second_file = next(f for f in client.get(f"/api/v1/agents/{second_id}/knowledge").json()
+                       if f["blob_sha256"] == listing[0]["blob_sha256"])
+    assert client.delete(f"/api/v1/agents/{second_id}/knowledge/{second_file['id']}").status_code == 200
+    with Session(engine) as session:
+        assert session.get(KnowledgeBlob, listing[0]["blob_sha256"]) is None
+        assert len(session.exec(select(KnowledgeBlobChunk)).all()) == 2
+
+
+@pytest.mark.asyncio
+async def test_profile_modes(engine):
+    retrieval_id = create_agent(engine)
+    full_id = create_agent(engine, knowledge_mode="full")
+    with Session(engine) as session:
+        for name, content in DOCS.items():
+            # Blobs without chunks, as stored before chunking existed
+            sha256 = hashlib.sha256(content.encode()).hexdigest()
+            session.add(KnowledgeBlob(sha256=sha256, content=content, refcount=2))
+            for agent_id in (retrieval_id, full_id):
+                session.add(AgentKnowledgeFile(agent_id=agent_id, filename=name, blob_sha256=sha256))
+        session.commit()
+
+        retrieval = await compile_agent_profile(load_agent_setup(session, retrieval_id), MagicMock())
+        full = await compile_agent_profile(load_agent_setup(session, full_id), MagicMock())
+
+    assert retrieval.knowledge_mode == "retrieval" and retrieval.system_prompt == "Answer from the docs."
+    assert len(retrieval.knowledge_index) == 3
+    message, chunk_ids = retrieve_knowledge(retrieval, "when do refunds arrive?", count_tokens)
+    assert message["role"] == "system" and "Refunds take five business days" in message["content"]
+    assert "Deploys" not in message["content"] and len(chunk_ids) == 1
+    assert retrieve_knowledge(retrieval, "refunds", count_tokens, exclude=chunk_ids) == (None, [])
+    # Sent chunks stay excluded after a rebuild that shifts every index (a file sorting first)
+    with Session(engine) as session:
+        content = "Ask the help desk about anything else."
+        sha256 = hashlib.sha256(content.encode()).hexdigest()
+        session.add(KnowledgeBlob(sha256=sha256, content=content, refcount=1))
+        session.add(AgentKnowledgeFile(agent_id=retrieval_id, filename="about.md", blob_sha256=sha256))
+        session.commit()
+        rebuilt = await compile_agent_profile(load_agent_setup(session, retrieval_id), MagicMock())
+    assert rebuilt.knowledge_index.chunks[0].filename == "about.md"
+    assert retrieve_knowledge(rebuilt, "refunds", count_tokens, exclude=chunk_ids) == (None, [])
+
+    assert full.knowledge_mode == "full" and full.knowledge_index is None
+    assert "Deploys run from the main branch." in full.system_prompt
+    assert retrieve_knowledge(full, "refunds", count_tokens) == (None, [])
+
+
+class RecordingTransport(httpx.ASGITransport):
+    def __init__(self, app):
+        super().__init__(app=app)
+        self.bodies = []
+
+    async def handle_async_request(self, request):
+        self.bodies.append(json.loads(await request.aread()))
+        return await super().handle_async_request(request)
+
+
+def test_rest_chat_sends_only_relevant_chunks(engine):
+    agent_id = create_agent(engine)
+    transport = RecordingTransport(create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2)))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=transport)
+    mcp_manager = MagicMock()
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+
+    client = TestClient(app)
+    upload_docs(client, agent_id)
+    question = "How do I roll back a deploy?"
+    assert client.post("/api/v1/chat/", json={"agent_id": agent_id, "message": question}).status_code == 200
+
+    system, knowledge, user = transport.bodies[-1]["messages"]
+    assert system == {"role": "system", "content": "Answer from the docs."}
+    assert knowledge["role"] == "system" and "File: deploy.md (part 1)" in knowledge["content"]
+    assert "Invoices" not in knowledge["content"] and "office" not in knowledge["content"]
+    assert user == {"role": "user", "content": question}
+
+    client.put(f"/api/v1/agents/{agent_id}", json={"knowledge_mode": "full"})
+    client.post("/api/v1/chat/", json={"agent_id": agent_id, "message": question})
+    system, user = transport.bodies[-1]["messages"]
+    assert all(content in system["content"] for content in DOCS.values())
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [0, 1])
+async def test_ingestor_runs_jobs_in_the_background(engine, tmp_path, workers):
+    agent_id = create_agent(engine)
+    with Session(engine) as session:
+        pending = AgentKnowledgeFile(agent_id=agent_id, filename="deploy.md", status="pending")
+        broken = AgentKnowledgeFile(agent_id=agent_id, filename="blob.bin", status="pending")
+        session.add_all([pending, broken])
+        session.commit()
+        pending_id, broken_id = pending.id, broken.id
+    (tmp_path / "deploy.md").write_text(DOCS["deploy.md"])
+    (tmp_path / "blob.bin").write_bytes(b"\xff\xfe")
+
+    profiles = AgentProfileCache()
+    with Session(engine) as session:
+        profile = await compile_agent_profile(load_agent_setup(session, agent_id), MagicMock())
+    await profiles.get(agent_id, AsyncMock(return_value=profile))
+
+    ingestor = KnowledgeIngestor(DBWorker(), workers=workers, spool_dir=str(tmp_path))
+    try:
+        jobs = [
+            ingestor.submit(pending_id, str(tmp_path / "deploy.md"), lambda: Session(engine), profiles),
+            ingestor.submit(broken_id, str(tmp_path / "blob.bin"), lambda: Session(engine), profiles),
+        ]
+        assert ingestor.stats()["in_flight"] == 2
+        for job in jobs:
+            await job
+    finally:
+        ingestor.shutdown()
+
+    with Session(engine) as session:
+        ready, failed = session.get(AgentKnowledgeFile, pending_id), session.get(AgentKnowledgeFile, broken_id)
+        assert (ready.status, ready.chunk_count, ready.blob.content) == ("ready", 1, DOCS["deploy.md"])
+        assert failed.status == "failed" and "UTF-8" in failed.error
+    assert not list(tmp_path.glob("*.md")) and not list(tmp_path.glob("*.bin"))  # spooled files are removed
+    assert ingestor.stats()["completed"] == 1 and ingestor.stats()["failed"] == 1
+
+    # The cached profile picked the file up without a rebuild
+    cached = await profiles.get(agent_id, None)
+    assert cached is profile
+    message, _ = retrieve_knowledge(cached, "roll back", count_tokens)
+    assert "previous release tag" in message["content"]
+
+
+def test_upload_is_queued_and_status_can_be_polled(engine):
+    agent_id = create_agent(engine)
+    with TestClient(app) as client:
+        upload_docs(client, agent_id)
+        queued = client.post(f"/api/v1/agents/{agent_id}/knowledge", files={"file": ("faq.md", b"Opening hours are nine to five.", "text/plain")})
+        assert queued.status_code == 202 and queued.json()["status"] == "pending"
+
+        file_id = queued.json()["id"]
+        deadline = time.monotonic() + 30
+        while client.get(f"/api/v1/agents/{agent_id}/knowledge/{file_id}").json()["status"] != "ready":
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        assert client.get(f"/api/v1/agents/{agent_id}/knowledge/{file_id}").json()["chunk_count"] == 1
+        assert client.get(f"/api/v1/agents/{agent_id}/knowledge/{file_id + 100}").status_code == 404
+
+        rejected = client.post(
+            f"/api/v1/agents/{agent_id}/knowledge", params={"wait": True}, files={"file": ("x.bin", b"\xff\xfe", "text/plain")}
+        )
+        assert rejected.status_code == 400 and "UTF-8" in rejected.json()["detail"]
@@ -0,0 +1,121 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock, AsyncMock
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session, get_session_factory
+from dependencies import get_mcp_manager, get_zai_client, get_llm_scheduler, get_write_buffer
+from models import Agent
+from db_worker import DBWorker
+from write_behind import WriteBehindBuffer
+from fake_zai_server import create_app, FakeZaiConfig
+from llm_scheduler import LLMScheduler, Priority, AdmissionTimeout
+from zai_client import ZaiClient
+
+
+async def run_queued(scheduler: LLMScheduler, requests):
+    """Hold the only slot, queue `requests` (priority, flow) and return the order they are admitted in."""
+    order = []
+    await scheduler.acquire(Priority.INTERACTIVE)
+
+    async def worker(label, priority, flow):
+        async with scheduler.slot(priority, flow=flow):
+            order.append(label)
+
+    tasks = []
+    for label, priority, flow in requests:
+        tasks.append(asyncio.create_task(worker(label, priority, flow)))
+        await asyncio.sleep(0)  # enqueue in submission order
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+@pytest.mark.asyncio
+async def test_priority_classes_are_served_in_order():
+    scheduler = LLMScheduler(capacity=1)
+    order = await run_queued(scheduler, [
+        ("batch", Priority.BATCH, "a"),
+        ("api", Priority.API, "a"),
+        ("interactive", Priority.INTERACTIVE, "a"),
+    ])
+    assert order == ["interactive", "api", "batch"]
+    assert scheduler.stats()["classes"]["batch"]["admitted"] == 1
+
+
+@pytest.mark.asyncio
+async def test_agents_share_a_class_fairly():
+    scheduler = LLMScheduler(capacity=1)
+    burst = [(f"a{i}", Priority.BATCH, "agent:1") for i in range(4)]
+    late = [(f"b{i}", Priority.BATCH, "agent:2") for i in range(2)]
+    order = await run_queued(scheduler, burst + late)
+    # agent:2 arrives after agent:1's burst but is interleaved instead of waiting behind it
+    assert order == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+@pytest.mark.asyncio
+async def test_weights_skew_the_share():
+    scheduler = LLMScheduler(capacity=1)
+    scheduler.set_weight("agent:1", 2)
+    order = await run_queued(scheduler, [(f"a{i}", Priority.API, "agent:1") for i in range(4)] + [(f"b{i}", Priority.API, "agent:2") for i in range(2)])
+    assert order == ["a0", "b0", "a1", "a2", "b1", "a3"]
+
+
+@pytest.mark.asyncio
+async def test_admission_deadline_rejects_and_frees_the_queue():
+    scheduler = LLMScheduler(capacity=1)
+    await scheduler.acquire(Priority.INTERACTIVE)
+
+    with pytest.raises(AdmissionTimeout):
+        await scheduler.acquire(Priority.API, deadline=0.05)
+    assert scheduler.stats()["classes"]["api"]["rejected"] == 1
+    assert scheduler.queued() == 0
+
+    scheduler.release()
+    # The timed-out waiter does not keep the slot
+    await asyncio.wait_for(scheduler.acquire(Priority.BATCH), 1)
+    assert scheduler.in_flight == 1
+
+
+def test_rest_chat_returns_503_when_not_admitted_in_time():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+    agent = Agent(name="Bulk", system_prompt="Be brief.", model="glm-4.5-flash")
+    session.add(agent)
+    session.commit()
+
+    mcp_manager = MagicMock()
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    # Saturated scheduler: every slot is taken and batch work may only wait 50ms
+    scheduler = LLMScheduler(capacity=0, deadlines={Priority.API: None, Priority.BATCH: 0.05})
+
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_llm_scheduler] = lambda: scheduler
+    try:
+        client = TestClient(app)
+        response = client.post("/api/v1/chat/", json={"agent_id": agent.id, "message": "hi", "priority": "batch"})
+        assert response.status_code == 503
+        assert fake.state.stats.requests == 0
+
+        scheduler.capacity = 1
+        response = client.post("/api/v1/chat/", json={"agent_id": agent.id, "message": "hi", "priority": "batch"})
+        assert response.status_code == 200
+        assert response.json()["response"] == "token0 token1 token2 "
+        assert scheduler.stats()["classes"]["batch"]["admitted"] == 1
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session
+from dependencies import get_mcp_manager, get_script_index
+from mcp_manager import MCPManager
+from models import MCPServer
+from script_index import ScriptIndex
+
+
+@pytest.fixture(name="setup")
+def setup_fixture(tmp_path):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    (tmp_path / "tools").mkdir()
+    (tmp_path / "calc.py").write_text("print('calc')")
+    (tmp_path / "tools" / "main.py").write_text("print('main')")
+    with Session(engine) as session:
+        session.add_all([
+            MCPServer(name="calc", script="calc.py"),
+            MCPServer(name="nested", script="tools/main.py"),
+            MCPServer(name="gone", script="gone.py"),
+        ])
+        session.commit()
+
+    manager = MCPManager()
+    scripts = ScriptIndex(str(tmp_path))
+    saved_overrides = dict(app.dependency_overrides)
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_mcp_manager] = lambda: manager
+    app.dependency_overrides[get_script_index] = lambda: scripts
+    yield engine, manager, scripts, tmp_path
+    app.dependency_overrides.clear()
+    app.dependency_overrides.update(saved_overrides)
+
+
+def test_listing_merges_snapshot_and_script_index(setup):
+    engine, manager, scripts, tmp_path = setup
+    client = TestClient(app)
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    servers = client.get("/api/v1/mcp/servers").json()
+    event.remove(engine, "before_cursor_execute", record)
+
+    assert len(statements) == 1
+    assert [s["status"] for s in servers] == ["ready", "ready", "missing_script"]
+
+    asyncio.run(manager.spawn_mcp(str(servers[0]["id"]), "python", [], cwd=str(tmp_path)))
+    manager._set_state(str(servers[1]["id"]), status="error", last_error="boom")
+    servers = client.get("/api/v1/mcp/servers").json()
+    assert [s["status"] for s in servers] == ["registered", "error", "missing_script"]
+    assert servers[1]["last_error"] == "boom"
+
+    # Runtime status is merged into the response, not written to the rows
+    with Session(engine) as session:
+        assert {s.status for s in session.exec(select(MCPServer))} == {"stopped"}
+
+
+def test_script_index_rescans_only_on_directory_changes(setup):
+    _, _, scripts, tmp_path = setup
+    client = TestClient(app)
+
+    for _ in range(3):
+        client.get("/api/v1/mcp/servers")
+    assert scripts.scans == 1
+
+    (tmp_path / "gone.py").write_text("print('back')")
+    assert client.get("/api/v1/mcp/servers").json()[2]["status"] == "ready"
+    (tmp_path / "tools" / "main.py").unlink()
+    assert client.get("/api/v1/mcp/servers").json()[1]["status"] == "missing_script"
+    assert scripts.scans == 3
+
+    assert scripts.exists(os.path.join(str(tmp_path), "calc.py"))
+    assert not scripts.exists("../calc.py")
+
+
+def test_pagination_and_conditional_get(setup):
+    _, manager, _, _ = setup
+    client = TestClient(app)
+
+    first = client.get("/api/v1/mcp/servers", params={"limit": 2})
+    assert [s["name"] for s in first.json()] == ["calc", "nested"]
+    rest = client.get("/api/v1/mcp/servers", params={"limit": 2, "after": first.headers["X-Next-Cursor"]})
+    assert [s["name"] for s in rest.json()] == ["gone"] and "X-Next-Cursor" not in rest.headers
+
+    full = client.get("/api/v1/mcp/servers")
+    etag = full.headers["ETag"]
+    assert client.get("/api/v1/mcp/servers", headers={"If-None-Match": etag}).status_code == 304
+
+    manager._set_state(str(full.json()[0]["id"]), status="active")
+    changed = client.get("/api/v1/mcp/servers", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.json()[0]["status"] == "active"
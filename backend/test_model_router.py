@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from fake_zai_server import create_app, FakeZaiConfig
+from model_router import ModelRouter, RoutingPolicy
+from zai_client import ZaiClient
+
+
+@pytest.mark.asyncio
+async def test_falls_back_on_rate_limit():
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3, rate_limit_models=["glm-4.6"]))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    router = ModelRouter()
+    policy = RoutingPolicy(fallback_model="glm-4.5-flash")
+
+    stream = router.stream(
+        lambda m: zai.chat_stream(messages=[{"role": "user", "content": "hi"}], model=m, max_retries=0),
+        "glm-4.6",
+        policy
+    )
+    content = ""
+    async for chunk in stream:
+        if chunk.choices:
+            content += chunk.choices[0].delta.content or ""
+
+    assert content == "token0 token1 token2 "
+    assert stream.route.model == "glm-4.5-flash"
+    assert stream.route.kind == "fallback"
+    assert stream.route.reason == "http_429"
+    assert fake.state.stats.rate_limited == 1
+    assert router.stats()["routes"] == {"glm-4.5-flash:fallback": 1}
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_without_fallback_raises():
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, rate_limit_models=["glm-4.6"]))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    router = ModelRouter()
+
+    with pytest.raises(Exception) as exc_info:
+        async for _ in router.stream(lambda m: zai.chat_stream(messages=[], model=m, max_retries=0), "glm-4.6"):
+            pass
+    assert getattr(exc_info.value, "status_code", None) == 429
+
+
+@pytest.mark.asyncio
+async def test_hedge_fires_after_learned_p95_and_cancels_loser():
+    router = ModelRouter()
+    for _ in range(50):
+        router.record_ttft("glm-4.6", 0.05)
+
+    calls = []
+    closed = []
+
+    def factory(model):
+        index = len(calls)
+        calls.append(model)
+
+        async def stream():
+            try:
+                # The first request stalls, the duplicate answers quickly.
+                await asyncio.sleep(5 if index == 0 else 0.01)
+                for token in ("a", "b"):
+                    yield f"{token}{index}"
+            finally:
+                closed.append(index)
+
+        return stream()
+
+    started = time.monotonic()
+    stream = router.stream(factory, "glm-4.6", RoutingPolicy(hedge=True))
+    items = [item async for item in stream]
+
+    assert items == ["a1", "b1"]
+    assert time.monotonic() - started < 1
+    assert calls == ["glm-4.6", "glm-4.6"]
+    assert stream.route.kind == "hedge"
+    assert 0 in closed  # the stalled primary was cancelled
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_until_ttft_is_learned():
+    router = ModelRouter()
+    calls = []
+
+    def factory(model):
+        calls.append(model)
+
+        async def stream():
+            await asyncio.sleep(0.2)
+            yield "only"
+
+        return stream()
+
+    items = [item async for item in router.stream(factory, "glm-4.6", RoutingPolicy(hedge=True))]
+    assert items == ["only"]
+    assert calls == ["glm-4.6"]
+    assert router.hedge_delay("glm-4.6") is None
+
+
+@pytest.mark.asyncio
+async def test_complete_falls_back_for_non_streaming_calls():
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=2, rate_limit_models=["glm-4.6"]))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+    router = ModelRouter()
+
+    message, route = await router.complete(
+        lambda m: zai.chat_once(messages=[{"role": "user", "content": "hi"}], model=m, max_retries=0),
+        "glm-4.6",
+        RoutingPolicy(fallback_model="glm-4.5-flash")
+    )
+    assert message.content == "token0 token1 "
+    assert (route.model, route.kind) == ("glm-4.5-flash", "fallback")
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_to_the_primary_after_it_failed_over():
+    router = ModelRouter()
+    for _ in range(50):
+        router.record_ttft("glm-4.6", 0.02)
+
+    class Overloaded(Exception):
+        status_code = 503
+
+    calls = []
+
+    def factory(model):
+        calls.append(model)
+
+        async def stream():
+            if model == "glm-4.6":
+                raise Overloaded("busy")
+            # The fallback takes well past the primary's hedge delay
+            await asyncio.sleep(0.3)
+            yield "fallback"
+
+        return stream()
+
+    stream = router.stream(factory, "glm-4.6", RoutingPolicy(fallback_model="glm-4.5-flash", hedge=True))
+    items = [item async for item in stream]
+
+    assert items == ["fallback"]
+    assert calls == ["glm-4.6", "glm-4.5-flash"]
+    assert stream.route.kind == "fallback"
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from agent_runtime import load_agent_mcp_servers, load_chat_history, load_knowledge_chunks, load_knowledge_files
+from knowledge_store import load_blob_contents
+from models import Agent, AgentMCPServer, ChatSession
+
+# Messages seeded for the plan checks; QUERY_PLAN_ROWS=1000000 reproduces production-sized history
+ROWS = int(os.getenv("QUERY_PLAN_ROWS", 200_000))
+AGENTS = 50
+SESSIONS = 2_000
+
+
+@pytest.fixture(scope="module")
+def engine(tmp_path_factory):
+    engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.db'}")
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        cursor.executemany(
+            "INSERT INTO zairag_agents (id, name, system_prompt, model, reasoning_enabled, hedge_enabled) "
+            "VALUES (?, ?, '', 'glm-4.5-flash', 1, 0)",
+            [(i, f"agent-{i}") for i in range(1, AGENTS + 1)]
+        )
+        cursor.executemany("INSERT INTO zairag_mcp_servers (id, name, script, command, args, cwd, env_vars, status) "
+                           "VALUES (?, ?, 's.py', 'python', '[]', '/app', '{}', 'stopped')",
+                           [(i, f"mcp-{i}") for i in range(1, 11)])
+        cursor.executemany("INSERT INTO zairag_agent_mcp_links (agent_id, mcp_server_id) VALUES (?, ?)",
+                           [(a, m) for a in range(1, AGENTS + 1) for m in range(1, 4)])
+        cursor.executemany("INSERT INTO zairag_agent_knowledge_files (agent_id, filename, status) "
+                           "VALUES (?, ?, 'ready')",
+                           [(a, f"file-{f}.md") for a in range(1, AGENTS + 1) for f in range(20)])
+        cursor.executemany(
+            "INSERT INTO zairag_chat_sessions (id, agent_id, total_tokens, prompt_tokens, completion_tokens, "
+            "cached_prompt_tokens) VALUES (?, ?, 0, 0, 0, 0)",
+            [(s, s % AGENTS + 1) for s in range(1, SESSIONS + 1)]
+        )
+        cursor.executemany("INSERT INTO zairag_chat_messages (chat_session_id, role, content) VALUES (?, 'user', 'hi')",
+                           ((i % SESSIONS + 1,) for i in range(ROWS)))
+        # Give the planner real statistics, as a long-running database would have
+        cursor.execute("ANALYZE")
+    return engine
+
+
+def query_plans(engine, operation):
+    """Run operation(session) and return the EXPLAIN QUERY PLAN details of every SELECT it issued."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        with Session(engine) as session:
+            operation(session)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    plans = []
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+            plans.append(" / ".join(row[-1] for row in rows))
+    return plans
+
+
+def assert_indexed(plans):
+    assert plans
+    for plan in plans:
+        # Every table is reached through an index or the primary key, never by a scan or a sort
+        assert ("USING" in plan and "INDEX" in plan) or "INTEGER PRIMARY KEY" in plan, plan
+        assert "SCAN" not in plan.replace("SCAN CONSTANT ROW", ""), plan
+        assert "TEMP B-TREE" not in plan, plan
+
+
+def test_chat_setup_queries_use_indexes(engine):
+    def chat_setup(session):
+        session.get(Agent, 7)
+        load_knowledge_files(session, 7)
+        load_agent_mcp_servers(session, 7)
+
+    plans = query_plans(engine, chat_setup)
+    assert len(plans) == 6  # agent, knowledge, links, one get per linked server
+    assert_indexed(plans)
+    assert "ix_zairag_agent_knowledge_files_agent_id_filename" in plans[1]
+
+
+def test_knowledge_reads_use_indexes(engine):
+    plans = query_plans(engine, lambda session: (
+        load_knowledge_chunks(session, 7), load_blob_contents(session, ["a" * 64, "b" * 64])
+    ))
+    assert_indexed(plans)
+    assert "ix_zairag_agent_knowledge_files_agent_id_filename" in plans[0]
+
+
+def test_history_reads_use_the_session_index(engine):
+    plans = query_plans(engine, lambda session: (
+        load_chat_history(session, 42),
+        load_chat_history(session, 42, 20),
+        # A page of a session reload: after its summary, before the page already read
+        load_chat_history(session, 42, 20, after_id=ROWS // 10, before_id=ROWS // 2),
+    ))
+    assert_indexed(plans)
+    assert all("ix_zairag_chat_messages_chat_session_id_id" in plan for plan in plans)
+
+
+def test_sessions_by_agent_and_links_by_server_use_indexes(engine):
+    plans = query_plans(engine, lambda session: (
+        session.exec(select(ChatSession).where(ChatSession.agent_id == 3)).all(),
+        session.exec(select(AgentMCPServer).where(AgentMCPServer.mcp_server_id == 2)).all(),
+    ))
+    assert_indexed(plans)
+    assert "ix_zairag_chat_sessions_agent_id" in plans[0]
+    assert "ix_zairag_agent_mcp_links_mcp_server_id" in plans[1]
+
+
+def test_history_is_ordered_and_limited(engine):
+    with Session(engine) as session:
+        history = load_chat_history(session, 42)
+        latest = load_chat_history(session, 42, 20)
+    assert len(history) == ROWS // SESSIONS
+    assert [m.id for m in history] == sorted(m.id for m in history)
+    assert latest == history[-20:]
@@ -0,0 +1,255 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock, MagicMock
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+from chat_memory import SUMMARY_HEADER, ChatMemory, MemoryPolicy
+from database import get_session, get_session_factory
+from db_worker import DBWorker
+from dependencies import get_chat_sessions, get_mcp_manager, get_write_buffer, get_zai_client
+from fake_zai_server import FakeZaiConfig, create_app
+from main import app
+from models import Agent, ChatMessage, ChatSession
+from session_store import (HISTORY_PAGE, ChatSessionStore, StoredSession, StoredTurn, load_session,
+                           store_messages, store_summary)
+from write_behind import WriteBehindBuffer
+from zai_client import ZaiClient
+
+
+def ten_per_message(message):
+    return 10
+
+
+def settings(window_tokens=100, pinned_turns=1, summary_model=""):
+    return ("Be brief.", MemoryPolicy(window_tokens=window_tokens, pinned_turns=pinned_turns,
+                                      summary_model=summary_model), ten_per_message, None)
+
+
+def seeded_engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all([Agent(name="Chatty", system_prompt="Be brief.", model="glm-4.5-flash"),
+                         Agent(name="Other", system_prompt="Be long.", model="glm-4.5-flash")])
+        session.add(ChatSession(agent_id=1))
+        session.commit()
+    return engine
+
+
+def store_turns(engine, chat_session_id, count):
+    with Session(engine) as session:
+        for i in range(count):
+            store_messages(session, chat_session_id, [("user", f"q{i}"), ("tool", f"Tool: t\nResult: r{i}"), ("assistant", f"a{i}")])
+
+
+def test_reload_reads_only_the_window_after_the_summary():
+    engine = seeded_engine()
+    store_turns(engine, 1, 200)
+    with Session(engine) as session:
+        store_summary(session, 1, "older stuff", 30)
+        # An older summary doesn't overwrite a newer one
+        store_summary(session, 1, "stale", 12)
+
+    selects = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: selects.append(statement) if statement.startswith("SELECT") else None)
+    with Session(engine) as session:
+        stored = load_session(session, 1, MemoryPolicy(window_tokens=100, pinned_turns=1, summary_model="cheap"), ten_per_message)
+    # 200 tokens (window plus a window of backlog) at 30 per turn: the newest 6 turns
+    assert stored.summary == "older stuff" and stored.agent_id == 1
+    assert [turn.messages[0]["content"] for turn in stored.turns] == [f"q{i}" for i in range(194, 200)]
+    assert stored.turns[-1].messages == [
+        {"role": "user", "content": "q199"},
+        {"role": "assistant", "content": "Tool: t\nResult: r199"},
+        {"role": "assistant", "content": "a199"},
+    ]
+    assert stored.turns[-1].last_message_id == 600
+    # The session row, then one page of messages
+    assert len(selects) == 2
+
+    with Session(engine) as session:
+        everything = load_session(session, 1, MemoryPolicy(window_tokens=0), ten_per_message)
+        missing = load_session(session, 99, MemoryPolicy(), ten_per_message)
+    # Paged back to the summary: messages up to id 30 (turns 0-9) are covered by it
+    assert len(everything.turns) == 190 and everything.turns[0].messages[0]["content"] == "q10"
+    assert 190 * 3 > HISTORY_PAGE and missing is None
+
+
+@pytest.mark.asyncio
+async def test_restored_memory_summarizes_its_backlog_and_saves_the_summary():
+    saved = []
+
+    async def summarize(previous, messages):
+        return f"{previous} + {len(messages)} messages"
+
+    async def save_summary(summary, through_id):
+        saved.append((summary, through_id))
+
+    turns = [StoredTurn([{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"}], 2 * i + 2)
+             for i in range(8)]
+    memory = ChatMemory("Be brief.", MemoryPolicy(window_tokens=100, pinned_turns=1, summary_model="cheap"),
+                        ten_per_message, summarize, save_summary)
+    memory.restore("earlier", turns)
+    await memory.settle()
+    # 160 tokens > 100: the oldest turns went, down to 60% of the window
+    assert saved == [("earlier + 10 messages", 10)]
+    prompt = memory.messages()
+    assert prompt[1]["content"] == SUMMARY_HEADER + "earlier + 10 messages"
+    assert prompt[2]["content"] == "q5"
+
+
+@pytest.mark.asyncio
+async def test_store_keeps_recent_sessions_and_shares_loads():
+    store = ChatSessionStore(max_sessions=2)
+    loads = []
+
+    def loader(chat_session_id, agent_id=1):
+        async def load():
+            loads.append(chat_session_id)
+            await asyncio.sleep(0.01)
+            return StoredSession(agent_id, "", [StoredTurn([{"role": "user", "content": "hi"}], 1)])
+        return load
+
+    first, again = await asyncio.gather(store.open(1, 1, settings(), loader(1)), store.open(1, 1, settings(), loader(1)))
+    assert first is again and loads == [1]
+    assert [m["content"] for m in first.memory.messages()] == ["Be brief.", "hi"]
+
+    # Another agent's session isn't opened (nor kept)
+    assert await store.open(2, 1, settings(), loader(2, agent_id=2)) is None
+    assert await store.open(1, 2, settings(), loader(1)) is None
+
+    store.create(3, 1, settings())
+    store.create(4, 1, settings())
+    assert store.stats()["evictions"] == 1 and store.stats()["sessions"] == 2
+    # Reopening picks up the agent's current settings
+    reopened = await store.open(4, 1, ("Be kind.",) + settings()[1:], loader(4))
+    assert reopened.memory.messages()[0]["content"] == "Be kind."
+    assert loads == [1, 2]
+
+
+class RecordingTransport(httpx.ASGITransport):
+    def __init__(self, app):
+        super().__init__(app=app)
+        self.bodies = []
+
+    async def handle_async_request(self, request):
+        self.bodies.append(json.loads(await request.aread()))
+        return await super().handle_async_request(request)
+
+
+@pytest.fixture
+def chat_app():
+    engine = seeded_engine()
+    transport = RecordingTransport(create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3)))
+    mcp_manager = MagicMock()
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    store = ChatSessionStore()
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: Session(engine)
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_chat_sessions] = lambda: store
+    app.dependency_overrides[get_zai_client] = lambda: ZaiClient(
+        api_key="test-key", base_url="http://fake-zai", transport=transport
+    )
+    try:
+        yield engine, transport, store
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+
+
+def ask(websocket, message):
+    websocket.send_json({"message": message})
+    while True:
+        event = websocket.receive_json()
+        if event["type"] in ("done", "error"):
+            return event
+
+
+def test_websocket_reconnect_resumes_the_session(chat_app):
+    engine, transport, store = chat_app
+    client = TestClient(app)
+    with client.websocket_connect("/api/v1/ws/chat/1") as websocket:
+        session_id = ask(websocket, "my name is Ada")["session_id"]
+
+    # Hot: the memory was kept in the store
+    with client.websocket_connect(f"/api/v1/ws/chat/1?session_id={session_id}") as websocket:
+        assert ask(websocket, "what is my name?")["session_id"] == session_id
+    assert [m["content"] for m in transport.bodies[-1]["messages"] if m["role"] == "user"] == [
+        "my name is Ada", "what is my name?"
+    ]
+
+    # Cold: after a restart the memory is rebuilt from the stored messages
+    app.dependency_overrides[get_chat_sessions] = lambda: ChatSessionStore()
+    with client.websocket_connect(f"/api/v1/ws/chat/1?session_id={session_id}") as websocket:
+        ask(websocket, "and again?")
+    prompt = transport.bodies[-1]["messages"]
+    assert [m["role"] for m in prompt] == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert prompt[1]["content"] == "my name is Ada" and prompt[-1]["content"] == "and again?"
+    with Session(engine) as session:
+        assert len(session.exec(select(ChatMessage).where(ChatMessage.chat_session_id == session_id)).all()) == 6
+
+    # Unknown sessions, and sessions of another agent, are refused
+    for url in ("/api/v1/ws/chat/1?session_id=999", f"/api/v1/ws/chat/2?session_id={session_id}"):
+        with client.websocket_connect(url) as websocket:
+            assert websocket.receive_json() == {"type": "error", "content": "Chat session not found"}
+
+
+def test_rest_chat_continues_a_session(chat_app):
+    engine, transport, store = chat_app
+    client = TestClient(app)
+    first = client.post("/api/v1/chat/", json={"agent_id": 1, "message": "my name is Ada"})
+    assert first.status_code == 200, first.text
+    session_id = first.json()["session_id"]
+
+    second = client.post("/api/v1/chat/", json={"agent_id": 1, "message": "what is my name?", "session_id": session_id})
+    assert second.status_code == 200 and second.json()["session_id"] == session_id
+    prompt = transport.bodies[-1]["messages"]
+    assert [m["role"] for m in prompt] == ["system", "user", "assistant", "user"]
+    assert prompt[1]["content"] == "my name is Ada"
+
+    # A REST session can be picked up over the WebSocket, with the stored history
+    app.dependency_overrides[get_chat_sessions] = lambda: ChatSessionStore()
+    with TestClient(app).websocket_connect(f"/api/v1/ws/chat/1?session_id={session_id}") as websocket:
+        ask(websocket, "still there?")
+    assert len(transport.bodies[-1]["messages"]) == 6
+
+    missing = client.post("/api/v1/chat/", json={"agent_id": 1, "message": "hi", "session_id": 999})
+    assert missing.status_code == 404
+
+
+def test_rest_chat_stores_a_new_session_only_once_its_turn_succeeds(chat_app):
+    engine, transport, store = chat_app
+    writes = WriteBehindBuffer(lambda: Session(engine), DBWorker(), flush_ms=60000)
+    app.dependency_overrides[get_write_buffer] = lambda: writes
+    with Session(engine) as session:
+        agent = session.get(Agent, 2)
+        agent.context_budget_tokens = 5
+        session.add(agent)
+        session.commit()
+    client = TestClient(app)
+
+    # Rejected before reaching the model: no session row is left behind
+    rejected = client.post("/api/v1/chat/", json={"agent_id": 2, "message": "hi"})
+    assert rejected.status_code == 413
+    with Session(engine) as session:
+        assert len(session.exec(select(ChatSession)).all()) == 1
+    assert store.stats()["sessions"] == 0
+
+    answered = client.post("/api/v1/chat/", json={"agent_id": 1, "message": "hi"})
+    assert answered.status_code == 200, answered.text
+    asyncio.run(writes.flush())
+    with Session(engine) as session:
+        chat_session = session.get(ChatSession, answered.json()["session_id"])
+        # The completion's usage is added to the new session
+        assert chat_session.prompt_tokens > 0 and chat_session.completion_tokens == 3
+        assert chat_session.total_tokens == chat_session.prompt_tokens + 3
+    assert store.stats()["sessions"] == 1
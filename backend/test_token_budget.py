@@ -0,0 +1,140 @@
+import httpx
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock, AsyncMock
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session, get_session_factory
+from dependencies import get_mcp_manager, get_zai_client, get_token_estimator, get_write_buffer
+from knowledge_store import add_knowledge_text
+from models import Agent, ChatMessage
+from db_worker import DBWorker
+from write_behind import WriteBehindBuffer
+from fake_zai_server import create_app, FakeZaiConfig
+from token_budget import TokenEstimator
+from zai_client import ZaiClient
+
+
+def test_report_splits_prompt_by_source():
+    estimator = TokenEstimator()
+    knowledge = "File: faq.txt\nContent:\n" + "x" * 700
+    messages = [
+        {"role": "system", "content": "Be brief." + knowledge},
+        {"role": "user", "content": "a" * 70},
+        {"role": "assistant", "tool_calls": [{"id": "c1", "type": "function", "function": {"name": "lookup", "arguments": "{}"}}]},
+        {"role": "tool", "tool_call_id": "c1", "content": "r" * 350},
+    ]
+    tools = [{"type": "function", "function": {"name": "lookup", "parameters": {"type": "object"}}}]
+
+    report = estimator.report(messages, tools, knowledge_context=knowledge, budget=1000)
+
+    assert report.knowledge > report.system_prompt > 0
+    assert report.history > 20
+    assert report.tool_results > 100
+    assert report.tools > 0
+    assert report.total == report.system_prompt + report.knowledge + report.history + report.tools + report.tool_results
+    assert not report.over_budget
+
+
+def test_estimator_calibrates_towards_upstream_usage():
+    estimator = TokenEstimator()
+    text = "hello world " * 100
+    initial = estimator.count_text(text, "glm-4.6")
+
+    for _ in range(30):
+        estimator.observe("glm-4.6", estimator.count_text(text, "glm-4.6"), initial * 2)
+
+    assert abs(estimator.count_text(text, "glm-4.6") - initial * 2) <= 2
+    # Calibration is per model
+    assert estimator.count_text(text, "glm-4.5-flash") == initial
+
+
+def setup_app(budget):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+    agent = Agent(
+        name="Tight", system_prompt="Be brief.", model="glm-4.5-flash", context_budget_tokens=budget, knowledge_mode="full"
+    )
+    session.add(agent)
+    session.commit()
+    add_knowledge_text(session, agent.id, "kb.txt", "knowledge " * 100)
+    session.commit()
+
+    mcp_manager = MagicMock()
+    mcp_manager.list_mcp_tools = AsyncMock(return_value=[])
+    fake = create_app(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=3))
+    zai = ZaiClient(api_key="test-key", base_url="http://fake-zai", transport=httpx.ASGITransport(app=fake))
+
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_mcp_manager] = lambda: mcp_manager
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    app.dependency_overrides[get_token_estimator] = lambda: TokenEstimator()
+    return session, agent, fake
+
+
+def test_websocket_rejects_over_budget_turn_and_keeps_session():
+    saved_overrides = dict(app.dependency_overrides)
+    session, agent, fake = setup_app(budget=400)
+    try:
+        client = TestClient(app)
+        with client.websocket_connect(f"/api/v1/ws/chat/{agent.id}") as websocket:
+            websocket.send_json({"message": "y" * 2000})
+            rejected = websocket.receive_json()
+
+            websocket.send_json({"message": "short question"})
+            events = []
+            while not events or events[-1]["type"] not in ("done", "error"):
+                events.append(websocket.receive_json())
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+
+    assert rejected["type"] == "error"
+    assert rejected["budget"]["budget"] == 400
+    assert rejected["budget"]["history"] > rejected["budget"]["knowledge"] > 0
+    assert fake.state.stats.requests == 1  # only the short turn reached upstream
+
+    done = events[-1]
+    assert done["type"] == "done"
+    assert done["budget"]["total"] <= 400
+    # The rejected message wasn't stored with the session
+    stored = session.exec(select(ChatMessage).order_by(ChatMessage.id)).all()
+    assert [(m.role, m.content) for m in stored] == [("user", "short question"), ("assistant", "token0 token1 token2 ")]
+
+
+def test_rest_chat_returns_413_over_budget():
+    saved_overrides = dict(app.dependency_overrides)
+    session, agent, fake = setup_app(budget=100)
+    try:
+        response = TestClient(app).post("/api/v1/chat/", json={"agent_id": agent.id, "message": "hello"})
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+
+    assert response.status_code == 413
+    assert response.json()["detail"]["budget"]["knowledge"] > 100
+    assert fake.state.stats.requests == 0
+
+
+def test_rest_chat_calibrates_the_estimator():
+    saved_overrides = dict(app.dependency_overrides)
+    session, agent, fake = setup_app(budget=None)
+    estimator = TokenEstimator()
+    app.dependency_overrides[get_token_estimator] = lambda: estimator
+    try:
+        response = TestClient(app).post("/api/v1/chat/", json={"agent_id": agent.id, "message": "hello"})
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+
+    assert response.status_code == 200, response.text
+    # Observed against the prompt_tokens the upstream reported
+    assert estimator.samples == {"glm-4.5-flash": 1}
+    assert estimator.scales["glm-4.5-flash"] != 1.0
@@ -1,6 +1,6 @@
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 import asyncio
 from sqlmodel import Session, SQLModel, create_engine, select
 from fastapi import FastAPI
@@ -10,26 +10,34 @@ import sys
 # Adjust path to import main from the parent directory
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from main import app
-from database import get_session
-from dependencies import get_zai_client
+from database import get_session, get_session_factory
+from dependencies import get_zai_client, get_write_buffer
+from db_worker import DBWorker
+from write_behind import WriteBehindBuffer
 from models import Agent, ChatSession, ChatMessage, AgentKnowledgeFile, MCPServer, AgentMCPServer
+from zai_client import StreamDelta
 
-# Setup for in-memory SQLite for testing
-engine = create_engine("sqlite:///test.db")
+# A file database per test: the write-behind buffer writes from the DB worker's threads
+@pytest.fixture(name="engine")
+def engine_fixture(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
 
 @pytest.fixture(name="session")
-def session_fixture():
-    SQLModel.metadata.create_all(engine)
+def session_fixture(engine):
     with Session(engine) as session:
         yield session
-    SQLModel.metadata.drop_all(engine)
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):
+def client_fixture(session: Session, engine):
     def get_session_override():
         return session
     
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_write_buffer] = lambda: WriteBehindBuffer(lambda: Session(engine), DBWorker())
 
     # Mock the ZaiClient
     mock_zai_client = AsyncMock()
@@ -51,36 +59,21 @@ def test_websocket_chat_reasoning_content_fallback(client: TestClient, session:
     # Configure mock_zai_client to return specific chunks
     mock_zai_client = app.dependency_overrides[get_zai_client]()
     
-    async def mock_chat_stream(*args, **kwargs):
+    async def mock_stream_deltas(*args, **kwargs):
         # Simulate a stream where content is empty but reasoning_content exists
-        class MockDelta:
-            def __init__(self, content=None, reasoning_content=None, tool_calls=None):
-                self.content = content
-                self.reasoning_content = reasoning_content
-                self.tool_calls = tool_calls or []
-
-        class MockChoice:
-            def __init__(self, delta):
-                self.delta = delta
-
-        class MockChunk:
-            def __init__(self, choices):
-                self.choices = choices
-                self.usage = None 
-
-        # First chunk: empty content, but reasoning content
-        yield MockChunk(choices=[MockChoice(delta=MockDelta(content="", reasoning_content="This is the reasoning part. "))])
-        await asyncio.sleep(0.01) 
+        # (StreamDelta: content, reasoning, tool_calls, usage)
+        yield StreamDelta("", "This is the reasoning part. ", None, None)
+        await asyncio.sleep(0.01)
         # Second chunk: normal content
-        yield MockChunk(choices=[MockChoice(delta=MockDelta(content="This is the content part."))])
+        yield StreamDelta("This is the content part.", None, None, None)
         await asyncio.sleep(0.01)
         # Third chunk: empty content, but reasoning content
-        yield MockChunk(choices=[MockChoice(delta=MockDelta(content=None, reasoning_content="More reasoning. "))])
+        yield StreamDelta(None, "More reasoning. ", None, None)
         await asyncio.sleep(0.01)
         # Final chunk
-        yield MockChunk(choices=[MockChoice(delta=MockDelta(content="Final piece."))])
+        yield StreamDelta("Final piece.", None, None, None)
 
-    mock_zai_client.chat_stream.return_value = mock_chat_stream()
+    mock_zai_client.stream_deltas = MagicMock(side_effect=mock_stream_deltas)
 
     # Connect to the websocket
     with client.websocket_connect(f"/api/v1/ws/chat/{agent_id}") as websocket:
@@ -89,7 +82,7 @@ def test_websocket_chat_reasoning_content_fallback(client: TestClient, session:
         received_tokens = []
         full_response = ""
 
-        # Expect 4 token chunks and 1 done message
+        # Expect up to 4 token frames and 1 done message
         for _ in range(5): 
             response = websocket.receive_json()
             if response["type"] == "token":
@@ -99,13 +92,9 @@ def test_websocket_chat_reasoning_content_fallback(client: TestClient, session:
                 break
         
         expected_response = "This is the reasoning part. This is the content part.More reasoning. Final piece."
+        # Consecutive tokens may be coalesced into fewer frames
         assert full_response == expected_response
-        assert received_tokens == [
-            "This is the reasoning part. ", 
-            "This is the content part.", 
-            "More reasoning. ", 
-            "Final piece."
-        ]
+        assert 1 <= len(received_tokens) <= 4
     
     # Verify chat session and messages are saved
     chat_sessions = session.exec(select(ChatSession)).all()
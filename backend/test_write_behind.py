@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+from db_worker import DBWorker
+from models import Agent, ChatMessage, ChatSession
+from write_behind import WriteBehindBuffer
+
+
+def make_db(sessions: int = 2):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        agent = Agent(name="A", system_prompt="", model="glm-4.5-flash")
+        session.add(agent)
+        session.commit()
+        ids = []
+        for _ in range(sessions):
+            chat_session = ChatSession(agent_id=agent.id)
+            session.add(chat_session)
+            session.commit()
+            ids.append(chat_session.id)
+    return engine, ids
+
+
+@pytest.mark.asyncio
+async def test_messages_and_usage_from_many_sessions_share_one_transaction():
+    engine, (first, second) = make_db()
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(1))
+    writes = WriteBehindBuffer(lambda: Session(engine), DBWorker(), flush_ms=10_000)
+
+    for i in range(3):
+        await writes.add_message(first, "user", f"q{i}")
+        await writes.add_message(second, "assistant", f"a{i}")
+    writes.add_usage(first, prompt_tokens=10, completion_tokens=5, total_tokens=15)
+    writes.add_usage(first, prompt_tokens=1, total_tokens=1, cached_prompt_tokens=8)
+    assert await writes.flush()
+
+    assert len(commits) == 1
+    with Session(engine) as session:
+        rows = session.exec(select(ChatMessage).order_by(ChatMessage.id)).all()
+        assert [(m.chat_session_id, m.content) for m in rows] == [
+            (first, "q0"), (second, "a0"), (first, "q1"), (second, "a1"), (first, "q2"), (second, "a2")
+        ]
+        usage = session.get(ChatSession, first)
+        assert (usage.prompt_tokens, usage.completion_tokens, usage.total_tokens, usage.cached_prompt_tokens) == (11, 5, 16, 8)
+    assert writes.stats()["flushes"] == 1 and writes.stats()["max_batch_rows"] == 7
+
+
+@pytest.mark.asyncio
+async def test_buffer_flushes_on_its_own_after_the_interval():
+    engine, (chat_session_id, _) = make_db()
+    writes = WriteBehindBuffer(lambda: Session(engine), DBWorker(), flush_ms=20)
+    await writes.add_message(chat_session_id, "user", "hello")
+    await asyncio.sleep(0.2)
+    assert writes.pending == 0 and writes.flushes == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_rows_until_close():
+    engine, (chat_session_id, _) = make_db()
+    broken = True
+
+    def session_factory():
+        if broken:
+            raise RuntimeError("database unavailable")
+        return Session(engine)
+
+    writes = WriteBehindBuffer(session_factory, DBWorker(), flush_ms=10_000)
+    await writes.add_message(chat_session_id, "user", "first")
+    assert not await writes.flush()
+    await writes.add_message(chat_session_id, "assistant", "second")
+    writes.add_usage(chat_session_id, total_tokens=3)
+    assert writes.pending == 3 and writes.failed_flushes == 1
+
+    broken = False
+    await writes.close()  # graceful shutdown writes everything that is left
+    with Session(engine) as session:
+        assert [m.content for m in session.exec(select(ChatMessage).order_by(ChatMessage.id))] == ["first", "second"]
+        assert session.get(ChatSession, chat_session_id).total_tokens == 3
+    assert writes.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_rejected_row_is_dead_lettered_after_repeated_failures():
+    engine, (chat_session_id, _) = make_db()
+    writes = WriteBehindBuffer(lambda: Session(engine), DBWorker(), flush_ms=10_000, max_attempts=2)
+    await writes.add_message(chat_session_id, "user", "before")
+    await writes.add_message(chat_session_id, "assistant", None)  # NOT NULL: the database will never take it
+    await writes.add_message(chat_session_id, "user", "after")
+    writes.add_usage(chat_session_id, total_tokens=5)
+
+    assert not await writes.flush() and not await writes.flush()
+    assert writes.pending == 4
+    # Third attempt goes row by row: the bad row is set aside, the rest is stored
+    assert await writes.flush()
+    assert writes.pending == 0 and writes.dead_lettered == 1
+    assert writes.dead_letters[0]["row"]["role"] == "assistant" and writes.stats()["rows_written"] == 3
+    with Session(engine) as session:
+        assert [m.content for m in session.exec(select(ChatMessage).order_by(ChatMessage.id))] == ["before", "after"]
+        assert session.get(ChatSession, chat_session_id).total_tokens == 5
+
+    # Back to batched writes once a flush succeeds
+    await writes.add_message(chat_session_id, "user", "later")
+    assert await writes.flush() and writes.dead_lettered == 1
+
+
+@pytest.mark.asyncio
+async def test_outage_keeps_rows_and_holds_writers_back_when_full():
+    engine, (chat_session_id, _) = make_db()
+    broken = True
+
+    def session_factory():
+        if broken:
+            raise RuntimeError("database unavailable")
+        return Session(engine)
+
+    writes = WriteBehindBuffer(session_factory, DBWorker(), flush_ms=20, max_attempts=1, max_pending=3)
+    for i in range(3):
+        await writes.add_message(chat_session_id, "user", f"q{i}")
+    # Row-by-row writes during an outage don't dead-letter anything
+    assert not await writes.flush() and not await writes.flush()
+    assert writes.pending == 3 and writes.dead_lettered == 0
+
+    # Full: the next message waits for room instead of growing the buffer or being dropped
+    overflow = asyncio.create_task(writes.add_message(chat_session_id, "user", "overflow"))
+    await asyncio.sleep(0.1)
+    assert not overflow.done() and writes.pending == 3 and writes.backpressure_waits == 1
+
+    broken = False
+    await asyncio.wait_for(overflow, 1)
+    assert await writes.flush() and writes.dead_lettered == 0
+    with Session(engine) as session:
+        assert [m.content for m in session.exec(select(ChatMessage).order_by(ChatMessage.id))] == ["q0", "q1", "q2", "overflow"]
@@ -0,0 +1,117 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from main import app
+from database import get_session, get_session_factory
+from dependencies import get_zai_client, get_write_buffer
+from db_worker import DBWorker
+from write_behind import WriteBehindBuffer
+from models import Agent
+from fake_zai_server import FakeZaiConfig
+from test_fake_zai_server import make_client
+import ws_protocol
+from ws_protocol import CompactWireFormat, JSON, UnsupportedWireFormat, available_formats, compact_frame, expand_frame, get_wire_format
+from routers.websocket_chat import manager
+
+
+EVENTS = [
+    {"type": "token", "content": "Hel"},
+    {"type": "tool_start", "tool": "add", "input": "{}"},
+    {"type": "tool_end", "result": "3"},
+    {"type": "queued", "position": 2, "eta_ms": None},
+    {"type": "error", "code": "busy", "content": "Server busy"},
+    {"type": "done", "tokens": {"prompt": 10, "completion": 3, "total": 13, "cached": 0}, "budget": None, "routes": []},
+]
+
+
+@pytest.mark.parametrize("event", EVENTS)
+def test_compact_frames_round_trip(event):
+    assert expand_frame(json.loads(CompactWireFormat().encode(event))) == event
+
+
+def test_compact_token_frames_are_smaller():
+    event = {"type": "token", "content": "Hel"}
+    assert compact_frame(event) == ["t", "Hel"]
+    assert len(CompactWireFormat().encode(event)) < len(JSON.encode(event)) / 2
+
+
+def test_decode_accepts_objects_and_plain_text():
+    assert JSON.decode({"type": "websocket.receive", "text": '{"message": "hi"}'}) == {"message": "hi"}
+    assert JSON.decode({"type": "websocket.receive", "text": "hi"}) == "hi"
+    assert JSON.decode({"type": "websocket.receive", "text": "42"}) == "42"
+
+
+def chat(agent_id: int, subprotocols=None):
+    """One turn; returns the decoded events (compact frames expanded) and the accepted subprotocol."""
+    events = []
+    with TestClient(app).websocket_connect(f"/api/v1/ws/chat/{agent_id}", subprotocols=subprotocols) as websocket:
+        accepted = websocket.accepted_subprotocol
+        websocket.send_json({"message": "hello"})
+        while True:
+            frame = json.loads(websocket.receive_text())
+            events.append(expand_frame(frame) if isinstance(frame, list) else frame)
+            if events[-1]["type"] in ("done", "error"):
+                break
+    return events, accepted
+
+
+@pytest.fixture(name="agent_id")
+def agent_fixture():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    session = Session(engine)
+    agent = Agent(name="Echo", system_prompt="Be brief.", model="glm-4.5-flash")
+    session.add(agent)
+    session.commit()
+
+    _, zai = make_client(FakeZaiConfig(ttft_ms=0, tokens_per_sec=0, response_tokens=20))
+    saved_overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_session] = lambda: session
+    app.dependency_overrides[get_session_factory] = lambda: lambda: Session(engine)
+    app.dependency_overrides[get_zai_client] = lambda: zai
+    writes = WriteBehindBuffer(lambda: Session(engine), DBWorker())
+    app.dependency_overrides[get_write_buffer] = lambda: writes
+    try:
+        yield agent.id
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(saved_overrides)
+        session.close()
+
+
+def test_compact_protocol_by_subprotocol_and_bytes_per_token_metric(agent_id):
+    json_events, accepted = chat(agent_id)
+    assert accepted is None
+    assert json_events[-1]["type"] == "done"
+
+    compact_events, accepted = chat(agent_id, subprotocols=["zai-chat.compact"])
+    assert accepted == "zai-chat.compact"
+    assert compact_events[-1]["type"] == "done"
+    text = lambda events: "".join(e["content"] for e in events if e["type"] == "token")
+    assert text(compact_events) == text(json_events) != ""
+
+    protocols = manager.stats()["protocols"]
+    assert protocols["compact"]["bytes_per_token"] < protocols["json"]["bytes_per_token"]
+
+
+def test_unknown_protocol_is_rejected(agent_id):
+    with TestClient(app).websocket_connect(f"/api/v1/ws/chat/{agent_id}?protocol=xml") as websocket:
+        event = websocket.receive_json()
+    assert event["type"] == "error" and "xml" in event["content"]
+
+
+def test_msgpack_falls_back_to_json_when_not_installed(agent_id, monkeypatch):
+    monkeypatch.setattr(ws_protocol, "msgpack", None)
+    assert available_formats() == ["json", "compact"]
+    with pytest.raises(UnsupportedWireFormat):
+        get_wire_format("msgpack")
+
+    # Offered as a subprotocol it's just not picked; asked for by name it's refused
+    events, accepted = chat(agent_id, subprotocols=["zai-chat.msgpack"])
+    assert accepted is None and events[-1]["type"] == "done"
+    with TestClient(app).websocket_connect(f"/api/v1/ws/chat/{agent_id}?protocol=msgpack") as websocket:
+        assert websocket.receive_json()["type"] == "error"
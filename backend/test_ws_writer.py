@@ -0,0 +1,116 @@
+import asyncio
+import json
+import time
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from ws_writer import ConnectionWriter, ClientTooSlow
+
+
+class StubSocket:
+    """Records frames; `stall` blocks sends until released (a slow client)."""
+
+    def __init__(self):
+        self.frames = []
+        self.closed = None
+        self.stall = asyncio.Event()
+        self.stall.set()
+
+    async def send_text(self, data):
+        await self.stall.wait()
+        self.frames.append(json.loads(data))
+
+    async def close(self, code=1000, reason=None):
+        self.closed = code
+
+
+@pytest.mark.asyncio
+async def test_tokens_are_coalesced_and_order_is_kept():
+    socket = StubSocket()
+    writer = ConnectionWriter(socket, coalesce_ms=50, coalesce_chars=10_000)
+    writer.start()
+
+    for i in range(100):
+        writer.send({"type": "token", "content": f"t{i} "})
+    writer.send({"type": "tool_start", "tool": "add", "input": "{}"})
+    writer.send({"type": "token", "content": "after"})
+    writer.send({"type": "done"})
+    await writer.close()
+
+    assert [f["type"] for f in socket.frames] == ["token", "tool_start", "token", "done"]
+    assert socket.frames[0]["content"] == "".join(f"t{i} " for i in range(100))
+    assert writer.tokens_in == 101 and writer.frames_sent == 4
+
+
+@pytest.mark.asyncio
+async def test_size_threshold_flushes_without_waiting_for_the_timer():
+    socket = StubSocket()
+    writer = ConnectionWriter(socket, coalesce_ms=10_000, coalesce_chars=8)
+    writer.start()
+    writer.send({"type": "token", "content": "1234"})
+    writer.send({"type": "token", "content": "5678"})
+    await asyncio.sleep(0.01)
+    assert socket.frames == [{"type": "token", "content": "12345678"}]
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_client_never_blocks_the_producer():
+    socket = StubSocket()
+    socket.stall.clear()
+    writer = ConnectionWriter(socket, coalesce_ms=0)
+    writer.start()
+
+    started = time.monotonic()
+    for i in range(1000):
+        writer.send({"type": "token", "content": "x"})
+    assert time.monotonic() - started < 0.5
+
+    # While the client is stuck, new tokens merge into the one unsent frame
+    socket.stall.set()
+    await writer.close()
+    assert "".join(f["content"] for f in socket.frames) == "x" * 1000
+    assert len(socket.frames) <= 2
+
+
+@pytest.mark.asyncio
+async def test_overflow_disconnects_a_client_that_falls_too_far_behind():
+    socket = StubSocket()
+    socket.stall.clear()
+    writer = ConnectionWriter(socket, coalesce_ms=0, max_buffer_chars=100)
+    writer.start()
+
+    with pytest.raises(ClientTooSlow):
+        for _ in range(20):
+            writer.send({"type": "token", "content": "0123456789"})
+    # Later sends keep failing like a disconnected socket
+    with pytest.raises(WebSocketDisconnect):
+        writer.send({"type": "done"})
+
+    socket.stall.set()
+    await writer.close()
+    assert socket.closed == 1013
+    assert writer.overflows == 1
+
+
+@pytest.mark.asyncio
+async def test_overflow_drop_policy_discards_text_and_reports_it():
+    socket = StubSocket()
+    socket.stall.clear()
+    writer = ConnectionWriter(socket, coalesce_ms=0, max_buffer_chars=100, overflow_policy="drop")
+    writer.start()
+    await asyncio.sleep(0)
+
+    for _ in range(20):
+        writer.send({"type": "token", "content": "0123456789"})
+    writer.send({"type": "done"})
+
+    socket.stall.set()
+    await writer.close()
+    assert socket.frames[-1] == {"type": "done"}
+    overflow = [f for f in socket.frames if f["type"] == "overflow"]
+    assert overflow and writer.dropped_chars == sum(f["dropped_chars"] for f in overflow)
+    sent = sum(len(f["content"]) for f in socket.frames if f["type"] == "token")
+    assert sent + writer.dropped_chars == 200
+    assert socket.closed is None
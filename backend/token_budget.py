@@ -0,0 +1,145 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from chat_memory import SUMMARY_HEADER
+
+# GLM-4.5 models accept 128k tokens; leave room for the 2000 token completion.
+DEFAULT_CONTEXT_BUDGET_TOKENS = int(os.getenv("DEFAULT_CONTEXT_BUDGET_TOKENS", 126000))
+
+
+class PromptBudgetReport(BaseModel):
+    """Estimated prompt size split by where the tokens came from."""
+
+    system_prompt: int = 0
+    knowledge: int = 0
+    history: int = 0
+    tools: int = 0
+    tool_results: int = 0
+    total: int = 0
+    budget: int = DEFAULT_CONTEXT_BUDGET_TOKENS
+
+    @property
+    def over_budget(self) -> bool:
+        return self.total > self.budget
+
+
+class PromptBudgetExceeded(Exception):
+    def __init__(self, report: PromptBudgetReport):
+        self.report = report
+        super().__init__(
+            f"Prompt is ~{report.total} tokens, over this agent's context budget of {report.budget} tokens"
+        )
+
+
+def _as_dict(message: Any) -> Dict[str, Any]:
+    # The REST router keeps SDK ChatCompletionMessage objects in its history.
+    if isinstance(message, dict):
+        return message
+    return message.model_dump(exclude_none=True)
+
+
+class TokenEstimator:
+    """
+    Cheap local token counter.
+
+    Starts from a characters-per-token heuristic and keeps a per-model
+    correction factor that is nudged towards the `usage.prompt_tokens` numbers
+    Z.ai returns, so estimates converge on the real tokenizer over time.
+    """
+
+    CHARS_PER_TOKEN = 3.5
+    MESSAGE_OVERHEAD = 4  # role/separator tokens added per chat message
+    SMOOTHING = 0.2
+    MIN_SCALE, MAX_SCALE = 0.25, 4.0
+
+    def __init__(self):
+        self.scales: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+
+    def _raw_text(self, text: str) -> float:
+        if not text:
+            return 0.0
+        # CJK characters are usually one token each; everything else is ~3.5 chars.
+        wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+        return wide + (len(text) - wide) / self.CHARS_PER_TOKEN
+
+    def _raw_message(self, message: Any) -> float:
+        message = _as_dict(message)
+        raw = self.MESSAGE_OVERHEAD + self._raw_text(message.get("content") or "")
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            raw += self._raw_text(function.get("name") or "") + self._raw_text(function.get("arguments") or "")
+        return raw
+
+    def _scaled(self, raw: float, model: str) -> int:
+        return int(round(raw * self.scales.get(model, 1.0)))
+
+    def count_text(self, text: str, model: str = "") -> int:
+        return self._scaled(self._raw_text(text), model)
+
+    def count_message(self, message: Any, model: str = "") -> int:
+        return self._scaled(self._raw_message(message), model)
+
+    def count_tools(self, tools: Optional[List[Dict[str, Any]]], model: str = "") -> int:
+        if not tools:
+            return 0
+        return self._scaled(self._raw_text(json.dumps(tools, separators=(",", ":"))), model)
+
+    def observe(self, model: str, estimated_tokens: int, actual_tokens: int):
+        """Calibrate against the prompt_tokens reported by the upstream for a prompt we estimated."""
+        if estimated_tokens <= 0 or actual_tokens <= 0:
+            return
+        current = self.scales.get(model, 1.0)
+        # Work out the scale that would have produced the actual count, then smooth towards it.
+        target = current * actual_tokens / estimated_tokens
+        updated = current + self.SMOOTHING * (target - current)
+        self.scales[model] = min(self.MAX_SCALE, max(self.MIN_SCALE, updated))
+        self.samples[model] = self.samples.get(model, 0) + 1
+
+    def report(
+        self,
+        messages: List[Any],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        model: str = "",
+        knowledge_context: str = "",
+        budget: Optional[int] = None
+    ) -> PromptBudgetReport:
+        """
+        Break an outgoing prompt down by source. `knowledge_context` is the part of
+        the first system message that was injected from knowledge files; later
+        system messages carry retrieved knowledge chunks and count as knowledge,
+        except the conversation summary (see chat_memory), which is history.
+        """
+        report = PromptBudgetReport(budget=budget or DEFAULT_CONTEXT_BUDGET_TOKENS)
+        seen_system = False
+        for message in messages:
+            tokens = self.count_message(message, model)
+            message = _as_dict(message)
+            role = message.get("role")
+            if role == "system" and seen_system:
+                if (message.get("content") or "").startswith(SUMMARY_HEADER):
+                    report.history += tokens
+                else:
+                    report.knowledge += tokens
+            elif role == "system":
+                seen_system = True
+                knowledge = min(tokens, self.count_text(knowledge_context, model)) if knowledge_context else 0
+                report.knowledge += knowledge
+                report.system_prompt += tokens - knowledge
+            elif role == "tool":
+                report.tool_results += tokens
+            else:
+                report.history += tokens
+        report.tools = self.count_tools(tools, model)
+        report.total = report.system_prompt + report.knowledge + report.history + report.tools + report.tool_results
+        return report
+
+    def check(self, *args, **kwargs) -> PromptBudgetReport:
+        """Like report(), but raises PromptBudgetExceeded when the prompt does not fit."""
+        report = self.report(*args, **kwargs)
+        if report.over_budget:
+            raise PromptBudgetExceeded(report)
+        return report
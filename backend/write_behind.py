@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlmodel import Session
+
+from db_worker import DBWorker
+from models import ChatMessage, ChatSession
+
+logger = logging.getLogger(__name__)
+# Rows the database rejects, one JSON record per line, so they can be replayed by hand
+dead_letter_log = logging.getLogger(f"{__name__}.dead_letter")
+
+# Buffered writes are flushed this often, or as soon as PERSIST_MAX_BATCH rows are waiting
+PERSIST_FLUSH_MS = float(os.getenv("PERSIST_FLUSH_MS", 200))
+PERSIST_MAX_BATCH = int(os.getenv("PERSIST_MAX_BATCH", 500))
+# After this many failed flushes in a row the rows are written one at a time, so a
+# row the database rejects goes to the dead-letter log instead of blocking the rest
+PERSIST_MAX_ATTEMPTS = int(os.getenv("PERSIST_MAX_ATTEMPTS", 3))
+# Message rows held at most; past it add_message() waits for a flush to make room
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", 10000))
+FLUSH_SAMPLES = 500
+# The latest dead-lettered rows, kept in memory for inspection
+DEAD_LETTER_KEEP = 100
+
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens", "cached_prompt_tokens")
+
+
+class WriteBehindBuffer:
+    """
+    Collects chat messages and ChatSession token usage increments from all
+    connections and writes them in one transaction per flush: a multi-row
+    INSERT for the messages and one UPDATE per session with the summed usage.
+
+    A flush happens every `flush_ms`, when `max_batch` rows are waiting, or when
+    a caller awaits flush() (the WebSocket chat does at the end of each turn, so
+    a turn is stored before its "done" event is sent). Flushes run one at a time
+    on the DB worker, so rows are written in the order they were added. A failed
+    flush keeps its rows for the next attempt; close() flushes what is left on
+    shutdown.
+
+    Failures are bounded: after `max_attempts` failed flushes in a row the batch
+    is written row by row, and rows the database rejects (integrity or data
+    errors) go to the dead-letter log while the rest are stored; other errors
+    (the database is down) keep the remaining rows for the next attempt. At most
+    `max_pending` messages are held; beyond that add_message() waits until a
+    flush makes room, so memory stays bounded during an outage and callers are
+    slowed down instead of rows being dropped or written out of order.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        db: DBWorker,
+        flush_ms: float = PERSIST_FLUSH_MS,
+        max_batch: int = PERSIST_MAX_BATCH,
+        max_attempts: int = PERSIST_MAX_ATTEMPTS,
+        max_pending: int = PERSIST_MAX_PENDING
+    ):
+        self.session_factory = session_factory
+        self.db = db
+        self.flush_s = flush_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        # Failed flushes in a row
+        self._failures = 0
+        self._messages: List[Dict[str, Any]] = []
+        # Messages taken out by the flush in progress; still held until it succeeds
+        self._flushing = 0
+        # chat_session_id -> summed increments per usage field
+        self._usage: Dict[int, Dict[str, int]] = {}
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self._flush_queued = False
+        # Metrics
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.rows_written = 0
+        self.max_batch_rows = 0
+        self.backpressure_waits = 0
+        self.dead_lettered = 0
+        self.dead_letters: Deque[Dict[str, Any]] = deque(maxlen=DEAD_LETTER_KEEP)
+        self._batch_rows: Deque[int] = deque(maxlen=FLUSH_SAMPLES)
+        self._latencies: Deque[float] = deque(maxlen=FLUSH_SAMPLES)
+
+    @property
+    def pending(self) -> int:
+        return len(self._messages) + len(self._usage)
+
+    async def add_message(self, chat_session_id: int, role: str, content: str):
+        if len(self._messages) + self._flushing >= self.max_pending:
+            # Backlog full (the database is slow or down): hold this caller back until a
+            # flush on the DB worker makes room, retrying at the flush interval
+            self.backpressure_waits += 1
+            while len(self._messages) + self._flushing >= self.max_pending:
+                if not await self.flush():
+                    await asyncio.sleep(self.flush_s)
+        self._messages.append({"chat_session_id": chat_session_id, "role": role, "content": content})
+        self._schedule()
+
+    def add_usage(self, chat_session_id: int, **increments: int):
+        totals = self._usage.setdefault(chat_session_id, dict.fromkeys(USAGE_FIELDS, 0))
+        for field, value in increments.items():
+            totals[field] += value or 0
+        self._schedule()
+
+    def _schedule(self):
+        if self.pending >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_s, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_queued:
+            return
+        self._flush_queued = True
+        task = asyncio.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self) -> bool:
+        """Write everything buffered so far. Returns False if the write failed (rows are kept)."""
+        async with self._lock:
+            self._flush_queued = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending:
+                return True
+            messages, usage = self._messages, self._usage
+            self._messages, self._usage = [], {}
+            self._flushing = len(messages)
+            rows = len(messages) + len(usage)
+            started = time.monotonic()
+            dead = 0
+            try:
+                if self._failures >= self.max_attempts:
+                    messages, usage, dead = await self.db.run(self._write_each, messages, usage)
+                    if messages or usage:
+                        raise RuntimeError("database unavailable while writing rows one at a time")
+                else:
+                    await self.db.run(self._write, messages, usage)
+            except Exception as e:
+                self._flushing = 0
+                self._failures += 1
+                self.failed_flushes += 1
+                logger.error(f"Write-behind flush of {rows} rows failed, will retry: {e}")
+                # Put what is left of the batch back in front of anything added meanwhile
+                self._messages = messages + self._messages
+                for chat_session_id, totals in self._usage.items():
+                    merged = usage.setdefault(chat_session_id, dict.fromkeys(USAGE_FIELDS, 0))
+                    for field, value in totals.items():
+                        merged[field] += value
+                self._usage = usage
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(self.flush_s, self._start_flush)
+                return False
+            self._flushing = 0
+            self._failures = 0
+            self.flushes += 1
+            self.rows_written += rows - dead
+            self.max_batch_rows = max(self.max_batch_rows, rows)
+            self._batch_rows.append(rows)
+            self._latencies.append(time.monotonic() - started)
+            return True
+
+    def _write(self, messages: List[Dict[str, Any]], usage: Dict[int, Dict[str, int]]):
+        with self.session_factory() as session:
+            if messages:
+                session.execute(insert(ChatMessage), messages)
+            for chat_session_id, totals in usage.items():
+                session.execute(
+                    update(ChatSession)
+                    .where(ChatSession.id == chat_session_id)
+                    .values({field: getattr(ChatSession, field) + value for field, value in totals.items()})
+                )
+            session.commit()
+
+    def _write_each(
+        self, messages: List[Dict[str, Any]], usage: Dict[int, Dict[str, int]]
+    ) -> Tuple[List[Dict[str, Any]], Dict[int, Dict[str, int]], int]:
+        """
+        Write each row in its own transaction, dead-lettering rows the database
+        rejects. Stops at any other error; returns the rows not yet handled and
+        how many were dead-lettered.
+        """
+        dead = 0
+        for index, message in enumerate(messages):
+            try:
+                self._write([message], {})
+            except (IntegrityError, DataError) as e:
+                self._dead_letter("message", message, e)
+                dead += 1
+            except Exception:
+                return messages[index:], usage, dead
+        usage = dict(usage)
+        for chat_session_id, totals in list(usage.items()):
+            try:
+                self._write([], {chat_session_id: totals})
+            except (IntegrityError, DataError) as e:
+                self._dead_letter("usage", {"chat_session_id": chat_session_id, **totals}, e)
+                dead += 1
+            except Exception:
+                return [], usage, dead
+            del usage[chat_session_id]
+        return [], {}, dead
+
+    def _dead_letter(self, kind: str, row: Dict[str, Any], error: Exception):
+        record = {"kind": kind, "row": row, "error": str(error).splitlines()[0] if str(error) else type(error).__name__}
+        self.dead_lettered += 1
+        self.dead_letters.append(record)
+        dead_letter_log.error(json.dumps(record, default=str))
+
+    async def close(self):
+        """Flush on shutdown; anything that still can't be written is logged as lost."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if not await self.flush():
+            logger.error(f"Write-behind buffer closed with {self.pending} unwritten rows")
+        if self._timer is not None:
+            self._timer.cancel()  # the retry timer set by a failed flush
+            self._timer = None
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+        return {
+            "pending": self.pending,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "rows_written": self.rows_written,
+            "backpressure_waits": self.backpressure_waits,
+            "dead_lettered": self.dead_lettered,
+            "mean_batch_rows": round(sum(self._batch_rows) / len(self._batch_rows), 2) if self._batch_rows else None,
+            "max_batch_rows": self.max_batch_rows,
+            "flush_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+            "flush_max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+        }
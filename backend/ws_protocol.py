@@ -0,0 +1,138 @@
+import json
+from typing import Any, Dict, Optional, Tuple, Union
+
+from fastapi import WebSocket
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; without it only the text formats are offered
+    msgpack = None
+
+# Subprotocol names a client may offer in Sec-WebSocket-Protocol, e.g. "zai-chat.compact"
+SUBPROTOCOL_PREFIX = "zai-chat."
+
+# Short codes used by the compact formats instead of the "type" field
+TYPE_CODES = {
+    "token": "t",
+    "tool_start": "ts",
+    "tool_end": "te",
+    "done": "d",
+    "error": "e",
+    "queued": "q",
+    "overflow": "o",
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+
+class UnsupportedWireFormat(ValueError):
+    def __init__(self, name: str):
+        self.name = name
+        super().__init__(f"Unsupported protocol '{name}', expected one of: {', '.join(available_formats())}")
+
+
+class WireFormat:
+    """
+    The default protocol: one JSON object per text frame, exactly as
+    documented in DOC_FRONTEND_STREAMING_PROTOCOL.md.
+    """
+
+    name = "json"
+
+    def encode(self, event: Dict[str, Any]) -> Union[str, bytes]:
+        # Same encoding as WebSocket.send_json
+        return json.dumps(event, separators=(",", ":"), ensure_ascii=False)
+
+    def decode(self, message: Dict[str, Any]) -> Union[Dict[str, Any], str]:
+        """Client ASGI message -> payload dict, or the raw text for plain-string messages."""
+        text = message.get("text")
+        if text is None:
+            text = (message.get("bytes") or b"").decode("utf-8", errors="replace")
+        try:
+            payload = json.loads(text)
+        except ValueError:
+            return text
+        return payload if isinstance(payload, dict) else text
+
+
+def compact_frame(event: Dict[str, Any]) -> list:
+    """{"type": "token", "content": "hi"} -> ["t", "hi"]; other events -> [code, {fields}]."""
+    event_type = event.get("type")
+    code = TYPE_CODES.get(event_type, event_type)
+    if event_type == "token" and len(event) == 2:
+        return [code, event.get("content", "")]
+    fields = {k: v for k, v in event.items() if k != "type"}
+    return [code, fields] if fields else [code]
+
+
+def expand_frame(frame: list) -> Dict[str, Any]:
+    """Inverse of compact_frame (for clients and tests)."""
+    event_type = TYPE_NAMES.get(frame[0], frame[0])
+    if len(frame) < 2:
+        return {"type": event_type}
+    if isinstance(frame[1], dict):
+        return {"type": event_type, **frame[1]}
+    return {"type": event_type, "content": frame[1]}
+
+
+class CompactWireFormat(WireFormat):
+    """JSON text frames as [code, content] / [code, {fields}] arrays."""
+
+    name = "compact"
+
+    def encode(self, event: Dict[str, Any]) -> Union[str, bytes]:
+        return json.dumps(compact_frame(event), separators=(",", ":"), ensure_ascii=False)
+
+
+class MsgpackWireFormat(WireFormat):
+    """The compact frame layout as MessagePack binary frames."""
+
+    name = "msgpack"
+
+    def encode(self, event: Dict[str, Any]) -> Union[str, bytes]:
+        return msgpack.packb(compact_frame(event), use_bin_type=True)
+
+    def decode(self, message: Dict[str, Any]) -> Union[Dict[str, Any], str]:
+        data = message.get("bytes")
+        if data is None:
+            return super().decode(message)  # text frames are still accepted
+        try:
+            payload = msgpack.unpackb(data, raw=False)
+        except Exception:
+            return data.decode("utf-8", errors="replace")
+        if isinstance(payload, dict):
+            return payload
+        return payload if isinstance(payload, str) else str(payload)
+
+
+JSON = WireFormat()
+_FORMATS = {f.name: f for f in (JSON, CompactWireFormat(), MsgpackWireFormat())}
+
+
+def available_formats() -> list:
+    return [name for name in _FORMATS if name != "msgpack" or msgpack is not None]
+
+
+def get_wire_format(name: str) -> WireFormat:
+    if name not in available_formats():
+        raise UnsupportedWireFormat(name)
+    return _FORMATS[name]
+
+
+def negotiate(websocket: WebSocket) -> Tuple[WireFormat, Optional[str]]:
+    """
+    Pick the wire format for a connection. `?protocol=` wins (and raises
+    UnsupportedWireFormat if unknown); otherwise the first offered
+    "zai-chat.<name>" subprotocol we support. Returns the format and the
+    subprotocol to confirm in the handshake, if any. JSON is the default.
+    """
+    offers = websocket.scope.get("subprotocols") or []
+    requested = websocket.query_params.get("protocol")
+    if requested:
+        matching = SUBPROTOCOL_PREFIX + requested
+        return get_wire_format(requested), matching if matching in offers else None
+    for offered in offers:
+        if offered.startswith(SUBPROTOCOL_PREFIX):
+            name = offered[len(SUBPROTOCOL_PREFIX):]
+            if name in available_formats():
+                return _FORMATS[name], offered
+    return JSON, None
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from ws_protocol import JSON, WireFormat
+
+logger = logging.getLogger(__name__)
+
+# Consecutive token events are merged into one frame per interval or size
+WS_COALESCE_MS = float(os.getenv("WS_COALESCE_MS", 20))
+WS_COALESCE_CHARS = int(os.getenv("WS_COALESCE_CHARS", 512))
+# Unsent output a client may fall behind by before the overflow policy applies
+WS_SEND_BUFFER_CHARS = int(os.getenv("WS_SEND_BUFFER_CHARS", 1_000_000))
+# "disconnect": close the socket (1013) and abort the turn; "drop": discard the
+# unsent token text and tell the client how much was lost
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "disconnect")
+WS_CLOSE_DRAIN_S = 5.0
+
+# Rough size of a non-token event, for the buffer limit
+_EVENT_CHARS = 64
+
+
+class ClientTooSlow(WebSocketDisconnect):
+    """The client fell further behind than WS_SEND_BUFFER_CHARS."""
+
+    def __init__(self):
+        super().__init__(code=1013, reason="Client too slow")
+
+
+class ConnectionWriter:
+    """
+    Sends events for one WebSocket from a dedicated task, so producers (the
+    upstream stream consumer) never wait on client I/O.
+
+    send() only queues. Token events are held for up to `coalesce_ms` (or
+    `coalesce_chars`) and merged into one frame; while the writer is behind,
+    new tokens are also merged into the newest unsent token frame. Other
+    events flush pending tokens first, so ordering is preserved. If unsent
+    output exceeds `max_buffer_chars` the overflow policy applies.
+
+    Frames are encoded with the connection's negotiated `wire_format`; bytes
+    written for token frames are counted so formats can be compared per token.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        coalesce_ms: float = WS_COALESCE_MS,
+        coalesce_chars: int = WS_COALESCE_CHARS,
+        max_buffer_chars: int = WS_SEND_BUFFER_CHARS,
+        overflow_policy: str = WS_OVERFLOW_POLICY,
+        wire_format: WireFormat = JSON
+    ):
+        self.websocket = websocket
+        self.wire_format = wire_format
+        self.coalesce_s = coalesce_ms / 1000.0
+        self.coalesce_chars = coalesce_chars
+        self.max_buffer_chars = max_buffer_chars
+        self.overflow_policy = overflow_policy
+        self._frames: Deque[Dict[str, Any]] = deque()
+        self._tail_token: Optional[Dict[str, Any]] = None  # newest unsent token frame
+        self._overflow_notice: Optional[Dict[str, Any]] = None  # unsent "overflow" frame
+        self._pending: list = []
+        self._pending_chars = 0
+        self._buffered_chars = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.error: Optional[WebSocketDisconnect] = None
+        # Metrics
+        self.tokens_in = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.token_bytes_sent = 0  # payload bytes of token frames, before any compression
+        self.dropped_chars = 0
+        self.overflows = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def buffered_chars(self) -> int:
+        return self._buffered_chars + self._pending_chars
+
+    def send(self, event: Dict[str, Any]):
+        """Queue an event without waiting. Raises WebSocketDisconnect once the connection is gone."""
+        if self.error:
+            raise self.error
+        if event.get("type") == "token" and len(event) == 2:
+            content = event.get("content") or ""
+            self.tokens_in += 1
+            self._pending.append(content)
+            self._pending_chars += len(content)
+            if self.coalesce_s <= 0 or self._pending_chars >= self.coalesce_chars:
+                self._flush_tokens()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.coalesce_s, self._flush_tokens)
+        else:
+            self._flush_tokens()
+            self._push(event, _EVENT_CHARS)
+            self._tail_token = None
+        self._check_overflow()
+
+    def _flush_tokens(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        content = "".join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        if self._tail_token is not None:
+            # Writer is behind: grow the unsent frame instead of adding another
+            self._tail_token["content"] += content
+            self._buffered_chars += len(content)
+        else:
+            self._tail_token = {"type": "token", "content": content}
+            self._push(self._tail_token, len(content))
+
+    def _push(self, frame: Dict[str, Any], size: int):
+        self._frames.append(frame)
+        self._buffered_chars += size
+        self._wakeup.set()
+
+    def _check_overflow(self):
+        if self.buffered_chars <= self.max_buffer_chars:
+            return
+        self.overflows += 1
+        if self.overflow_policy == "drop":
+            dropped = self._pending_chars
+            self._pending, self._pending_chars = [], 0
+            kept: Deque[Dict[str, Any]] = deque()
+            for frame in self._frames:
+                if frame.get("type") == "token":
+                    dropped += len(frame["content"])
+                else:
+                    kept.append(frame)
+            self._frames = kept
+            self._tail_token = None
+            self._buffered_chars = len(kept) * _EVENT_CHARS
+            if not dropped:
+                return  # only control events are queued; nothing to shed
+            self.dropped_chars += dropped
+            logger.warning(f"WS client too slow, dropped {dropped} chars of output")
+            if self._overflow_notice is not None:
+                self._overflow_notice["dropped_chars"] += dropped
+            else:
+                self._overflow_notice = {"type": "overflow", "dropped_chars": dropped}
+                self._push(self._overflow_notice, _EVENT_CHARS)
+        else:
+            logger.warning(f"WS client too slow ({self.buffered_chars} chars unsent), disconnecting")
+            self.error = ClientTooSlow()
+            self._frames.clear()
+            self._tail_token = None
+            self._wakeup.set()
+            raise self.error
+
+    async def _run(self):
+        try:
+            while True:
+                if not self._frames:
+                    if self._closing or self.error:
+                        break
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                frame = self._frames.popleft()
+                if frame is self._tail_token:
+                    self._tail_token = None
+                elif frame is self._overflow_notice:
+                    self._overflow_notice = None
+                self._buffered_chars -= len(frame["content"]) if frame.get("type") == "token" else _EVENT_CHARS
+                data = self.wire_format.encode(frame)
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                    size = len(data)
+                else:
+                    await self.websocket.send_text(data)
+                    size = len(data.encode("utf-8"))
+                self.frames_sent += 1
+                self.bytes_sent += size
+                if frame.get("type") == "token":
+                    self.token_bytes_sent += size
+            if isinstance(self.error, ClientTooSlow):
+                await self.websocket.close(code=self.error.code, reason=self.error.reason)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"WS writer stopped: {e}")
+            self.error = self.error or WebSocketDisconnect(code=1006)
+
+    async def close(self, timeout: float = WS_CLOSE_DRAIN_S):
+        """Send what is queued (up to `timeout`) and stop the writer task."""
+        if self.error is None:
+            self._flush_tokens()
+        self._closing = True
+        self._wakeup.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except (asyncio.TimeoutError, Exception):
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
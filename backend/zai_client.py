@@ -1,37 +1,140 @@
 import os
+import json
 import httpx
-from typing import List, Dict, Optional, Any
-from openai import AsyncOpenAI, RateLimitError
+from collections import OrderedDict
+from typing import List, Dict, Optional, Any, NamedTuple, Callable, Awaitable, Tuple
+from openai import AsyncOpenAI, RateLimitError, InternalServerError, APIStatusError
 from openai.types.chat import ChatCompletionMessage
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
+from key_pool import KeyPool, KeyState, mask_key
+
+try:
+    import orjson
+
+    def _loads(data):
+        return orjson.loads(data)
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:  # orjson is optional; the stdlib is just slower
+    def _loads(data):
+        return json.loads(data)
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+# Upstream HTTP connections per pooled key. Every key has its own client, so total
+# concurrency grows with the number of keys configured
+ZAI_MAX_CONNECTIONS_PER_KEY = int(os.getenv("ZAI_MAX_CONNECTIONS_PER_KEY", 10))
+ZAI_MAX_KEEPALIVE_PER_KEY = int(os.getenv("ZAI_MAX_KEEPALIVE_PER_KEY", 5))
+
+
+class StreamDelta(NamedTuple):
+    """One streamed chunk, reduced to the fields the chat loop uses."""
+    content: Optional[str]
+    reasoning: Optional[str]
+    tool_calls: Optional[List[Dict[str, Any]]]  # raw OpenAI tool_call deltas
+    usage: Optional[Dict[str, Any]]
+
+
+def _chunk_to_delta(chunk) -> StreamDelta:
+    usage = chunk.usage.model_dump(exclude_none=True) if getattr(chunk, "usage", None) else None
+    if not chunk.choices:
+        return StreamDelta(None, None, None, usage)
+    delta = chunk.choices[0].delta
+    tool_calls = [tc.model_dump(exclude_none=True) for tc in delta.tool_calls] if delta.tool_calls else None
+    return StreamDelta(delta.content, getattr(delta, "reasoning_content", None), tool_calls, usage)
+
+
 class ZaiClient:
-    def __init__(self, api_key: str, base_url: str = "https://api.z.ai/api/coding/paas/v4", timeout: int = 300):
-        self.api_key = api_key
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: str = "https://api.z.ai/api/coding/paas/v4",
+        timeout: int = 300,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        raw_streaming: bool = False,
+        api_keys: Optional[List[str]] = None
+    ):
         self.base_url = base_url
         self.timeout = timeout
+        # Stream via stream_deltas() with the hand-rolled SSE parser instead of the SDK
+        self.raw_streaming = raw_streaming
+        # tools_key -> (tools list, serialized JSON); see _tools_json()
+        self._tools_json_cache: "OrderedDict[str, tuple]" = OrderedDict()
         
-        # Create a custom Async HTTP client for better performance and stability
-        self.http_client = httpx.AsyncClient(
+        # `transport` lets tests route requests to an in-process ASGI app (see fake_zai_server.py).
+        self.transport = transport
+
+        # Requests are spread over every configured key (see key_pool.py), each on its own HTTP client
+        self.pool = KeyPool(self.base_url, self._new_http_client, api_keys or [api_key])
+
+    def _new_http_client(self) -> httpx.AsyncClient:
+        # Custom Async HTTP client for better performance and stability
+        return httpx.AsyncClient(
             timeout=float(self.timeout),
-            limits=httpx.Limits(max_keepalive_connections=5, max_connections=10)
+            limits=httpx.Limits(
+                max_keepalive_connections=ZAI_MAX_KEEPALIVE_PER_KEY, max_connections=ZAI_MAX_CONNECTIONS_PER_KEY
+            ),
+            transport=self.transport,
+            event_hooks={"response": [self._on_response]}
         )
 
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url,
-            http_client=self.http_client
-        )
+    @property
+    def api_key(self) -> Optional[str]:
+        return self.pool.keys[0].api_key if self.pool.keys else None
 
     def update_api_key(self, api_key: str):
-        """Update the API key and re-initialize the client."""
-        self.api_key = api_key
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url,
-            http_client=self.http_client
-        )
-        print(f"ZaiClient API Key updated to: {api_key[:4]}***")
+        """Replace the key pool with a single key."""
+        self.set_api_keys([api_key])
+
+    def set_api_keys(self, api_keys: List[str]):
+        """Replace the key pool; counters are kept for keys that remain."""
+        self.pool.set_keys(api_keys)
+        print(f"ZaiClient API keys updated: {', '.join(mask_key(k) for k in api_keys)}")
+
+    async def _on_response(self, response: httpx.Response):
+        # Track per-key remaining quota from the upstream's rate limit headers
+        auth = response.request.headers.get("authorization", "")
+        key = self.pool.find(auth[len("Bearer "):])
+        if key is not None:
+            self.pool.observe_headers(key, response.headers)
+
+    def _client_for(self, key: KeyState, max_retries: Optional[int]) -> AsyncOpenAI:
+        if max_retries is None and len(self.pool) > 1:
+            # With spare keys a 429 moves on to another key instead of the SDK
+            # retrying (and sleeping) on the same one
+            max_retries = 0
+        if max_retries is None:
+            return key.client
+        return key.client.with_options(max_retries=max_retries)
+
+    async def _with_key(self, call: Callable[[KeyState], Awaitable[Any]]) -> Tuple[KeyState, Any]:
+        """
+        Run `call(key)` on the least-loaded pooled key. A 429 sidelines that key
+        and the call is repeated on another healthy key; once none is left the
+        RateLimitError propagates. The returned key stays acquired until the
+        caller passes it to pool.release().
+        """
+        while True:
+            key = self.pool.acquire()
+            try:
+                result = await call(key)
+            except RateLimitError as e:
+                self.pool.release(key)
+                self.pool.record_rate_limit(key, e.response)
+                if self.pool.has_healthy_key():
+                    continue
+                raise
+            except BaseException as e:
+                self.pool.release(key)
+                if isinstance(e, Exception):
+                    self.pool.record_error(key)
+                raise
+            self.pool.record_success(key)
+            return key, result
 
     @retry(
         retry=retry_if_exception_type(RateLimitError),
@@ -44,13 +147,32 @@ class ZaiClient:
         model: str = "glm-4.5-flash", 
         tools: Optional[List[Dict[str, Any]]] = None,
         tool_choice: Optional[Any] = None,
-        include_reasoning: bool = True
+        include_reasoning: bool = True,
+        on_usage: Optional[Callable[[Dict[str, Any]], None]] = None
     ) -> ChatCompletionMessage:
         """
         Send a chat request to Z.ai API, optionally with tools.
         Returns the full message object (content, tool_calls, etc).
         Retries on RateLimitError up to 3 times.
         """
+        return await self.chat_once(messages, model, tools, tool_choice, include_reasoning, on_usage=on_usage)
+
+    async def chat_once(
+        self, 
+        messages: List[Dict[str, str]], 
+        model: str = "glm-4.5-flash", 
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tool_choice: Optional[Any] = None,
+        include_reasoning: bool = True,
+        max_retries: Optional[int] = None,
+        on_usage: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> ChatCompletionMessage:
+        """
+        Single chat request without the RateLimitError retry loop, for callers
+        (ModelRouter) that fail over to another model instead of waiting.
+        `max_retries` overrides the SDK's own retry count; `on_usage` gets the
+        response's token usage dict, if it reports one.
+        """
         try:
             kwargs = {
                 "model": model,
@@ -63,7 +185,14 @@ class ZaiClient:
             if tool_choice:
                 kwargs["tool_choice"] = tool_choice
 
-            response = await self.client.chat.completions.create(**kwargs)
+            key, response = await self._with_key(
+                lambda k: self._client_for(k, max_retries).chat.completions.create(**kwargs)
+            )
+            self.pool.release(key)
+            usage = response.usage.model_dump(exclude_none=True) if response.usage else None
+            self.pool.record_usage(key, usage)
+            if usage and on_usage:
+                on_usage(usage)
             message = response.choices[0].message
             
             # Handle reasoning content fallback logic
@@ -89,12 +218,14 @@ class ZaiClient:
         model: str = "glm-4.5-flash", 
         tools: Optional[List[Dict[str, Any]]] = None,
         tool_choice: Optional[Any] = None,
-        stream_options: Optional[Dict[str, Any]] = None
+        stream_options: Optional[Dict[str, Any]] = None,
+        max_retries: Optional[int] = None
     ):
         """
         Send a streaming chat request to Z.ai API.
         Yields chunks of the response.
         Retries on RateLimitError.
+        `max_retries` overrides the SDK's own retry count.
         """
         try:
             kwargs = {
@@ -111,9 +242,163 @@ class ZaiClient:
             if stream_options:
                 kwargs["stream_options"] = stream_options
 
-            stream = await self.client.chat.completions.create(**kwargs)
-            async for chunk in stream:
-                yield chunk
+            key, stream = await self._with_key(
+                lambda k: self._client_for(k, max_retries).chat.completions.create(**kwargs)
+            )
+            try:
+                # Close the HTTP response even if the consumer stops early (e.g. a cancelled hedge)
+                async with stream:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            self.pool.record_usage(key, chunk.usage.model_dump())
+                        yield chunk
+            finally:
+                self.pool.release(key)
 
         except Exception as e:
             raise e
+
+    def _tools_json(self, tools: List[Dict[str, Any]], tools_key: Optional[str]) -> bytes:
+        """
+        Serialized tools, cached per caller key (e.g. one agent's tool list). The
+        cached list object is kept so a new list under the same key re-serializes.
+        """
+        if tools_key is None:
+            return _dumps(tools)
+        cached = self._tools_json_cache.get(tools_key)
+        if cached and cached[0] is tools:
+            self._tools_json_cache.move_to_end(tools_key)
+            return cached[1]
+        encoded = _dumps(tools)
+        self._tools_json_cache[tools_key] = (tools, encoded)
+        if len(self._tools_json_cache) > 256:
+            self._tools_json_cache.popitem(last=False)
+        return encoded
+
+    def _raw_request_body(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str,
+        tools: Optional[List[Dict[str, Any]]],
+        tools_key: Optional[str],
+        tool_choice: Optional[Any],
+        stream_options: Optional[Dict[str, Any]]
+    ) -> bytes:
+        head = {"model": model, "temperature": 0.7, "max_tokens": 2000, "stream": True}
+        if tool_choice:
+            head["tool_choice"] = tool_choice
+        if stream_options:
+            head["stream_options"] = stream_options
+        # Splice the pre-serialized tools into the body instead of re-encoding them per request
+        body = _dumps(head)[:-1] + b',"messages":' + _dumps(messages)
+        if tools:
+            body += b',"tools":' + self._tools_json(tools, tools_key)
+        return body + b"}"
+
+    async def chat_stream_raw(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str = "glm-4.5-flash",
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tools_key: Optional[str] = None,
+        tool_choice: Optional[Any] = None,
+        stream_options: Optional[Dict[str, Any]] = None
+    ):
+        """
+        Streaming chat request that parses the SSE response directly from httpx
+        and yields StreamDelta tuples, skipping the SDK's per-chunk pydantic models.
+        Errors are raised as the same openai exception types as chat_stream (no
+        retries beyond moving to another pooled key on a 429).
+        """
+        body = self._raw_request_body(messages, model, tools, tools_key, tool_choice, stream_options)
+
+        async def open_response(key: KeyState) -> httpx.Response:
+            headers = {
+                "Authorization": f"Bearer {key.api_key}",
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream",
+            }
+            request = key.http_client.build_request("POST", f"{self.base_url}/chat/completions", content=body, headers=headers)
+            response = await key.http_client.send(request, stream=True)
+            if response.status_code >= 400:
+                try:
+                    await response.aread()
+                finally:
+                    await response.aclose()
+                try:
+                    error_body = _loads(response.content)
+                except ValueError:
+                    error_body = response.text
+                message = f"Error code: {response.status_code} - {error_body}"
+                if response.status_code == 429:
+                    raise RateLimitError(message, response=response, body=error_body)
+                if response.status_code >= 500:
+                    raise InternalServerError(message, response=response, body=error_body)
+                raise APIStatusError(message, response=response, body=error_body)
+            return response
+
+        key, response = await self._with_key(open_response)
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if not data:
+                    # Keep-alive or an empty event
+                    continue
+                if data == "[DONE]":
+                    break
+                event = _loads(data)
+                usage = event.get("usage")
+                if usage:
+                    self.pool.record_usage(key, usage)
+                choices = event.get("choices")
+                if not choices:
+                    if usage:
+                        yield StreamDelta(None, None, None, usage)
+                    continue
+                delta = choices[0].get("delta") or {}
+                yield StreamDelta(
+                    delta.get("content"),
+                    delta.get("reasoning_content"),
+                    delta.get("tool_calls"),
+                    usage
+                )
+        finally:
+            await response.aclose()
+            self.pool.release(key)
+
+    async def stream_deltas(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str = "glm-4.5-flash",
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tools_key: Optional[str] = None,
+        tool_choice: Optional[Any] = None,
+        stream_options: Optional[Dict[str, Any]] = None,
+        max_retries: Optional[int] = None
+    ):
+        """
+        Stream a chat response as StreamDelta tuples, through the raw SSE path when
+        `raw_streaming` is enabled and through the SDK otherwise.
+        """
+        if self.raw_streaming:
+            stream = self.chat_stream_raw(messages, model, tools, tools_key, tool_choice, stream_options)
+            convert = None
+        else:
+            stream = self.chat_stream(
+                messages=messages,
+                model=model,
+                tools=tools,
+                tool_choice=tool_choice,
+                stream_options=stream_options,
+                max_retries=max_retries
+            )
+            convert = _chunk_to_delta
+
+        try:
+            async for item in stream:
+                yield convert(item) if convert else item
+        finally:
+            # Release the upstream response promptly if the consumer stops early
+            await stream.aclose()